@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 10:12:31 2026
+Benchmarks of the post-processing pipeline with synthetic tower data
+
+Generates deterministic EddyPro full output and CSI biomet like data for a
+number of site-years and times the stages of the pipeline: reading
+(df_fulloutput, df_biomet), screening (physical_range) and gap filling
+(biomet_gap_fill, gapfill). Every stage runs in its own process and reports
+its wall time, peak resident memory and rows per second.
+
+Usage
+-----
+python benchmarks.py --years 1 5 20 --gap-fraction 0.3 --gap-length 6
+python benchmarks.py --years 1 --stages gapfill --engine loop vectorized
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+STAGES = ['df_fulloutput', 'df_biomet', 'physical_range',
+          'biomet_gap_fill', 'gapfill']
+
+#%% Synthetic data
+
+
+def synthetic_met(years, seed=0, start='2020-01-01 00:30'):
+    """
+    Half-hourly meteorology with daily and seasonal cycles.
+
+    Parameters
+    ----------
+    years : float
+        Number of site-years.
+    seed : int, optional
+        Seed of the random generator. The default is 0.
+    start : str, optional
+        First time stamp. The default is '2020-01-01 00:30'.
+
+    Returns
+    -------
+    met : DataFrame
+        SW_IN [W m-2], TA [deg C], VPD [hPa], RH [%] and WS [m s-1].
+
+    """
+    rng   = np.random.default_rng(seed)
+    index = pd.date_range(start, periods=int(years*365*48), freq='30min')
+    n     = len(index)
+    hour  = index.hour + index.minute/60.
+    doy   = index.dayofyear.to_numpy()
+    season = np.sin((doy - 110)/365*2*np.pi)
+    sw  = 500*(1 + 0.6*season)*np.sin((hour - 6)/12*np.pi)
+    sw  = np.clip(sw, 0, None)*(0.5 + 0.5*rng.random(n))
+    ta  = (5 + 15*season + 5*np.sin((hour - 9)/24*2*np.pi) +
+           rng.normal(0, 1, n))
+    vpd = np.clip(0.6*ta + rng.normal(0, 2, n), 0, None)
+    rh  = np.clip(80 - 2*vpd + rng.normal(0, 5, n), 5, 100)
+    ws  = np.abs(rng.normal(3, 1.5, n))
+    return pd.DataFrame({'SW_IN': sw, 'TA': ta, 'VPD': vpd, 'RH': rh,
+                         'WS': ws}, index=index)
+
+
+def synthetic_gaps(n, gap_fraction=0.3, gap_length=6., seed=0,
+                   gap_dist='exponential'):
+    """
+    Boolean mask of gaps with random lengths.
+
+    Parameters
+    ----------
+    n : int
+        Number of data points.
+    gap_fraction : float, optional
+        Fraction of missing data points. The default is 0.3.
+    gap_length : float, optional
+        Mean length of the gaps in data points. The default is 6.
+    seed : int, optional
+        Seed of the random generator. The default is 0.
+    gap_dist : str or list of int, optional
+        Distribution of the gap lengths:
+
+        'exponential': exponential with mean *gap_length* (default).
+
+        'uniform': uniform from 1 to 2*gap_length-1.
+
+        'fixed': all gaps of *gap_length*.
+
+        list of int: lengths drawn from the list, *gap_length* is then
+        ignored.
+
+    Returns
+    -------
+    mask : array of bool
+        True for missing data.
+
+    """
+    rng  = np.random.default_rng(seed)
+    mask = np.zeros(n, dtype=bool)
+    if gap_fraction <= 0:
+        return mask
+    if not isinstance(gap_dist, str):
+        choices    = np.asarray(gap_dist, dtype=int)
+        gap_length = choices.mean()
+    ngap = int(np.ceil(gap_fraction*n/gap_length))
+    if not isinstance(gap_dist, str):
+        lengths = rng.choice(choices, ngap)
+    elif gap_dist == 'exponential':
+        lengths = rng.exponential(gap_length, ngap).astype(int)
+    elif gap_dist == 'uniform':
+        lengths = rng.integers(1, max(int(2*gap_length), 2), ngap)
+    elif gap_dist == 'fixed':
+        lengths = np.full(ngap, int(round(gap_length)))
+    else:
+        raise ValueError('gap_dist must be exponential, uniform, fixed or a'
+                         ' list of lengths, given: ' + str(gap_dist))
+    lengths = np.maximum(lengths, 1)
+    starts  = rng.integers(0, n, ngap)
+    for start, length in zip(starts, lengths):
+        mask[start:start+length] = True
+        if mask.mean() >= gap_fraction:
+            break
+    return mask
+
+
+def synthetic_flux(years, gap_fraction=0.3, gap_length=6., seed=0,
+                   gap_dist='exponential'):
+    """
+    Fluxes and meteorology as input for `gapfilling.gapfill`, with gaps in
+    the fluxes set to -9999.
+
+    Parameters
+    ----------
+    years, gap_fraction, gap_length, seed, gap_dist
+        See `synthetic_met` and `synthetic_gaps`.
+
+    Returns
+    -------
+    df : DataFrame
+        FC, LE, H, SW_IN, TA and VPD.
+
+    """
+    met = synthetic_met(years, seed)
+    rng = np.random.default_rng(seed + 1)
+    n   = len(met)
+    df  = pd.DataFrame(index=met.index)
+    df['FC'] = -0.02*met.SW_IN + 0.1*met.TA + 2 + rng.normal(0, 2, n)
+    df['LE'] = 0.35*met.SW_IN + 3*met.VPD + rng.normal(0, 15, n)
+    df['H']  = 0.25*met.SW_IN - 2*met.VPD + rng.normal(0, 15, n)
+    for icol, col in enumerate(['FC', 'LE', 'H']):
+        gaps = synthetic_gaps(n, gap_fraction, gap_length, seed + 10 + icol,
+                              gap_dist)
+        df.loc[gaps, col] = -9999.
+    df['SW_IN'] = met.SW_IN
+    df['TA']    = met.TA
+    df['VPD']   = met.VPD
+    return df
+
+
+def write_fulloutput(path, years, gap_fraction=0.3, gap_length=6., seed=0,
+                     gap_dist='exponential'):
+    """
+    Writes an EddyPro full output like file readable by
+    `data_ingest.df_fulloutput`.
+
+    Parameters
+    ----------
+    path : str
+        Filename.
+    years, gap_fraction, gap_length, seed, gap_dist
+        See `synthetic_flux`.
+
+    Returns
+    -------
+    nrows : int
+        Number of data rows.
+
+    """
+    df   = synthetic_flux(years, gap_fraction, gap_length, seed, gap_dist)
+    rng  = np.random.default_rng(seed + 2)
+    n    = len(df)
+    full = pd.DataFrame({
+        'filename': [ 'eddypro_'+str(i) for i in range(n) ],
+        'date': df.index.strftime('%Y-%m-%d'),
+        'time': df.index.strftime('%H:%M'),
+        'DOY': (df.index.dayofyear + df.index.hour/24.).to_numpy(),
+        'daytime': (df.SW_IN > 10).astype(int).to_numpy(),
+        'H': df.H.to_numpy(), 'qc_H': rng.integers(0, 3, n),
+        'LE': df.LE.to_numpy(), 'qc_LE': rng.integers(0, 3, n),
+        'co2_flux': df.FC.to_numpy(), 'qc_co2_flux': rng.integers(0, 3, n),
+        'u*': np.abs(rng.normal(0.3, 0.15, n)),
+        '(z-d)/L': rng.normal(0, 0.5, n),
+        'wind_dir': rng.uniform(0, 360, n),
+        'u_rot': np.abs(rng.normal(3, 1.5, n)), 'v_rot': rng.normal(0, 0.1, n),
+        'air_temperature': df.TA.to_numpy() + 273.15,
+        'VPD': df.VPD.to_numpy()*100.})
+    units = ['', '[yyyy-mm-dd]', '[HH:MM]', '[ddd.ddd]', '[1=daytime]',
+             '[W+1m-2]', '[#]', '[W+1m-2]', '[#]', '[µmol+1s-1m-2]', '[#]',
+             '[m+1s-1]', '[#]', '[deg_from_north]', '[m+1s-1]', '[m+1s-1]',
+             '[K]', '[Pa]']
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write('file_info,,,corrected_fluxes_and_quality_flags\n')
+        f.write(','.join(full.columns) + '\n')
+        f.write(','.join(units) + '\n')
+        full.to_csv(f, header=False, index=False, float_format='%.4f')
+    return n
+
+
+def write_biomet(directory, years, gap_fraction=0.3, gap_length=6.,
+                 seed=0, file_days=1, gap_dist='exponential'):
+    """
+    Writes CSI datalogger like biomet files readable by
+    `data_ingest.df_biomet`, one file per *file_days* days.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the files.
+    years, gap_fraction, gap_length, seed, gap_dist
+        See `synthetic_flux`.
+    file_days : int, optional
+        Number of days per file. The default is 1.
+
+    Returns
+    -------
+    pattern : str
+        Glob pattern of the files.
+    nrows : int
+        Number of data rows.
+
+    """
+    met = synthetic_met(years, seed)
+    n   = len(met)
+    bio = pd.DataFrame({'TIMESTAMP': met.index.strftime('%Y-%m-%d %H:%M:%S'),
+                        'RECORD': np.arange(n),
+                        'TA_1_1_1': met.TA.to_numpy(),
+                        'RH_1_1_1': met.RH.to_numpy(),
+                        'SWIN_1_1_1': met.SW_IN.to_numpy(),
+                        'WS_1_1_1': met.WS.to_numpy()})
+    for icol, col in enumerate(['TA_1_1_1', 'RH_1_1_1', 'SWIN_1_1_1',
+                                'WS_1_1_1']):
+        gaps = synthetic_gaps(n, gap_fraction, gap_length, seed + 20 + icol,
+                              gap_dist)
+        bio.loc[gaps, col] = -9999.
+    nfile = 48*file_days
+    for ifile, start in enumerate(range(0, n, nfile)):
+        path = os.path.join(directory, 'biomet_{:05d}.dat'.format(ifile))
+        with open(path, 'w', newline='') as f:
+            f.write('"TOA5","site","CR1000X","1","OS","CPU","1234","Biomet"\n')
+            f.write(','.join('"'+c+'"' for c in bio.columns) + '\n')
+            f.write('"TS","RN","C","%","W/m^2","m/s"\n')
+            f.write('"","","Avg","Avg","Avg","Avg"\n')
+            bio[start:start+nfile].to_csv(f, header=False, index=False,
+                                          float_format='%.3f')
+    return os.path.join(directory, 'biomet_*.dat'), n
+
+
+def range_yaml():
+    """
+    Screening configuration like the YAML files used by
+    `data_screening.physical_range` for the synthetic full output.
+    """
+    limits = {'H': [-200, 800], 'LE': [-200, 800], 'co2_flux': [-50, 50],
+              'u*': [0, 5], 'air_temperature': [233, 323], 'VPD': [0, 8000]}
+    names  = {'H': 'H', 'LE': 'LE', 'co2_flux': 'FC', 'u*': 'USTAR',
+              'air_temperature': 'TA', 'VPD': 'VPD'}
+    return { names[var]: {'inputFileName': var, 'variableName': names[var],
+                          'minMax': limits[var]} for var in limits }
+
+#%% Benchmark
+
+
+def _peak_rss():
+    """Peak resident memory of the process in MB, None if not available."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak/1024.**2 if sys.platform == 'darwin' else peak/1024.
+
+
+def _run_stage(stage, inputs, options, queue):
+    """
+    Runs a stage in a child process and puts its measures, or the error
+    message if it fails, in *queue*.
+    """
+    try:
+        queue.put(_stage_measures(stage, inputs, options))
+    except Exception as e:
+        queue.put('{}: {}'.format(type(e).__name__, e))
+
+
+def _stage_measures(stage, inputs, options):
+    """Wall time, peak RSS and its increase of a stage."""
+    import data_ingest
+    import data_screening
+    import gapfilling
+    if stage == 'df_fulloutput':
+        args = (inputs['fulloutput'],)
+        func = data_ingest.df_fulloutput
+    elif stage == 'df_biomet':
+        args = (inputs['biomet'],)
+        func = data_ingest.df_biomet
+    elif stage == 'physical_range':
+        args = (range_yaml(), pd.read_pickle(inputs['full']))
+        func = data_screening.physical_range
+    elif stage == 'biomet_gap_fill':
+        args = (pd.read_pickle(inputs['biomet_df']),
+                pd.read_pickle(inputs['predictors']))
+        func = gapfilling.biomet_gap_fill
+    else:
+        args = (pd.read_pickle(inputs['flux']),)
+        func = lambda df: gapfilling.gapfill(df, engine=options['engine'])
+    rss0 = _peak_rss()
+    t0   = time.perf_counter()
+    func(*args)
+    wall = time.perf_counter() - t0
+    rss  = _peak_rss()
+    return wall, rss, None if rss is None else rss - rss0
+
+
+def _stage_result(proc, queue, poll=1.):
+    """
+    Measures of the stage run by *proc*, or the error message if it failed
+    or exited without result.
+    """
+    from queue import Empty
+    while True:
+        try:
+            return queue.get(timeout=poll)
+        except Empty:
+            if not proc.is_alive():
+                break
+    try:
+        return queue.get(timeout=poll)
+    except Empty:
+        return 'process exited with code {}'.format(proc.exitcode)
+
+
+def run_benchmarks(years=(1, 5, 20), stages=STAGES, gap_fraction=0.3,
+                   gap_length=6., engines=('vectorized',), file_days=1,
+                   seed=0, workdir=None, verbose=1, gap_dist='exponential'):
+    """
+    Runs the benchmarks of the pipeline stages with synthetic data.
+
+    Parameters
+    ----------
+    years : list of float, optional
+        Site-years of synthetic data. The default is (1, 5, 20).
+    stages : list of str, optional
+        Stages to benchmark, see `STAGES`. The default is all.
+    gap_fraction : float, optional
+        Fraction of missing data. The default is 0.3.
+    gap_length : float, optional
+        Mean gap length in half-hours. The default is 6.
+    engines : list of str, optional
+        Engines of `gapfilling.gapfill`. The default is ('vectorized',).
+    file_days : int, optional
+        Days per synthetic biomet file. The default is 1.
+    seed : int, optional
+        Seed of the synthetic data. The default is 0.
+    workdir : str, optional
+        Directory for the synthetic files. The default is a temporary
+        directory removed at the end.
+    verbose : int, optional
+        Print every result if > 0. The default is 1.
+    gap_dist : str or list of int, optional
+        Distribution of the gap lengths, see `synthetic_gaps`. The default
+        is 'exponential'.
+
+    Returns
+    -------
+    results : DataFrame
+        Stage, engine, years, rows, wall time [s], peak RSS [MB], increase of
+        the peak RSS during the stage [MB], rows per second, and error
+        message of the failed stages (NaN measures).
+
+    """
+    import multiprocessing as mp
+    ctx = mp.get_context('spawn')
+    tmp = None
+    if workdir is None:
+        tmp = tempfile.TemporaryDirectory()
+        workdir = tmp.name
+    results = []
+    try:
+        for nyear in years:
+            ydir = os.path.join(workdir, 'years_'+str(nyear))
+            os.makedirs(ydir, exist_ok=True)
+            inputs = {}
+            # Inputs
+            inputs['fulloutput'] = os.path.join(ydir, 'full_output.csv')
+            nfull = write_fulloutput(inputs['fulloutput'], nyear,
+                                     gap_fraction, gap_length, seed,
+                                     gap_dist)
+            bdir = os.path.join(ydir, 'biomet')
+            os.makedirs(bdir, exist_ok=True)
+            inputs['biomet'], nbio = write_biomet(bdir, nyear, gap_fraction,
+                                                  gap_length, seed, file_days,
+                                                  gap_dist)
+            full = pd.read_csv(inputs['fulloutput'], skiprows=[0, 2],
+                               na_values=[-9999])
+            full = full.drop(columns=['filename', 'date', 'time'])
+            inputs['full'] = os.path.join(ydir, 'full.pkl')
+            full.to_pickle(inputs['full'])
+            flux = synthetic_flux(nyear, gap_fraction, gap_length, seed,
+                                  gap_dist)
+            inputs['flux'] = os.path.join(ydir, 'flux.pkl')
+            flux.to_pickle(inputs['flux'])
+            met = synthetic_met(nyear, seed)
+            bio = met[['TA', 'RH', 'WS']].copy()
+            for icol, col in enumerate(bio.columns):
+                bio.loc[synthetic_gaps(len(bio), gap_fraction, gap_length,
+                                       seed + 30 + icol, gap_dist),
+                        col] = np.nan
+            rng  = np.random.default_rng(seed + 3)
+            pred = met[['TA', 'RH', 'WS']] + rng.normal(0, 1, (len(met), 3))
+            inputs['biomet_df']  = os.path.join(ydir, 'biomet.pkl')
+            inputs['predictors'] = os.path.join(ydir, 'predictors.pkl')
+            bio.to_pickle(inputs['biomet_df'])
+            pred.to_pickle(inputs['predictors'])
+            nrows = {'df_fulloutput': nfull, 'df_biomet': nbio,
+                     'physical_range': nfull, 'biomet_gap_fill': len(bio),
+                     'gapfill': len(flux)}
+            # Stages
+            for stage in stages:
+                for engine in (engines if stage == 'gapfill' else ['']):
+                    queue = ctx.Queue()
+                    proc  = ctx.Process(target=_run_stage,
+                                        args=(stage, inputs,
+                                              {'engine': engine}, queue))
+                    proc.start()
+                    result = _stage_result(proc, queue)
+                    proc.join()
+                    res = {'stage': stage, 'engine': engine, 'years': nyear,
+                           'rows': nrows[stage], 'wall_s': np.nan,
+                           'peak_rss_mb': np.nan, 'delta_rss_mb': np.nan,
+                           'rows_per_s': np.nan, 'error': None}
+                    if isinstance(result, str):
+                        res['error'] = result
+                        results.append(res)
+                        if verbose > 0:
+                            print('{stage:>16s} {engine:>10s} {years:>5}'
+                                  ' years failed: {error}'.format(**res))
+                        continue
+                    wall, rss, drss = result
+                    res.update(wall_s=wall, peak_rss_mb=rss,
+                               delta_rss_mb=drss,
+                               rows_per_s=nrows[stage]/wall)
+                    results.append(res)
+                    if verbose > 0:
+                        print('{stage:>16s} {engine:>10s} {years:>5} years'
+                              ' {rows:>9d} rows {wall_s:9.2f} s'
+                              ' {rows_per_s:12.0f} rows/s'.format(**res))
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the'
+                                     ' post-processing pipeline.')
+    parser.add_argument('--years', type=float, nargs='+', default=[1, 5, 20],
+                        help='site-years of synthetic data')
+    parser.add_argument('--stages', nargs='+', default=STAGES,
+                        choices=STAGES, help='stages to benchmark')
+    parser.add_argument('--gap-fraction', type=float, default=0.3,
+                        help='fraction of missing data')
+    parser.add_argument('--gap-length', type=float, default=6.,
+                        help='mean gap length in half-hours')
+    parser.add_argument('--gap-dist', default='exponential',
+                        choices=['exponential', 'uniform', 'fixed'],
+                        help='distribution of the gap lengths')
+    parser.add_argument('--gap-lengths', type=int, nargs='+', default=None,
+                        help='gap lengths in half-hours drawn at random,'
+                        ' instead of --gap-dist and --gap-length')
+    parser.add_argument('--engine', nargs='+', default=['vectorized'],
+                        help='engines of gapfill')
+    parser.add_argument('--file-days', type=int, default=1,
+                        help='days per synthetic biomet file')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the synthetic data')
+    parser.add_argument('--output', default=None,
+                        help='csv file for the results')
+    args = parser.parse_args()
+    results = run_benchmarks(args.years, args.stages, args.gap_fraction,
+                             args.gap_length, args.engine, args.file_days,
+                             args.seed, gap_dist=args.gap_dist
+                             if args.gap_lengths is None
+                             else args.gap_lengths)
+    print(results.to_string(index=False))
+    if args.output is not None:
+        results.to_csv(args.output, index=False)
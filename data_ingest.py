@@ -8,13 +8,15 @@ Data ingest
 Functions to read and filter data
 """
 
+import os
 import numpy as np
 import pandas as pd
 
 #%% data reading functions
 
 
-def df_fulloutput(PATH):
+def df_fulloutput(PATH, dtype="float64", engine=None, chunksize=None,
+                  timeformat="%Y-%m-%d %H:%M", cache=None, lazy=False):
     """
     Reads the EddyPro fullout file and return a dataframe of the data and their
     units.
@@ -23,8 +25,28 @@ def df_fulloutput(PATH):
     ----------
     PATH : str
         String of the directory to the file.
-    FILENAME_FULL : str
-        Filename.
+    dtype : str or dtype, optional
+        Data type of the variables, e.g. "float32" to halve the memory.
+        Default is "float64".
+    engine : str, optional
+        CSV parser, "c", "python" or "pyarrow" (needs pyarrow). Default is
+        None, the pandas default.
+    chunksize : int, optional
+        Number of rows parsed at a time. The file is streamed and only the
+        30-min sums and counts are kept in memory. Default is None, the whole
+        file is read at once.
+    timeformat : str, optional
+        Format of the date and time columns joined by a space.
+        Default is "%Y-%m-%d %H:%M".
+    cache : str, optional
+        Directory of the on-disk cache (needs pyarrow). The parsed data and
+        units are stored as Feather files and read back without parsing
+        until the file changes. The whole DataFrame is still loaded in
+        memory. Default is None, no cache.
+    lazy : bool, optional
+        If True, returns a `FeatherWindows` of the cache file instead of the
+        DataFrame, so that the records can be read by time windows. Needs
+        *cache*. Default is False.
 
     Returns
     -------
@@ -34,21 +56,81 @@ def df_fulloutput(PATH):
         Series of the units of each variable as given by EddyPro.
 
     """
+    if cache is not None:
+        return _cached_read(df_fulloutput, PATH, cache,
+                            dict(dtype=dtype, timeformat=timeformat),
+                            dict(engine=engine, chunksize=chunksize), lazy)
+    if lazy:
+        raise ValueError("lazy needs a cache directory.")
+    # Header and units
+    head = pd.read_csv(PATH, skiprows=[0], nrows=1)
+    units = head.iloc[0][3:]
+    columns = [col for col in head.columns
+               if col not in ["filename", "date", "time"]]
+    dtypes = {col: dtype for col in columns}
+    dtypes.update({"date": str, "time": str})
     # Reading of fulloutput file
-    full = pd.read_csv(PATH, skiprows=([0]),
-                       low_memory=False)
-    units = full.iloc[0][3:]; full = full[1:]
-    # Indexing
-    full.index = pd.DatetimeIndex(full.date.astype(str) +' '+ full.time.astype(str))
-    # Droping columns and changing data to float
-    full = full.drop(columns=['filename', 'date', 'time']).astype(float)
-    full[full==-9999] = np.nan
-    # 30-min data consistency and sorting
-    full = full.resample('30min').mean()
+    if engine == "pyarrow":
+        chunks = _fulloutput_arrow(PATH, columns, dtypes, chunksize)
+    else:
+        chunks = pd.read_csv(PATH, skiprows=[0, 2], dtype=dtypes,
+                             usecols=["date", "time"] + columns,
+                             na_values=[-9999], engine=engine,
+                             chunksize=chunksize)
+    if chunksize is None:
+        chunks = [chunks]
+    sums = []; counts = []
+    for chunk in chunks:
+        # Indexing
+        chunk.index = pd.to_datetime(chunk.date + " " + chunk.time,
+                                     format=timeformat).rename(None)
+        chunk = chunk.drop(columns=["date", "time"])
+        if chunksize is None:
+            # 30-min data consistency and sorting
+            return chunk.resample("30min").mean(), units
+        bins = chunk.groupby(chunk.index.floor("30min"))
+        sums.append(bins.sum()); counts.append(bins.count())
+    # 30-min means of all chunks
+    full = (pd.concat(sums).groupby(level=0).sum() /
+            pd.concat(counts).groupby(level=0).sum()).astype(dtype)
+    full = full.reindex(pd.date_range(full.index[0], full.index[-1],
+                                      freq="30min"))
     return full, units
 
 
-def df_biomet(PATH):
+def _fulloutput_arrow(PATH, columns, dtypes, chunksize):
+    """
+    Parses the data rows of an EddyPro full output file with pyarrow, as a
+    DataFrame or as an iterator of DataFrames of about *chunksize* rows.
+    """
+    import pyarrow as pa
+    from pyarrow import csv
+    types = {col: pa.from_numpy_dtype(np.dtype(dtypes[col]))
+             for col in columns}
+    types.update({"date": pa.string(), "time": pa.string()})
+    convert = csv.ConvertOptions(column_types=types,
+                                 include_columns=["date", "time"] + columns)
+    def to_pandas(table):
+        # -9999 is matched by value, whatever its number of decimals
+        df = table.to_pandas()
+        df[columns] = df[columns].mask(df[columns] == -9999)
+        return df
+    if chunksize is None:
+        read = csv.ReadOptions(skip_rows=1, skip_rows_after_names=1)
+        return to_pandas(csv.read_csv(PATH, read_options=read,
+                                      convert_options=convert))
+    # block size from the length of a line of the file
+    with open(PATH, "rb") as f:
+        f.readline(); f.readline(); f.readline()
+        nbytes = len(f.readline())
+    read = csv.ReadOptions(skip_rows=1, skip_rows_after_names=1,
+                           block_size=max(nbytes*chunksize, 2**16))
+    reader = csv.open_csv(PATH, read_options=read, convert_options=convert)
+    return (to_pandas(batch) for batch in reader)
+
+
+def df_biomet(PATH, n_jobs=1, duplicates="mean", errors="warn",
+              timeformat="%Y-%m-%d %H:%M:%S", cache=None, lazy=False):
     """
     Reads the biomet data coming from a CSI datalogger. It can read multiple
     files if the filename is given with a string + *.
@@ -59,6 +141,26 @@ def df_biomet(PATH):
         String of the directory to the file.
     FILENAME_BIOMET : str
         Filename, it can read multiple files if the filename uses an *.
+    n_jobs : int, optional
+        Number of threads reading the files. Default is 1.
+    duplicates : str, optional
+        Resolution of repeated timestamps, e.g. in overlapping files: "mean"
+        averages them, "first" or "last" keeps the record of the first or
+        last file in name order. Default is "mean".
+    errors : str, optional
+        What to do with files that cannot be parsed: "raise" the error or
+        "warn", skip them and list them in a warning and in
+        df.attrs["skipped_files"]. Default is "warn".
+    timeformat : str, optional
+        Format of the TIMESTAMP column. Default is "%Y-%m-%d %H:%M:%S".
+    cache : str, optional
+        Directory of the on-disk cache (needs pyarrow). The parsed data and
+        units are stored as Feather files and read back without parsing
+        until one of the files changes, is added or removed. The whole
+        DataFrame is still loaded in memory. Default is None, no cache.
+    lazy : bool, optional
+        If True, returns a `FeatherWindows` of the cache file instead of the
+        DataFrame, see `df_fulloutput`. Default is False.
 
     Returns
     -------
@@ -68,36 +170,463 @@ def df_biomet(PATH):
         Series of the units of each variable.
 
     """
-    import glob
-    df = []
+    if duplicates not in ["mean", "first", "last"]:
+        raise ValueError("duplicates must be 'mean', 'first' or 'last'")
+    if errors not in ["raise", "warn"]:
+        raise ValueError("errors must be 'raise' or 'warn'")
+    if cache is not None:
+        return _cached_read(df_biomet, PATH, cache,
+                            dict(duplicates=duplicates, timeformat=timeformat),
+                            dict(n_jobs=n_jobs, errors=errors), lazy)
+    if lazy:
+        raise ValueError("lazy needs a cache directory.")
     # Lists all the files with silimar filenames
-    FILENAMES = glob.glob(PATH)
+    FILENAMES = _source_files(PATH)
+    read, skipped = _biomet_files(FILENAMES, n_jobs, errors, timeformat)
+    if not read:
+        raise ValueError("No biomet file could be read from " + PATH)
+    # Units of the last file read
+    df, units = _biomet_frame([dfo for _, dfo, _ in read], read[-1][2],
+                              duplicates)
+    df.attrs["skipped_files"] = skipped
+    return df, units
+
+
+def update_biomet(PATH, store, n_jobs=1, duplicates="mean", errors="warn",
+                  timeformat="%Y-%m-%d %H:%M:%S"):
+    """
+    Ingests the new or modified biomet files of a directory into a
+    consolidated store and returns the biomet data of the store, as
+    `df_biomet` does. Meant for runs on a growing archive of logger files,
+    only the files not seen before, or whose size or mtime changed, are
+    parsed.
+
+    Parameters
+    ----------
+    PATH : str
+        String of the directory to the files, with an *.
+    store : str
+        Feather file of the store (needs pyarrow), created if missing. It
+        holds the parsed records of every file and a manifest with the
+        path, size, mtime and row range of each file in the store.
+    n_jobs, duplicates, errors, timeformat
+        See `df_biomet`. Records are ordered by ingestion, "first" and
+        "last" duplicates refer to that order.
+
+    Returns
+    -------
+    df : DataFrame
+        DataFrame of the biomet data with the datetime as index.
+    units : Series
+        Series of the units of each variable.
+
+    Notes
+    -----
+    Files removed from the directory keep their records in the store. The
+    records of a modified file are replaced by its new content.
+
+    """
+    if duplicates not in ["mean", "first", "last"]:
+        raise ValueError("duplicates must be 'mean', 'first' or 'last'")
+    if errors not in ["raise", "warn"]:
+        raise ValueError("errors must be 'raise' or 'warn'")
+    FILENAMES = _source_files(PATH)
+    if os.path.isfile(store):
+        data, meta = _feather_read(store)
+        manifest = meta["manifest"]; units = _units_series(meta["units"])
+    else:
+        data = None; manifest = {}; units = None
+    # New and modified files
+    new = []
     for filename in FILENAMES:
-        dfo = pd.read_csv(filename, skiprows=[0])
-        units = dfo.iloc[0]; dfo = dfo[2:]
-        df.append(dfo)
+        st = os.stat(filename)
+        old = manifest.get(filename, {})
+        if (old.get("size"), old.get("mtime")) != (st.st_size,
+                                                   st.st_mtime_ns):
+            new.append((filename, st))
+    read, _ = _biomet_files([filename for filename, _ in new], n_jobs, errors,
+                            timeformat)
+    if read:
+        # Records of the modified files read again are dropped, the files
+        # that could not be read keep their records and manifest entries
+        # and are retried at the next update
+        keep = np.ones(0 if data is None else len(data), dtype=bool)
+        for filename, _, _ in read:
+            if filename in manifest:
+                rows = manifest.pop(filename)
+                keep[rows["start"]:rows["stop"]] = False
+        shift = np.concatenate([[0], np.cumsum(~keep)])
+        for rows in manifest.values():
+            rows["start"] -= int(shift[rows["start"]])
+            rows["stop"] -= int(shift[rows["stop"]])
+        data = [] if data is None else [data[keep]]
+        start = len(data[0]) if data else 0
+        stats = dict(new)
+        for filename, dfo, units in read:
+            st = stats[filename]
+            manifest[filename] = {"size": st.st_size, "mtime": st.st_mtime_ns,
+                                  "start": start, "stop": start + len(dfo)}
+            data.append(dfo); start += len(dfo)
+        data = pd.concat(data)
+        _feather_write(data, store, {"manifest": manifest,
+                                     "units": _units_meta(units)})
+    if data is None:
+        raise ValueError("No biomet file could be read from " + PATH)
+    return _biomet_frame([data], units, duplicates)
+
+
+def _biomet_files(FILENAMES, n_jobs, errors, timeformat):
+    """
+    Parses CSI datalogger TOA5 files, optionally on *n_jobs* threads.
+    Returns the list of (filename, data, units) of the files read, in the
+    order of FILENAMES. The files that could not be parsed are skipped and
+    reported in a warning when errors is "warn".
+    """
+    import warnings
+    from concurrent.futures import ThreadPoolExecutor
+    def read(filename):
+        try:
+            return _biomet_text(filename)
+        except Exception as e:
+            if errors == "raise":
+                raise
+            return e
+    # Reading of the files, the results keep the order of the filenames
+    if n_jobs > 1:
+        with ThreadPoolExecutor(int(n_jobs)) as executor:
+            texts = list(executor.map(read, FILENAMES))
+    else:
+        texts = [read(filename) for filename in FILENAMES]
+    # Files with the same header are parsed together
+    groups = {}; skipped = {}
+    for filename, text in zip(FILENAMES, texts):
+        if isinstance(text, Exception):
+            skipped[filename] = "{}: {}".format(type(text).__name__, text)
+            continue
+        groups.setdefault(text[0], []).append((filename, text[2]))
+    parsed = {}
+    for columns, files in groups.items():
+        files, bodies = zip(*files)
+        try:
+            dfo = _biomet_parse("".join(bodies), columns, timeformat)
+            # Splitting the records back per file
+            nrows = [sum(1 for line in body.split("\n") if line.strip())
+                     for body in bodies]
+            if sum(nrows) != len(dfo):
+                raise ValueError("blank lines")
+            bounds = np.concatenate([[0], np.cumsum(nrows)])
+            for i, filename in enumerate(files):
+                parsed[filename] = dfo.iloc[bounds[i]:bounds[i+1]]
+        except Exception:
+            # Parsing file by file to find the malformed ones
+            for filename, body in zip(files, bodies):
+                try:
+                    parsed[filename] = _biomet_parse(body, columns,
+                                                     timeformat)
+                except Exception as e:
+                    if errors == "raise":
+                        raise ValueError("Cannot parse " + filename) from e
+                    skipped[filename] = "{}: {}".format(type(e).__name__, e)
+    if skipped:
+        warnings.warn("{} biomet file(s) skipped:\n".format(len(skipped)) +
+                      "\n".join("{} ({})".format(*item)
+                                for item in skipped.items()))
+    return [(filename, parsed[filename], text[1])
+            for filename, text in zip(FILENAMES, texts)
+            if filename in parsed], skipped
+
+
+def _biomet_frame(df, units, duplicates):
+    """
+    Concatenates the records of biomet files into the 30-min biomet
+    DataFrame returned by `df_biomet`.
+    """
     # Concatenates all the files
     df = pd.concat(df)
-    # Indexing
-    df.index = pd.DatetimeIndex(df.TIMESTAMP)
-    # Droping columns and changing data to float
-    df = df.drop(columns=["TIMESTAMP"]).astype(float, errors="ignore")
-    df[df==-9999] = np.nan
+    if duplicates != "mean":
+        df = df.sort_index(kind="mergesort")
+        df = df[~df.index.duplicated(keep=duplicates)]
     # Droping columns with no data
     no_data = df.columns[df.isna().sum()==len(df)].to_list()
     df = df.drop(columns=no_data)
     units = units.drop(columns=no_data)
-    # 30-min data consistency and sorting
-    df = df.resample("30min").mean()
+    # 30-min data consistency and sorting, first value of text variables
+    text = df.columns[df.dtypes == object]
+    if len(text) > 0:
+        columns = df.columns
+        df = pd.concat([df.drop(columns=text).resample("30min").mean(),
+                        df[text].resample("30min").first()],
+                       axis=1)[columns]
+    else:
+        df = df.resample("30min").mean()
     return df, units
 
 
+def _biomet_text(filename):
+    """
+    Splits a CSI datalogger TOA5 file in its column names, units and the
+    text of the data lines.
+    """
+    import csv
+    with open(filename, newline="") as f:
+        lines = f.read().split("\n", 4)
+    if len(lines) < 5:
+        raise ValueError("incomplete TOA5 header")
+    columns, units = [next(csv.reader([line.rstrip("\r")]))
+                      for line in lines[1:3]]
+    if "TIMESTAMP" not in columns or len(units) != len(columns):
+        raise ValueError("not a TOA5 header")
+    units = pd.Series([u if u else np.nan for u in units], index=columns,
+                      name=0)
+    body = lines[4] if lines[4].endswith("\n") else lines[4] + "\n"
+    return tuple(columns), units, body
+
+
+def _biomet_parse(body, columns, timeformat):
+    """
+    Parses the data lines of TOA5 files. The numeric variables are float,
+    with NaN for values that are not numbers, and the text variables (e.g.
+    status strings) are kept as they are.
+    """
+    import io
+    dfo = pd.read_csv(io.StringIO(body), header=None, names=list(columns),
+                      index_col="TIMESTAMP", na_values=[-9999, "NAN"])
+    # Indexing
+    dfo.index = pd.to_datetime(dfo.index, format=timeformat)
+    for col in dfo.columns:
+        values = pd.to_numeric(dfo[col], errors="coerce")
+        if values.notna().any() or dfo[col].isna().all():
+            dfo[col] = values.astype(float)
+    return dfo
+
+
+def _source_files(PATH):
+    """
+    Returns the sorted list of files matched by PATH, which can use an *.
+    """
+    import glob
+    return sorted(os.path.abspath(f) for f in glob.glob(PATH))
+
+
+def _file_hash(filename, blocksize=2**20):
+    """
+    Returns the SHA-256 hex digest of the content of a file.
+    """
+    import hashlib
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _units_meta(units):
+    """
+    Returns the units Series as a JSON serializable dict.
+    """
+    return {"name": units.name, "index": list(units.index),
+            "values": list(units.values)}
+
+
+def _units_series(meta):
+    """
+    Returns the units Series of a dict made by `_units_meta`.
+    """
+    return pd.Series(meta["values"], index=meta["index"], name=meta["name"],
+                     dtype=object)
+
+
+def _feather_write(df, filename, meta):
+    """
+    Writes a DataFrame and its index into an uncompressed Feather file, with
+    the dict *meta* as JSON in the schema metadata.
+    """
+    import json
+    import pyarrow as pa
+    from pyarrow import feather
+    meta = dict(meta, index=df.index.name,
+                freq=getattr(df.index, "freqstr", None))
+    table = pa.Table.from_pandas(df.rename_axis("__index__").reset_index(),
+                                 preserve_index=False)
+    table = table.replace_schema_metadata(
+        {b"meta": json.dumps(meta, default=lambda o: o.item())})
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # Atomic replacement of the file
+    feather.write_feather(table, filename + ".tmp",
+                          compression="uncompressed")
+    os.replace(filename + ".tmp", filename)
+
+
+def _feather_meta(filename):
+    """
+    Returns the metadata of a Feather file written by `_feather_write`.
+    """
+    import json
+    from pyarrow import feather
+    return json.loads(feather.read_table(filename, memory_map=True)
+                      .schema.metadata[b"meta"])
+
+
+def _feather_read(filename):
+    """
+    Reads a Feather file written by `_feather_write`. Returns the DataFrame
+    and the metadata.
+
+    The file is memory-mapped and its columns are converted to pandas one by
+    one, releasing the Arrow buffers as they go, so the peak memory is about
+    one copy of the data instead of two. The DataFrame itself is not
+    memory-mapped (missing values are Arrow nulls, which are converted to
+    NaN).
+    """
+    import json
+    from pyarrow import feather
+    table = feather.read_table(filename, memory_map=True)
+    meta = json.loads(table.schema.metadata[b"meta"])
+    index = pd.Index(table.column("__index__").to_pandas(),
+                     name=meta["index"])
+    table = table.drop_columns(["__index__"])
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    del table
+    df.index = index
+    if meta["freq"] is not None:
+        df.index.freq = meta["freq"]
+    return df, meta
+
+
+def _cached_read(reader, PATH, cache, options, kwargs, lazy=False):
+    """
+    Returns reader(PATH, **options, **kwargs) from the Feather cache in the
+    directory *cache*, parsing and storing it when it is missing or stale.
+    The DataFrame is a `FeatherWindows` of the cache file if *lazy*.
+
+    The cache file is named after the reader, PATH and the *options*
+    changing the result. It holds the size, mtime and content hash
+    of every source file. A file with a different size or mtime is hashed
+    again and the cache is only rebuilt when its content changed.
+    """
+    import hashlib, json
+    files = _source_files(PATH)
+    name = json.dumps([reader.__name__, os.path.abspath(PATH), options],
+                      sort_keys=True)
+    fcache = os.path.join(cache, "{}_{}.feather".format(
+        reader.__name__, hashlib.sha1(name.encode()).hexdigest()[:16]))
+    stats = [os.stat(f) for f in files]
+    sources = [{"path": f, "size": st.st_size, "mtime": st.st_mtime_ns}
+               for f, st in zip(files, stats)]
+    fresh = os.path.isfile(fcache)
+    if fresh:
+        old = _feather_meta(fcache)["sources"]
+        fresh = len(old) == len(sources)
+        for src, o in zip(sources, old):
+            if not fresh:
+                break
+            src["hash"] = o["hash"]
+            if (src["path"], src["size"], src["mtime"]) != \
+               (o["path"], o["size"], o["mtime"]):
+                src["hash"] = _file_hash(src["path"])
+                fresh = src["path"] == o["path"] and src["hash"] == o["hash"]
+    if not fresh:
+        # Missing or stale cache
+        df, units = reader(PATH, **options, **kwargs)
+        for src in sources:
+            src.setdefault("hash", _file_hash(src["path"]))
+        _feather_write(df, fcache, {"sources": sources,
+                                    "units": _units_meta(units)})
+        if lazy:
+            return FeatherWindows(fcache), units
+        return df, units
+    if lazy:
+        meta = _feather_meta(fcache)
+        if sources != meta["sources"]:
+            # Same content, touched files
+            _feather_update_meta(fcache, dict(meta, sources=sources))
+        return FeatherWindows(fcache), _units_series(meta["units"])
+    df, meta = _feather_read(fcache)
+    if sources != meta["sources"]:
+        # Same content, touched files
+        _feather_write(df, fcache, dict(meta, sources=sources))
+    return df, _units_series(meta["units"])
+
+
+class FeatherWindows:
+    """
+    Records of a Feather file written by `_feather_write`, read by time
+    windows.
+
+    The file stays memory-mapped and only the records of a window are
+    converted to pandas, so that memory is bounded by the window instead of
+    by the whole record. Only the time index is loaded.
+
+    Parameters
+    ----------
+    filename : str
+        Feather file, e.g. a reader cache file.
+
+    Examples
+    --------
+    >>> full, units = df_fulloutput(PATH, cache="cache", lazy=True)
+    >>> df = full.window("2020-01-01", "2020-02-01")
+    """
+
+    def __init__(self, filename):
+        import json
+        from pyarrow import feather
+        self.filename = filename
+        self._table = feather.read_table(filename, memory_map=True)
+        meta = json.loads(self._table.schema.metadata[b"meta"])
+        self.index = pd.Index(self._table.column("__index__").to_pandas(),
+                              name=meta["index"])
+        self._table = self._table.drop_columns(["__index__"])
+        self.columns = pd.Index(self._table.column_names)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __repr__(self):
+        return "FeatherWindows({!r}, {} records x {} columns)".format(
+            self.filename, len(self), len(self.columns))
+
+    def window(self, start=None, stop=None):
+        """
+        DataFrame of the records from *start* included to *stop* excluded,
+        from the first or to the last record if None.
+        """
+        lo = 0 if start is None else self.index.searchsorted(
+            pd.Timestamp(start))
+        hi = len(self) if stop is None else self.index.searchsorted(
+            pd.Timestamp(stop))
+        df = self._table.slice(lo, max(hi - lo, 0)).to_pandas(
+            split_blocks=True)
+        df.index = self.index[lo:max(hi, lo)]
+        return df
+
+
+def _feather_update_meta(filename, meta):
+    """
+    Replaces the metadata of a Feather file written by `_feather_write`
+    without converting its data to pandas.
+    """
+    import json
+    from pyarrow import feather
+    table = feather.read_table(filename, memory_map=True)
+    old = json.loads(table.schema.metadata[b"meta"])
+    meta = dict(meta, index=old["index"], freq=old["freq"])
+    table = table.replace_schema_metadata(
+        {b"meta": json.dumps(meta, default=lambda o: o.item())})
+    feather.write_feather(table, filename + ".tmp",
+                          compression="uncompressed")
+    os.replace(filename + ".tmp", filename)
+
+
 def canadian_stations(PATH, lon, lat, d=50):
     """
     Returns the station IDs and names of the Canadian Meteorological stations
     close to the given coordinates. It will return all the stations in the given 
     distance.
 
+    The stations file is read once, see `StationCatalogue`.
+
     Parameters
     ----------
     PATH : str
@@ -116,38 +645,208 @@ def canadian_stations(PATH, lon, lat, d=50):
         Tuple with the stations ids and names (ids, names).
 
     """
-    from numpy import cos, arcsin, sqrt
-    df = pd.read_csv(PATH)
-    lats = df.y
-    lons = df.x
-    stsid = df.STN_ID
-    stsname = df.STATION_NAME
-    lon = float(lon)
-    lat = float(lat)   
-    d = float(d)
-    p = 0.017453292519943295
-    hav = 0.5 - cos((lats-lat)*p)/2 + cos(lat*p)*cos(lats*p) * (1-cos((lons-lon)*p)) / 2
-    distance = 12742 * arcsin(sqrt(hav))
-    mask = np.where(distance < d)[0]
-    ids = stsid[mask]
-    names = stsname[mask]
-    stns_info = (ids, names)
+    catalogue = StationCatalogue.load(PATH)
+    stations = catalogue.query_radius(float(lon), float(lat), float(d))
+    stations = stations.sort_index()
+    stns_info = (stations.STN_ID, stations.STATION_NAME)
     return stns_info
 
 
-def get_met_data(years, months, stn_id):
-    import requests
+class StationCatalogue:
+    """
+    Spatial index of the Canadian Meteorological stations of
+    climate-stations.csv, for radius and nearest-station queries of one or
+    many locations.
+
+    The stations are stored as 3-D unit vectors in a KD-tree, where the
+    chord distance between two points orders them as the great-circle
+    distance. Queries thus take microseconds instead of a haversine distance
+    to every station.
+
+    Parameters
+    ----------
+    PATH : str
+        Path of the climate-stations.csv file.
+
+    Attributes
+    ----------
+    stations : DataFrame
+        Stations of the file, with HLY_FIRST_DATE and HLY_LAST_DATE parsed.
+
+    Examples
+    --------
+    >>> catalogue = StationCatalogue.load("climate-stations.csv")
+    >>> catalogue.query_radius(-72.685, 46.1645, d=50, hourly=True)
+    >>> catalogue.query_nearest(lons, lats, k=3, start="2020-01-01",
+    ...                         end="2023-12-31")
+    """
+    RADIUS = 6371.0  # Earth radius [km]
+    _loaded = {}
+
+    def __init__(self, PATH):
+        from sklearn.neighbors import KDTree
+        df = pd.read_csv(PATH, low_memory=False)
+        for col in ["HLY_FIRST_DATE", "HLY_LAST_DATE"]:
+            df[col] = pd.to_datetime(df[col], errors="coerce")
+        self.stations = df
+        self._hourly = (df.HAS_HOURLY_DATA == "Y").to_numpy()
+        self._tree = KDTree(self._vectors(df.x, df.y))
+
+    def __len__(self):
+        return len(self.stations)
+
+    def __repr__(self):
+        return "StationCatalogue({} stations)".format(len(self))
+
+    @classmethod
+    def load(cls, PATH):
+        """
+        Catalogue of the file *PATH*, read again only if it changed since
+        the last call.
+        """
+        key = os.path.abspath(PATH)
+        mtime = os.stat(PATH).st_mtime_ns
+        if key not in cls._loaded or cls._loaded[key][0] != mtime:
+            cls._loaded[key] = (mtime, cls(PATH))
+        return cls._loaded[key][1]
+
+    @staticmethod
+    def _vectors(lon, lat):
+        """3-D unit vectors of the coordinates in decimal degrees."""
+        lon = np.radians(np.asarray(lon, dtype=float))
+        lat = np.radians(np.asarray(lat, dtype=float))
+        return np.column_stack([np.cos(lat)*np.cos(lon),
+                                np.cos(lat)*np.sin(lon), np.sin(lat)])
+
+    def _mask(self, hourly, start, end):
+        """Stations passing the filters, None if there are none."""
+        if not hourly and start is None and end is None:
+            return None
+        mask = self._hourly.copy() if hourly else np.ones(len(self), bool)
+        if start is not None:
+            mask &= (self.stations.HLY_FIRST_DATE <= pd.Timestamp(start)) \
+                .to_numpy()
+        if end is not None:
+            mask &= (self.stations.HLY_LAST_DATE >= pd.Timestamp(end)) \
+                .to_numpy()
+        return mask
+
+    def _result(self, ind, chord, mask):
+        """DataFrame of the stations *ind* sorted by distance."""
+        if mask is not None:
+            keep = mask[ind]
+            ind, chord = ind[keep], chord[keep]
+        order = np.argsort(chord, kind="stable")
+        out = self.stations.iloc[ind[order]].copy()
+        out["distance"] = 2*self.RADIUS*np.arcsin(np.minimum(chord[order]/2,
+                                                             1.))
+        return out
+
+    def query_radius(self, lon, lat, d=50, hourly=False, start=None,
+                     end=None):
+        """
+        Stations within a distance of the coordinates.
+
+        Parameters
+        ----------
+        lon, lat : float or array_like
+            Longitudes and latitudes in decimal degrees.
+        d : float, optional
+            Distance in [km]. Default is 50 km.
+        hourly : bool, optional
+            Only stations with hourly data (HAS_HOURLY_DATA). Default is
+            False.
+        start, end : str or Timestamp, optional
+            Only stations with hourly data from *start* and until *end*
+            (HLY_FIRST_DATE and HLY_LAST_DATE).
+
+        Returns
+        -------
+        stations : DataFrame or list of DataFrame
+            Stations sorted by distance, with the column "distance" in [km],
+            one DataFrame per location if *lon* and *lat* are arrays.
+        """
+        scalar = np.ndim(lon) == 0
+        chord = 2*np.sin(min(float(d)/(2*self.RADIUS), np.pi/2))
+        inds, chords = self._tree.query_radius(self._vectors(lon, lat), chord,
+                                               return_distance=True)
+        mask = self._mask(hourly, start, end)
+        out = [self._result(ind, dist, mask)
+               for ind, dist in zip(inds, chords)]
+        return out[0] if scalar else out
+
+    def query_nearest(self, lon, lat, k=5, hourly=False, start=None,
+                      end=None):
+        """
+        Nearest *k* stations of the coordinates, see `query_radius` for the
+        parameters.
+        """
+        scalar = np.ndim(lon) == 0
+        points = self._vectors(lon, lat)
+        mask = self._mask(hourly, start, end)
+        nvalid = len(self) if mask is None else int(mask.sum())
+        k = min(int(k), nvalid)
+        out = [None] * len(points)
+        todo = np.arange(len(points))
+        # More neighbours are queried until k of them pass the filters
+        kq = max(1, k if mask is None else min(len(self), 4*k))
+        while len(todo) > 0:
+            chords, inds = self._tree.query(points[todo], k=kq)
+            left = []
+            for i, ind, dist in zip(todo, inds, chords):
+                keep = slice(None) if mask is None else mask[ind]
+                if len(ind[keep]) >= k or kq == len(self):
+                    out[i] = self._result(ind[keep][:k], dist[keep][:k],
+                                          None)
+                else:
+                    left.append(i)
+            todo = np.array(left, dtype=int)
+            kq = min(len(self), 4*kq)
+        return out[0] if scalar else out
+
+
+ECCC_URL = "https://climate.weather.gc.ca/climate_data/bulk_data_e.html"
+# Result of a request still failing with 429 or 5xx after the retries
+_ECCC_FAILED = object()
+
+
+def get_met_data(years, months, stn_id, n_jobs=8, retries=3, timeout=20,
+                 base_url=ECCC_URL, cache=None):
+    """
+    Downloads the hourly data of an ECCC met station for the given years and
+    months, see `eccc_download`, and returns them resampled to 30 min and
+    interpolated to match the eddy covariance data.
+
+    Parameters
+    ----------
+    years : list, array
+        Years of the data.
+    months : list or array
+        Months of the data.
+    stn_id : float, int or str
+        Station ID using ECCC convention.
+    n_jobs : int, optional
+        Number of concurrent downloads. Default is 8.
+    retries : int, optional
+        Retries of a failed download. Default is 3.
+    timeout : float, optional
+        Timeout of each request in [s]. Default is 20 s.
+    base_url : str, optional
+        URL of the ECCC bulk data service. Default is `ECCC_URL`.
+    cache : str or ECCCCache, optional
+        Cache of the downloaded files, see `ECCCCache`. Default is None.
+
+    Returns
+    -------
+    df : DataFrame
+        Data with a 30-min resolution.
+    """
     import io
-    df = []
-    stn_id = str(int(stn_id))
-    for iyear in range(len(years)):
-        year = str(int(years[iyear]))
-        for imonth in range(len(months)):
-            month = str(int(months[imonth]))
-            url = "https://climate.weather.gc.ca/climate_data/bulk_data_e.html?format=csv&stationID="+stn_id+"&Year="+year+"&Month="+month+"&Day=14&timeframe=1&submit=%20Download+Data"
-            response = requests.get(url, timeout=20)
-            if response.ok:
-                df.append(pd.read_csv(io.StringIO(response.content.decode('utf-8'))))
+    periods = [(year, month) for year in years for month in months]
+    texts = eccc_download(stn_id, periods, n_jobs=n_jobs, retries=retries,
+                          timeout=timeout, base_url=base_url, cache=cache)
+    df = [pd.read_csv(io.StringIO(text)) for text in texts
+          if text is not None]
     df = pd.concat(df)
     df = df.drop(columns=df.filter(regex="Flag"))
     df.index = pd.DatetimeIndex(df['Date/Time (LST)'])
@@ -162,7 +861,264 @@ def get_met_data(years, months, stn_id):
     return df
 
 
-    
+def eccc_download(stn_id, periods, n_jobs=8, retries=3, backoff=1.,
+                  timeout=20, base_url=ECCC_URL, cache=None):
+    """
+    Downloads the hourly CSV files of an ECCC met station, one per month.
+
+    The months are downloaded on *n_jobs* threads sharing one HTTP session,
+    so that the connections to the server are reused. Connection errors,
+    timeouts and server errors (429, 5xx) are retried with exponential
+    backoff. Months still failing with server errors after the retries are
+    returned as None with a warning, and are not cached.
+
+    Parameters
+    ----------
+    stn_id : float, int or str
+        Station ID using ECCC convention.
+    periods : list of tuple
+        (year, month) of the files.
+    n_jobs : int, optional
+        Maximum number of concurrent requests. Default is 8.
+    retries : int, optional
+        Retries of a failed request. Default is 3.
+    backoff : float, optional
+        Wait before the first retry in [s], doubled at every retry. Default
+        is 1 s.
+    timeout : float, optional
+        Timeout of each request in [s]. Default is 20 s.
+    base_url : str, optional
+        URL of the bulk data service, e.g. a local server for testing.
+        Default is `ECCC_URL`.
+    cache : str or ECCCCache, optional
+        Cache directory of the files, only the months missing from it or not
+        complete are downloaded, past months refused by the server are not
+        requested again. Default is None, no cache.
+
+    Returns
+    -------
+    texts : list of str
+        CSV text of each period, None if the server refused it (e.g. 404) or
+        failed after the retries.
+
+    Raises
+    ------
+    ImportError
+        If requests is not installed and some periods must be downloaded.
+    """
+    import warnings
+    stn_id = str(int(stn_id))
+    periods = [(int(year), int(month)) for year, month in periods]
+    if cache is not None:
+        if not isinstance(cache, ECCCCache):
+            cache = ECCCCache(cache)
+        texts = [cache.get(stn_id, *period) for period in periods]
+        todo = [i for i, text in enumerate(texts) if text is None]
+        if todo:
+            new = _eccc_download(stn_id, [periods[i] for i in todo], n_jobs,
+                                 retries, backoff, timeout, base_url)
+            for i, text in zip(todo, new):
+                # failures are downloaded again next time
+                if text is not _ECCC_FAILED:
+                    cache.put(stn_id, *periods[i], text)
+                texts[i] = text
+    else:
+        texts = _eccc_download(stn_id, periods, n_jobs, retries, backoff,
+                               timeout, base_url)
+    failed = [period for period, text in zip(periods, texts)
+              if text is _ECCC_FAILED]
+    if failed:
+        warnings.warn("{} month(s) of station {} not downloaded after {} "
+                      "retries: {}".format(len(failed), stn_id, retries,
+                                           failed))
+    # Cached refusals and failures as None
+    return [None if (text is _ECCC_FAILED) or (text == "") else text
+            for text in texts]
+
+
+def _eccc_download(stn_id, periods, n_jobs, retries, backoff, timeout,
+                   base_url):
+    """
+    Texts of the months of `eccc_download` from the server, None if refused
+    and _ECCC_FAILED if the retries failed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    requests = _requests()
+    n_jobs = max(1, min(int(n_jobs), len(periods)))
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=n_jobs)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        def get(period):
+            year, month = period
+            params = {"format": "csv", "stationID": stn_id,
+                      "Year": str(year), "Month": str(month),
+                      "Day": "14", "timeframe": "1",
+                      "submit": " Download Data"}
+            return _eccc_get(session, base_url, params, retries, backoff,
+                             timeout)
+        if n_jobs > 1:
+            with ThreadPoolExecutor(n_jobs) as executor:
+                return list(executor.map(get, periods))
+        return [get(period) for period in periods]
+
+
+def _eccc_get(session, url, params, retries, backoff, timeout):
+    """
+    Text of a GET request of *session*, None if refused by the server,
+    retried *retries* times with exponential *backoff*. _ECCC_FAILED if the
+    server errors (429, 5xx) last after the retries, the last connection
+    error or timeout is raised.
+    """
+    import time
+    requests = _requests()
+    for attempt in range(int(retries) + 1):
+        last = attempt == int(retries)
+        try:
+            response = session.get(url, params=params, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout):
+            if last:
+                raise
+        else:
+            if response.ok:
+                return response.content.decode("utf-8")
+            if response.status_code not in (429, 500, 502, 503, 504):
+                return None
+            if last:
+                return _ECCC_FAILED
+        time.sleep(backoff * 2**attempt)
+
+
+def _requests():
+    """requests module, with an explicit error if it is not installed."""
+    try:
+        import requests
+    except ImportError as err:
+        raise ImportError("requests is needed to download the ECCC data, "
+                          "install it with: pip install requests") from err
+    return requests
+
+
+class ECCCCache:
+    """
+    On-disk cache of the monthly CSV files of the ECCC met stations, stored
+    gzip-compressed in <directory>/<station>/.
+
+    Whether a month is complete is decided when it is stored and kept in the
+    file name, so that copies of the cache keep it:
+
+    - <year>-<month>.csv.gz: downloaded after the end of the month, never
+      downloaded again.
+    - <year>-<month>.partial.csv.gz: downloaded before the end of the month
+      (e.g. the current month), downloaded again at every use.
+    - <year>-<month>.refused: empty marker of a past month refused by the
+      server, never requested again.
+
+    Parameters
+    ----------
+    directory : str
+        Cache directory, created if missing.
+
+    Attributes
+    ----------
+    hits, misses, refreshed : int
+        Months read from the cache (files or refusals), missing from it, and
+        in it but incomplete, since the cache was created.
+
+    Examples
+    --------
+    >>> cache = ECCCCache("eccc_cache")
+    >>> df = get_met_data(range(2015, 2025), range(1, 13), 51698,
+    ...                   cache=cache)
+    >>> cache.stats()
+    """
+    SUFFIXES = {"final": ".csv.gz", "partial": ".partial.csv.gz",
+                "refused": ".refused"}
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = self.misses = self.refreshed = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        return "ECCCCache({!r}, hits={}, misses={}, refreshed={})".format(
+            self.directory, self.hits, self.misses, self.refreshed)
+
+    def path(self, stn_id, year, month, state="final"):
+        """File of a station and month in the *state* of `SUFFIXES`."""
+        return os.path.join(self.directory, str(int(stn_id)),
+                            "{:04d}-{:02d}{}".format(int(year), int(month),
+                                                     self.SUFFIXES[state]))
+
+    @staticmethod
+    def complete(year, month):
+        """
+        True if the month ended, with a day of margin for the local time of
+        the stations.
+        """
+        end = pd.Timestamp(int(year), int(month), 1) + pd.DateOffset(
+            months=1, days=1)
+        return pd.Timestamp.now(tz="UTC").tz_localize(None) >= end
+
+    def get(self, stn_id, year, month):
+        """
+        CSV text of a station and month, "" if the server refused it, None
+        if it must be downloaded.
+        """
+        import gzip
+        if os.path.exists(self.path(stn_id, year, month, "refused")):
+            self.hits += 1
+            return ""
+        filename = self.path(stn_id, year, month)
+        if os.path.exists(filename):
+            self.hits += 1
+            with gzip.open(filename, "rt", encoding="utf-8") as f:
+                return f.read()
+        if os.path.exists(self.path(stn_id, year, month, "partial")):
+            self.refreshed += 1
+        else:
+            self.misses += 1
+        return None
+
+    def put(self, stn_id, year, month, text):
+        """
+        Stores the CSV text of a station and month, complete if the month
+        ended. A refusal (*text* None) is only stored for ended months, and
+        failed downloads are not stored.
+        """
+        import gzip
+        if text is _ECCC_FAILED:
+            return
+        complete = self.complete(year, month)
+        if text is None:
+            if complete:
+                filename = self.path(stn_id, year, month, "refused")
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                open(filename, "w").close()
+            return
+        filename = self.path(stn_id, year, month,
+                             "final" if complete else "partial")
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp = filename + ".tmp"
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, filename)
+        partial = self.path(stn_id, year, month, "partial")
+        if complete and os.path.exists(partial):
+            os.remove(partial)
+
+    def stats(self):
+        """
+        Dict of the number of hits, misses and refreshed files, and of the
+        hit rate.
+        """
+        total = self.hits + self.misses + self.refreshed
+        return {"hits": self.hits, "misses": self.misses,
+                "refreshed": self.refreshed,
+                "hit_rate": self.hits / total if total else 0.}
+
+
 def var_reading(varname, data, boolean):
     """
     Reads variables from a dataframe and turns non valid data into NaN.
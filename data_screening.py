@@ -7,89 +7,221 @@ Data screening functions
 import numpy as np
 import yaml
 import pandas as pd
+from collections import namedtuple
 #%% Filtering data functions
 
-def physical_range(yaml, df):
+RangePlan = namedtuple("RangePlan", ["input", "output", "min", "max"])
+RangePlan.__doc__ = """
+Compiled physical range screening of `physical_range`, see `range_plan`.
+"""
+
+
+def range_plan(yaml):
     """
-    Filter extreme values using the limits defined in the YAML configuration file
+    Compiles the limits of the YAML configuration file into a screening plan
+    that can be applied to many DataFrames with `physical_range`.
 
     Parameters
     ----------
     yaml : dict
         Dictionary from the YAML configuration file.
+
+    Returns
+    -------
+    plan : RangePlan
+        Input and output (Ameriflux) names of the variables and arrays of
+        their minimum and maximum values.
+
+    """
+    variables = {}
+    for section in yaml.keys():
+        metadata = yaml[section]
+        minmax = np.float64(metadata["minMax"])
+        # A repeated variable name takes the last section, in place
+        variables[metadata["variableName"]] = (metadata["inputFileName"],
+                                               minmax[0], minmax[1])
+    inputs = [var[0] for var in variables.values()]
+    return RangePlan(inputs, list(variables.keys()),
+                     np.array([var[1] for var in variables.values()]),
+                     np.array([var[2] for var in variables.values()]))
+
+
+def physical_range(yaml, df, qc=None):
+    """
+    Filter extreme values using the limits defined in the YAML configuration file
+
+    Parameters
+    ----------
+    yaml : dict or RangePlan
+        Dictionary from the YAML configuration file, or plan compiled from it
+        with `range_plan`.
     df : DataFrame
         DataFrame of the data to be filter.
+    qc : QCFlags, optional
+        Flags store where the data outside the limits are flagged with the
+        range test, under the Ameriflux names.
 
     Returns
     -------
     df2 : DataFrame
         DataFrame with the data already filtered using the extreme limits.
+        The variables of the YAML file not available in *df* are listed in
+        df2.attrs["missing_variables"].
 
     """
-    # Read sections of the yaml file
-    sections = yaml.keys()
-    # filter data in a loop for every section and rename to Ameriflux format
-    df2 = pd.DataFrame()
-    for section in sections:
-        metadata = yaml[section]
-        inputvarname = metadata["inputFileName"]
-        variablename = metadata["variableName"]
-        try: 
-            var = df[inputvarname].copy()
-            # Read min and max values of the variable
-            minmax = np.float64(metadata["minMax"])
-            # Create a boolean mask for values outside the interval
-            mask = (var < minmax[0]) | (var > minmax[1])
-            # Convert to nan data outside the limits
-            # df[inputvarname][mask] = np.nan
-            var[mask] = np.nan
-            # Rename column to Ameriflux standard format
-            df2[variablename] = var
-        except KeyError:
-            print("Variable " + inputvarname+" is not available in the dataset")
-            pass
+    plan = yaml if isinstance(yaml, RangePlan) else range_plan(yaml)
+    # Columns of the variables
+    positions = df.columns.get_indexer(plan.input)
+    found = positions >= 0
+    missing = [var for var, ok in zip(plan.input, found) if not ok]
+    if missing:
+        print("Variables not available in the dataset: " + ", ".join(missing))
+    if not found.any():
+        df2 = pd.DataFrame()
+    else:
+        # Filter all variables at once and rename to Ameriflux format
+        # iloc already copies the columns
+        data = df.iloc[:, positions[found]].to_numpy()
+        if not np.issubdtype(data.dtype, np.floating):
+            data = data.astype(float)
+        elif not data.flags.writeable:
+            data = data.copy()
+        mask = np.less(data, plan.min[found])
+        mask |= np.greater(data, plan.max[found])
+        np.copyto(data, np.nan, where=mask)
+        if qc is not None:
+            qc.set("range", mask, index=df.index,
+                   columns=[var for var, ok in zip(plan.output, found) if ok])
+        df2 = pd.DataFrame(data, index=df.index,
+                           columns=[var for var, ok in zip(plan.output, found)
+                                    if ok])
+    df2.attrs["missing_variables"] = missing
     return df2
 
 
-def dependencies_filtering(biomet_yaml, df):
+DependencyPlan = namedtuple("DependencyPlan", ["order", "dependent"])
+DependencyPlan.__doc__ = """
+Compiled dependencies of `dependencies_filtering`, see `dependency_plan`.
+"""
+
+
+def dependency_plan(biomet_yaml):
     """
-    Read the dependencies of a variable and propagate the dependencies' nan values
-    to the variable.
+    Compiles the dependencies of the YAML configuration file into a graph
+    of variables in topological order, every variable after the variables
+    it depends on.
 
     Parameters
     ----------
     biomet_yaml : dict
         Dictionary from the YAML configuration file.
+
+    Returns
+    -------
+    plan : DependencyPlan
+        Topological order of the variables and dict of the dependencies of
+        each variable with the dependent feature.
+
+    Raises
+    ------
+    ValueError
+        If the dependencies are cyclic, e.g. A depends on B and B on A. A
+        variable depending on itself is not a cycle, it is ignored.
+
+    """
+    dependent = {}
+    for section in biomet_yaml.keys():
+        variablename = biomet_yaml[section]["variableName"]
+        try:
+            dep = biomet_yaml[variablename]["dependent"]
+        except KeyError:
+            continue  # If the variable doesn't have the dependecies feature, it is skipped
+        if dep is None:
+            continue  # If the dependency feature does not have a variable, then it is omitted
+        dep = [dep] if isinstance(dep, str) else list(dep)
+        # A variable listed as its own dependency changes nothing
+        dependent[variablename] = [d for d in dep if d != variablename]
+    # Variables of the graph and variables depending on each of them
+    nodes = list(dependent)
+    users = {}
+    for variablename, deps in dependent.items():
+        for dependency in dict.fromkeys(deps):
+            if dependency not in dependent and dependency not in users:
+                nodes.append(dependency)
+            users.setdefault(dependency, []).append(variablename)
+    # Kahn's algorithm
+    remaining = {var: len(set(dependent.get(var, []))) for var in nodes}
+    order = [var for var in nodes if remaining[var] == 0]
+    for var in order:
+        for user in users.get(var, []):
+            remaining[user] -= 1
+            if remaining[user] == 0:
+                order.append(user)
+    if len(order) < len(nodes):
+        cycle = [var for var in nodes if remaining[var] > 0]
+        raise ValueError("Cyclic dependencies between the variables: "
+                         + ", ".join(cycle))
+    return DependencyPlan(order, dependent)
+
+
+def dependencies_filtering(biomet_yaml, df, qc=None):
+    """
+    Read the dependencies of a variable and propagate the dependencies' nan values
+    to the variable.
+
+    The dependencies are propagated transitively: if A depends on B and B
+    depends on C, the nan values of C are propagated to B and then to A.
+
+    Parameters
+    ----------
+    biomet_yaml : dict or DependencyPlan
+        Dictionary from the YAML configuration file, or plan compiled from it
+        with `dependency_plan`.
     df : DataFrame
         DataFrame of the data to be filtered.
+    qc : QCFlags, optional
+        Flags store where the data removed because of their dependencies are
+        flagged with the dependency test.
 
     Returns
     -------
     df3 : DataFrame
         DataFrame of the data already filtered using the dependencies.
+        Variables with dependencies missing in *df* are not filtered, the
+        missing variables are listed in df3.attrs["missing_variables"].
+
+    Raises
+    ------
+    ValueError
+        If the dependencies are cyclic.
 
     """
-    sections = biomet_yaml.keys()
+    plan = (biomet_yaml if isinstance(biomet_yaml, DependencyPlan)
+            else dependency_plan(biomet_yaml))
+    columns = [var for var in plan.order if var in df.columns]
+    icol = {var: i for i, var in enumerate(columns)}
+    # Mask of nan values of all variables, propagated in topological order
+    nan = df[columns].isna().to_numpy()
+    filtered = []
+    for variablename in plan.order:
+        deps = plan.dependent.get(variablename)
+        if deps is None or variablename not in icol:
+            continue
+        if any(dependency not in icol for dependency in deps):
+            continue
+        i = icol[variablename]
+        nan[:, i] |= nan[:, [icol[dependency] for dependency in deps]].any(axis=1)
+        filtered.append(variablename)
     df3 = df.copy(deep=True)
-    for section in sections:
-        metadata = biomet_yaml[section]
-        variablename = metadata["variableName"]
-        # try:
-        mask = np.zeros_like(df[variablename]) == 1 # Mask of Falses
-        try:
-            dep = biomet_yaml[variablename]["dependent"]
-            # In each loop the non valid data is propagated to the mask as Trues
-            try:
-                for dependency in dep:
-                    mask = mask + df[dependency].isna()
-                # If one of the dependencies is nan (due to lack of data or previous
-                # removal) then the nan values is propagated to the variable
-            except TypeError:
-                pass  # If the dependency feature does not have a variable, then it is omitted
-                
-            df3.loc[mask, variablename] = np.nan
-        except KeyError:
-            pass  # If the variable doesn't have the dependecies feature, it is skipped
+    for variablename in filtered:
+        df3[variablename] = df3[variablename].mask(nan[:, icol[variablename]])
+    if qc is not None and filtered:
+        # Only the data removed here, not the data already missing
+        rows = [icol[var] for var in filtered]
+        qc.set("dependency", nan[:, rows] & df[filtered].notna().to_numpy(),
+               index=df.index, columns=filtered)
+    df3.attrs["missing_variables"] = [var for var in plan.order
+                                      if var not in icol]
     return df3
     
     
@@ -170,7 +302,7 @@ def dependencies_qc(variable, min_val, max_val):
 
 
 def quality_screening(variable, min_val, max_val, date_exclusions,
-                      dependencies, foken_flags):
+                      dependencies, foken_flags, qc=None, column=None):
     """
     Returns filtered data of the variable desired using folken_flags, 
     physical possible values, dependencies and date exclusion.
@@ -193,6 +325,12 @@ def quality_screening(variable, min_val, max_val, date_exclusions,
     foken_flags : array or float
         Flux quality flags for micrometeorological tests using Mauder and Foken
         (2004) policy. If float, it does not apply the filter.
+    qc : QCFlags, optional
+        Flags where the range, date, nonfinite, dependency and foken tests
+        of the variable are recorded.
+    column : str, optional
+        Name of the variable in *qc*. Default is the name of *variable* if it
+        is a Series, whose index then gives the times of the flags.
 
     Returns
     -------
@@ -200,19 +338,299 @@ def quality_screening(variable, min_val, max_val, date_exclusions,
         Filtered variable.
 
     """
-    variable = np.copy(variable)
-    variable[variable>max_val] = np.nan; variable[variable<min_val] = np.nan
-    variable[date_exclusions] = np.nan
-    variable[~np.isfinite(variable)] = np.nan
-    variable[dependencies] = np.nan
-    try:
-        float(date_exclusions)
-        pass
-    except TypeError:
-        variable[date_exclusions] = np.nan
-    try:
-        float(foken_flags)
-        pass
-    except TypeError:
-        variable[foken_flags==2] = np.nan
-    return variable
\ No newline at end of file
+    index = None
+    if isinstance(variable, pd.Series):
+        index = variable.index
+        column = variable.name if column is None else column
+    if qc is not None and column is None:
+        raise ValueError("The column of the variable in qc is needed.")
+    variable = np.asarray(variable)
+    screened, _ = quality_screening_batch(
+        variable.reshape(-1, 1), min_val, max_val, date_exclusions,
+        dependencies, _column(foken_flags), qc=qc, columns=[column],
+        index=index)
+    return screened.reshape(variable.shape)
+
+
+def quality_screening_batch(data, min_val, max_val, date_exclusions=None,
+                            dependencies=None, foken_flags=None, qc=None,
+                            columns=None, index=None):
+    """
+    Screens many variables at once with the tests of `quality_screening`:
+    physical limits, date exclusions, non-finite values, dependencies and
+    Foken flags, in a single pass over a 2-D array.
+
+    Parameters
+    ----------
+    data : 2-D array or DataFrame
+        Variables to screen, of shape (time, variables).
+    min_val, max_val : float or array
+        Minimal and maximal possible values, one per variable or for all.
+    date_exclusions : boolean array, optional
+        Dates to filter from all variables, of length time, or of the shape
+        of *data* for exclusions of each variable, see `DateExclusions.masks`.
+        If None or float it does not apply the filter.
+    dependencies : boolean array, optional
+        Data to filter because of their dependencies, of the shape of
+        *data*, or of length time for all variables. If None or float it
+        does not apply the filter.
+    foken_flags : array, optional
+        Flux quality flags of Mauder and Foken (2004) of each variable, of
+        the shape of *data*, data with flag 2 are filtered. Use NaN for
+        variables without flags. If None or float it does not apply the
+        filter.
+    qc : QCFlags, optional
+        Flags where the tests of each variable are recorded.
+    columns : list of str, optional
+        Names of the variables in *qc*. Default is the columns of *data* if
+        it is a DataFrame.
+    index : array_like, optional
+        Times of the rows of *data* in *qc*. Default is the index of *data*
+        if it is a DataFrame, else the whole index of *qc*.
+
+    Returns
+    -------
+    screened : 2-D array
+        Filtered variables.
+    counts : dict
+        Number of data rejected by each test ("range", "date", "nonfinite",
+        "dependency", "foken") for each variable, a datum can be rejected by
+        several tests.
+
+    """
+    if isinstance(data, pd.DataFrame):
+        columns = data.columns if columns is None else columns
+        index = data.index if index is None else index
+    if qc is not None and columns is None:
+        raise ValueError("The columns of the variables in qc are needed.")
+    data = np.asarray(data)
+    if not np.issubdtype(data.dtype, np.floating):
+        data = data.astype(float)
+    # Physical limits and non-finite values
+    masks = {"range": np.less(data, min_val),
+             "nonfinite": ~np.isfinite(data)}
+    masks["range"] |= np.greater(data, max_val)
+    # Date exclusions, dependencies and Foken flags
+    for name, tmask in [("date", date_exclusions),
+                        ("dependency", dependencies),
+                        ("foken", foken_flags)]:
+        if tmask is None or np.ndim(tmask) == 0:
+            continue
+        if name == "foken":
+            tmask = np.asarray(tmask) == 2
+        else:
+            tmask = _row_mask(tmask, data.shape[0])
+        masks[name] = tmask[:, None] if tmask.ndim == 1 else tmask
+    # All tests applied at once
+    reject = masks["range"] | masks["nonfinite"]
+    for name in ["date", "dependency", "foken"]:
+        if name in masks:
+            reject |= masks[name]
+    screened = np.where(reject, np.nan, data)
+    counts = {name: np.broadcast_to(np.count_nonzero(mask, axis=0),
+                                    data.shape[1:]).copy()
+              for name, mask in masks.items()}
+    if qc is not None:
+        for name, mask in masks.items():
+            qc.set(name, np.broadcast_to(mask, data.shape), index=index,
+                   columns=columns)
+    return screened, counts
+
+
+def _row_mask(mask, n):
+    """
+    Boolean mask of length or shape *n* from a boolean mask or from indices.
+    """
+    mask = np.asarray(mask)
+    if mask.dtype == bool:
+        return mask
+    rows = np.zeros(n, dtype=bool)
+    rows[mask] = True
+    return rows
+
+
+def _column(flags):
+    """
+    Foken flags of a single variable as a column, scalars unchanged.
+    """
+    if flags is None or np.ndim(flags) == 0:
+        return flags
+    return np.asarray(flags).reshape(-1, 1)
+
+#%% Date exclusions
+
+
+class DateExclusions:
+    """
+    Registry of date exclusion intervals, e.g. maintenance or calibration
+    periods, with the variables they affect.
+
+    The intervals are kept sorted by start time for every variable, and
+    masks are built for a time index with `searchsorted`, in
+    O(k log n) for k intervals and n times, plus one pass to expand them.
+
+    Parameters
+    ----------
+    intervals : DataFrame or list of dict, optional
+        Intervals with the columns or keys "start", "end" (both included,
+        an empty bound leaves the interval open on that side) and
+        "variables", a list of variable names or "all" (default). An
+        optional "reason" is kept for reference.
+
+    Examples
+    --------
+    >>> exclusions = DateExclusions.from_yaml("exclusions.yaml")
+    >>> df2 = exclusions.apply(df)
+    >>> mask = exclusions.mask(df.index, "FC")
+    """
+
+    def __init__(self, intervals=None):
+        self.intervals = pd.DataFrame(columns=["start", "end", "variables",
+                                               "reason"])
+        self._index = {}
+        if intervals is not None:
+            self.add(intervals)
+
+    def __repr__(self):
+        return "DateExclusions({} intervals)".format(len(self.intervals))
+
+    def __len__(self):
+        return len(self.intervals)
+
+    @classmethod
+    def from_yaml(cls, path):
+        """
+        Reads the intervals from a YAML file, or from the dictionary of a
+        YAML file, as a list of intervals or under a "date_exclusions" key,
+        e.g.
+
+        date_exclusions:
+          - {start: 2024-05-01 10:00, end: 2024-05-01 14:00,
+             variables: [FC, LE], reason: calibration}
+        """
+        if isinstance(path, (dict, list)):
+            config = path
+        else:
+            with open(path) as f:
+                config = yaml.safe_load(f)
+        if isinstance(config, dict):
+            config = config.get("date_exclusions", list(config.values()))
+        return cls(config)
+
+    @classmethod
+    def from_csv(cls, path):
+        """
+        Reads the intervals from a CSV file with the columns start, end,
+        variables (names separated by ";", or all) and optionally reason.
+        """
+        df = pd.read_csv(path, dtype={"variables": str})
+        df["variables"] = [
+            "all" if pd.isna(var) or var.strip() == "all"
+            else [v.strip() for v in var.split(";") if v.strip()]
+            for var in df["variables"]]
+        return cls(df)
+
+    def add(self, intervals):
+        """
+        Adds intervals (DataFrame or list of dict, see `DateExclusions`).
+        """
+        new = pd.DataFrame(intervals)
+        if not {"start", "end"}.issubset(new.columns):
+            raise ValueError("Date exclusions need start and end dates.")
+        if "variables" not in new.columns:
+            new["variables"] = "all"
+        if "reason" not in new.columns:
+            new["reason"] = None
+        # Open-ended intervals
+        new["start"] = pd.to_datetime(new["start"]).fillna(pd.Timestamp.min)
+        new["end"] = pd.to_datetime(new["end"]).fillna(pd.Timestamp.max)
+        new["variables"] = [
+            "all" if (isinstance(var, str) and var == "all")
+            or (np.ndim(var) == 0 and pd.isna(var))
+            else [var] if isinstance(var, str) else list(var)
+            for var in new["variables"]]
+        if (new["end"] < new["start"]).any():
+            raise ValueError("Date exclusions must end after their start.")
+        new = new[["start", "end", "variables", "reason"]]
+        self.intervals = new if self.intervals.empty else \
+            pd.concat([self.intervals, new], ignore_index=True)
+        self._index = {}
+
+    def _intervals(self, variable):
+        """Sorted starts and ends of the intervals affecting *variable*."""
+        if not self._index:
+            # Sorted interval index of every variable, "all" for everyone
+            groups = {}
+            for start, end, variables in zip(self.intervals["start"],
+                                             self.intervals["end"],
+                                             self.intervals["variables"]):
+                for var in (["all"] if variables == "all" else variables):
+                    groups.setdefault(var, []).append((start, end))
+            for var, pairs in groups.items():
+                pairs = sorted(pairs)
+                self._index[var] = (pd.DatetimeIndex([p[0] for p in pairs]),
+                                    pd.DatetimeIndex([p[1] for p in pairs]))
+        empty = (pd.DatetimeIndex([]), pd.DatetimeIndex([]))
+        starts, ends = self._index.get(variable, empty)
+        if variable != "all":
+            all_starts, all_ends = self._index.get("all", empty)
+            if len(all_starts):
+                starts = starts.append(all_starts)
+                ends = ends.append(all_ends)
+        return starts, ends
+
+    def variables(self):
+        """
+        Variables with intervals, "all" if some intervals affect all.
+        """
+        self._intervals("all")
+        return list(self._index)
+
+    def mask(self, index, variable="all"):
+        """
+        Boolean mask of the times of *index* (sorted) excluded for
+        *variable*, or excluded for all variables if "all".
+        """
+        index = pd.DatetimeIndex(index)
+        starts, ends = self._intervals(variable)
+        lo = index.searchsorted(starts, side="left")
+        hi = index.searchsorted(ends, side="right")
+        # Number of intervals covering each time
+        cover = np.zeros(len(index) + 1, dtype=np.int64)
+        np.add.at(cover, lo, 1)
+        np.add.at(cover, hi, -1)
+        return np.cumsum(cover[:-1]) > 0
+
+    def masks(self, index, columns):
+        """
+        Boolean array of shape (len(index), len(columns)) of the excluded
+        data, e.g. the *date_exclusions* of `quality_screening_batch`.
+        """
+        return np.column_stack([self.mask(index, col) for col in columns]
+                               ) if len(columns) else \
+            np.zeros((len(index), 0), dtype=bool)
+
+    def apply(self, df, qc=None):
+        """
+        Returns a copy of *df* with nan in the excluded intervals. Only the
+        variables targeted by intervals are masked.
+
+        Parameters
+        ----------
+        df : DataFrame
+            Data with a sorted datetime index.
+        qc : QCFlags, optional
+            Flags store where the excluded data are flagged with the date
+            test.
+        """
+        df2 = df.copy()
+        targeted = self.variables()
+        columns = df.columns if "all" in targeted else \
+            [col for col in df.columns if col in targeted]
+        for col in columns:
+            mask = self.mask(df.index, col)
+            if mask.any():
+                df2[col] = df2[col].mask(mask)
+            if qc is not None:
+                qc.set("date", mask, index=df.index, columns=col)
+        return df2
@@ -4,22 +4,39 @@ Created on Thu Nov 28 13:23:44 2024
 
 @author: david
 """
+import os
+import warnings
 import numpy as np
 import pandas as pd
-from sklearn import linear_model
 
 #%% Functions
-def biomet_gap_fill(df, predictors):
+def biomet_gap_fill(df, predictors, window=None, step="1D",
+                    min_samples=None):
     """
     Gapfills biometerological data from EC stations using multiple linear
     regression (MLR) with near meterological data from other stations as predictors.
 
+    The columns with the same missing data share one least-squares solve,
+    and remaining gaps are interpolated in time once all columns are filled.
+
     Parameters
     ----------
     df : DataFrame
         Original DataFrame with biometeorological data.
     predictors : DataFrame
         Meterological data from other stations as predictors.
+    window : str or Timedelta, optional
+        Half-width of moving windows, e.g. "15D". If given, the gaps of every
+        *step* are filled with a regression fitted on the data within
+        *window* of it (e.g. +-15 days) instead of one regression over the
+        whole record, which follows the seasonality of the relations.
+        Records with non-finite predictors are then ignored instead of
+        leaving the whole column unfilled. Default is None, one regression.
+    step : str or Timedelta, optional
+        Period filled by each moving-window regression. Default is "1D".
+    min_samples : int, optional
+        Minimum number of training data of a moving window, its gaps are
+        otherwise interpolated. Default is the number of predictors + 2.
 
     Returns
     -------
@@ -27,37 +44,288 @@ def biomet_gap_fill(df, predictors):
         Original DataFrame with filled values in its gaps using MLR.
 
     """
-    # warnings.filterwarnings("ignore", category=DeprecationWarning)
     columns = df.columns
     df_pred = df.copy(deep=True)
-    for icol in range(len(columns)):
-        # Variable selection and validation
-        col = columns[icol]
-        var = df[col].copy(deep=True)
-        var[~np.isfinite(var)] = np.nan
-        # Date selection to train the model
-        valid_intersection = df.index.intersection(predictors.index)
-        # Linear Model
-        reg = linear_model.LinearRegression()
-        var2 = var[valid_intersection]
-        pred2 = predictors.loc[valid_intersection]
-        valid_training = (~np.isnan(var2))
-        try:
-            reg.fit(pred2[valid_training], var2[valid_training])
-            predicted = reg.predict(pred2[np.isnan(var2)])
-            var2[np.isnan(var2)] = predicted
-            df_pred[col] = var2
-        except ValueError:
-            pass
+    # Date selection to train the model
+    valid_intersection = df.index.intersection(predictors.index)
+    pred2 = predictors.loc[valid_intersection].to_numpy(dtype=float)
+    var2 = df.loc[valid_intersection, columns].to_numpy(dtype=float,
+                                                         copy=True)
+    var2[~np.isfinite(var2)] = np.nan
+    # Columns without gaps or without training data and non-finite
+    # predictors cannot be filled, they are left as they are
+    missing = np.isnan(var2)
+    nmissing = missing.sum(axis=0)
+    fit = (nmissing > 0) & (nmissing < len(valid_intersection))
+    if pred2.shape[1] == 0:
+        fit[:] = False
+    if window is not None:
+        if min_samples is None:
+            min_samples = pred2.shape[1] + 2
+        _mlr_rolling(pred2, var2, missing, np.where(fit)[0],
+                     valid_intersection, pd.Timedelta(window),
+                     pd.Timedelta(step), min_samples)
+    else:
+        if not np.isfinite(pred2).all():
+            fit[:] = False
+        # Columns grouped by missing data pattern
+        groups = {}
+        for icol in np.where(fit)[0]:
+            groups.setdefault(missing[:, icol].tobytes(), []).append(icol)
+        for icols in groups.values():
+            gaps = missing[:, icols[0]]
+            coef, intercept = _mlr_fit(pred2[~gaps], var2[~gaps][:, icols])
+            var2[np.ix_(gaps, icols)] = pred2[gaps] @ coef + intercept
+    # Filled columns, dates out of the predictors are left empty
+    icols = np.where(fit)[0]
+    filled = pd.DataFrame(var2[:, icols], index=valid_intersection,
+                          columns=columns[icols]).reindex(df.index)
+    for icol in icols:
+        df_pred[columns[icol]] = filled[columns[icol]]
+    if len(columns) > 0:
         df_pred = df_pred.interpolate(method="time")
     return df_pred
 
 
+def _mlr_fit(x, y):
+    """
+    Least-squares multiple linear regression with intercept of the columns
+    of *y* on *x*, as sklearn.linear_model.LinearRegression.
+
+    Returns
+    -------
+    coef : array
+        Coefficients of shape (x.shape[1], y.shape[1]).
+    intercept : array
+        Intercepts of shape (y.shape[1],).
+    """
+    x_offset = x.mean(axis=0)
+    y_offset = y.mean(axis=0)
+    coef = np.linalg.lstsq(x - x_offset, y - y_offset, rcond=None)[0]
+    return coef, y_offset - x_offset @ coef
+
+
+def _mlr_rolling(x, y, missing, icols, times, window, step, min_samples):
+    """
+    Fills in place the gaps of the columns *icols* of *y* with moving-window
+    regressions with intercept on *x*, one per *step* of *times*, fitted on
+    the data within *window* of the step.
+
+    The normal equations of the windows are built from prefix sums of the
+    sufficient statistics (z z^T and z y, z = [1, x]) of every step, so that
+    each window costs O(p^2) whatever its length.
+    """
+    ok = np.isfinite(x).all(axis=1)
+    if not ok.any():
+        return
+    # Centred predictors for better conditioned normal equations
+    z = np.column_stack([np.ones(len(x)),
+                         np.where(ok[:, None], x - x[ok].mean(axis=0), 0.)])
+    q = z.shape[1]
+    zz = (z[:, :, None] * z[:, None, :]).reshape(len(z), q*q)
+    # Steps of the data and first data of every step
+    period = np.asarray((times - times[0]) // step, dtype=int)
+    first = np.flatnonzero(np.diff(period, prepend=-1))
+    nper = period[-1] + 1
+    half = int(window // step)
+    lo = np.clip(np.arange(nper) - half, 0, nper)
+    hi = np.clip(np.arange(nper) + half + 1, 0, nper)
+    for icol in icols:
+        train = ok & ~missing[:, icol]
+        gaps = ok & missing[:, icol]
+        # Prefix sums of the statistics of the steps
+        sums = np.zeros((nper+1, q*q + q + 1))
+        sums[period[first]+1] = np.add.reduceat(np.column_stack(
+            [zz, z * np.where(train, y[:, icol], 0.)[:, None],
+             np.ones(len(z))]) * train[:, None], first)
+        sums = np.cumsum(sums, axis=0)
+        stats = sums[hi] - sums[lo]
+        need = np.unique(period[gaps])
+        need = need[stats[need, -1] >= min_samples]
+        if need.size == 0:
+            continue
+        coef = np.full((nper, q), np.nan)
+        coef[need] = _solve_normal(stats[need, :q*q].reshape(-1, q, q),
+                                   stats[need, q*q:q*q+q])
+        rows = np.flatnonzero(gaps)
+        y[rows, icol] = np.einsum("ij,ij->i", z[rows], coef[period[rows]])
+
+
+def _solve_normal(a, b):
+    """
+    Solutions of a stack of normal equations a x = b, with the
+    pseudo-inverse if some are singular.
+    """
+    try:
+        return np.linalg.solve(a, b[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        return (np.linalg.pinv(a) @ b[..., None])[..., 0]
+
+
+def station_gap_fill(df, stations, cache=None, site="site", min_overlap=0.5):
+    """
+    Gapfills biometeorological data by MLR with the best of several nearby
+    stations for each variable, e.g. the ECCC stations of
+    `data_ingest.canadian_stations`.
+
+    Every station is scored for every variable by its largest absolute
+    correlation with the variable times the overlap, the fraction of the
+    valid data of the variable with complete data of the station. The
+    regression on the best station is stored in *cache* with a hash of the
+    data, and reused as long as the variable and the stations are unchanged.
+    Remaining gaps are interpolated in time.
+
+    Parameters
+    ----------
+    df : DataFrame
+        Original DataFrame with biometeorological data.
+    stations : dict
+        DataFrame of meteorological data of each station (numeric columns
+        are the predictors), keyed by station name or id.
+    cache : str, optional
+        JSON file of the selected models, created if missing. Default is
+        None, the models are fitted at every call.
+    site : str, optional
+        Name of the site in *cache*, which can be shared by sites. Default is
+        "site".
+    min_overlap : float, optional
+        Minimum overlap of a station to be selected. Default is 0.5.
+
+    Returns
+    -------
+    df_pred : DataFrame
+        Gapfilled DataFrame.
+    models : DataFrame
+        Selected station, score, overlap and whether the model was fitted
+        (False if read from *cache*) of each filled variable.
+    """
+    import hashlib
+    import json
+    columns = df.columns
+    df_pred = df.copy(deep=True)
+    y = df.to_numpy(dtype=float, copy=True)
+    y[~np.isfinite(y)] = np.nan
+    valid = ~np.isnan(y)
+    # Predictors of the stations on the index of df
+    xs, hashes = {}, {}
+    for name, data in stations.items():
+        x = data.select_dtypes("number").reindex(df.index)
+        x = x.loc[:, x.notna().any()]
+        xs[str(name)] = x
+        hashes[str(name)] = hashlib.sha256(
+            x.to_numpy(dtype=float).tobytes()
+            + "\x00".join(map(str, x.columns)).encode()).hexdigest()
+    # Times as int64 with their time zone, the object array of a tz-aware
+    # index would give memory addresses that change from run to run
+    if isinstance(df.index, pd.DatetimeIndex):
+        index_bytes = df.index.asi8.tobytes() + str(df.index.tz).encode()
+    elif df.index.dtype.kind in "biufmM":
+        index_bytes = df.index.to_numpy().tobytes()
+    else:
+        index_bytes = "\x00".join(map(str, df.index)).encode()
+    index_hash = hashlib.sha256(index_bytes).digest()
+    models = {}
+    if cache is not None and os.path.exists(cache):
+        with open(cache) as f:
+            models = json.load(f)
+    site_models = models.setdefault(site, {})
+    # Hash of the data of every variable with the stations
+    keys = {}
+    for icol, col in enumerate(columns):
+        if valid[:, icol].all() or not valid[:, icol].any():
+            continue
+        h = hashlib.sha256(index_hash + y[:, icol].tobytes())
+        for name in sorted(hashes):
+            h.update((name + hashes[name]).encode())
+        keys[col] = h.hexdigest()
+    refit = [col for col in keys if site_models.get(col, {}).get("hash")
+             != keys[col]]
+    if refit:
+        icols = columns.get_indexer(refit)
+        best = _station_scores(y[:, icols], valid[:, icols], xs, min_overlap)
+        for col, icol, (name, score, overlap) in zip(refit, icols, best):
+            if name is None:
+                site_models[col] = {"hash": keys[col], "station": None}
+                continue
+            x = xs[name].to_numpy(dtype=float)
+            train = valid[:, icol] & np.isfinite(x).all(axis=1)
+            coef, intercept = _mlr_fit(x[train], y[train, icol][:, None])
+            site_models[col] = {"hash": keys[col], "station": name,
+                                "columns": list(xs[name].columns),
+                                "coef": coef[:, 0].tolist(),
+                                "intercept": float(intercept[0]),
+                                "score": float(score),
+                                "overlap": float(overlap)}
+        if cache is not None:
+            tmp = cache + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(models, f, indent=1)
+            os.replace(tmp, cache)
+    # Filling with the selected models
+    report = []
+    for col in keys:
+        model = site_models[col]
+        if model["station"] is None:
+            continue
+        x = xs[model["station"]].reindex(columns=model["columns"]) \
+            .to_numpy(dtype=float)
+        icol = columns.get_loc(col)
+        gaps = ~valid[:, icol] & np.isfinite(x).all(axis=1)
+        values = y[:, icol]
+        values[gaps] = x[gaps] @ np.array(model["coef"]) + model["intercept"]
+        df_pred[col] = values
+        report.append((col, model["station"], model["score"],
+                       model["overlap"], col in refit))
+    if len(columns) > 0:
+        df_pred = df_pred.interpolate(method="time")
+    models = pd.DataFrame(report, columns=["variable", "station", "score",
+                                           "overlap", "fitted"])
+    return df_pred, models.set_index("variable")
+
+
+def _station_scores(y, valid, xs, min_overlap):
+    """
+    Best station of *xs* for each column of *y*, as a list of
+    (name, score, overlap), name None if no station has *min_overlap*.
+
+    The correlations of all columns of *y* with all predictors of a station
+    over their common data come from matrix products of the masked sums.
+    """
+    nvalid = valid.sum(axis=0)
+    yz = np.where(valid, y, 0.)
+    best = [(None, -np.inf, 0.)] * y.shape[1]
+    for name, data in xs.items():
+        x = data.to_numpy(dtype=float)
+        if x.shape[1] == 0:
+            continue
+        ok = np.isfinite(x).all(axis=1)
+        x = np.where(ok[:, None], x, 0.)
+        w = (valid & ok[:, None]).astype(float)
+        n = w.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sx = w.T @ x
+            sy = (w * yz).sum(axis=0)
+            cov = (w * yz).T @ x - sx * sy[:, None] / n[:, None]
+            varx = w.T @ x**2 - sx**2 / n[:, None]
+            vary = (w * yz**2).sum(axis=0) - sy**2 / n
+            corr = cov / np.sqrt(varx * vary[:, None])
+            overlap = n / nvalid
+        corr = np.nan_to_num(np.abs(corr), nan=0.).max(axis=1)
+        score = corr * overlap
+        for i in range(y.shape[1]):
+            if (overlap[i] >= min_overlap) and (n[i] > x.shape[1] + 1) \
+                    and (score[i] > best[i][1]):
+                best[i] = (name, score[i], overlap[i])
+    return best
+
+
 def gapfill(dfin, flag=None, date=None, timeformat='%Y-%m-%d %H:%M:%S',
             colhead=None,
             sw_dev=50., ta_dev=2.5, vpd_dev=5.,
             longgap=60, fullday=False, undef=-9999, ddof=1,
-            err=False, errmean=False, verbose=0):
+            err=False, errmean=False, fillerr=False,
+            engine='loop', backend='numpy',
+            n_jobs=1, chunks=1, verbose=0):
     """
     Fill gaps of flux data from Eddy covariance measurements
     or estimate flux uncertainties
@@ -95,12 +363,17 @@ def gapfill(dfin, flag=None, date=None, timeformat='%Y-%m-%d %H:%M:%S',
 
         *dfin* can also me a numpy array with the same columns. In this case
         *colhead*, *date*, and possibly *dateformat* must be given.
-    flag : pandas.Dataframe or numpy.array, optional
+    flag : pandas.Dataframe or numpy.array or qc_flags.QCFlags, optional
         Dataframe or array has the same shape as dfin.
         Non-zero values in *flag* will be treated as missing values in *dfin*.
         *flag* must follow the same rules as *dfin* if pandas.Dataframe.
         If *flag* is numpy array, *df.columns.values* will be used as column
         heads and the index of *dfin* will be copied to *flag*.
+
+        If *flag* is a QCFlags store, data rejected by any screening test
+        as well as *undef* and NaN values are treated as missing values,
+        and the large gaps and quality classes of the filling are written
+        back into the store (if not *err*). Flags are then uint16.
     date : array_like of string, optional
         1D-array_like of calendar dates in format given in *timeformat*.
         *date* must be given if *dfin* is numpy array.
@@ -137,11 +410,39 @@ def gapfill(dfin, flag=None, date=None, timeformat='%Y-%m-%d %H:%M:%S',
     errmean : bool, optional
         True: also return mean value of values for error estimates
         `if err == True` (default: False)
+    fillerr : bool, optional
+        True: fill gaps and estimate errors in the same pass, i.e. the search
+        for similar meteorological conditions of Method 1 is shared by the
+        gap filling and the error estimate of a data point (default: False).
+        *err* must be False.
     shape : bool or tuple, optional
         True: output have the same shape as input data if *dfin* is
         numpy array; if a tuple is given, then this tuple is used to reshape.
 
         False: outputs are 1D arrays if *dfin* is numpy array (default: False).
+    engine : str, optional
+        'loop': search similar conditions point by point (default).
+
+        'vectorized': search similar conditions for all gaps of a column at
+        once, evaluating the windows of each method in blocks. Gives
+        bit-identical results to 'loop' but is much faster on long records.
+    backend : str, optional
+        'numpy': run *engine* with numpy (default).
+
+        'numba': run the search of *engine* 'loop' as a compiled kernel
+        without temporary arrays. Quality flags are the same as with
+        'numpy', filled values and error estimates can differ in the last
+        digits because means are summed sequentially. Falls back to
+        'numpy' with *engine* 'vectorized' if numba is not installed.
+    n_jobs : int, optional
+        Number of processes filling columns in parallel; -1 uses all
+        processors (default: 1). Data and meteorological drivers are shared
+        with the processes via shared memory. Results are the same as
+        filling serially.
+    chunks : int, optional
+        Number of disjoint time chunks each column is split into for the
+        parallel filling (default: 1). The processes read the search windows
+        around their chunk directly from the shared data.
     verbose : int, optional
         Verbosity level 0-3 (default: 0). 0 is no output; 3 is very verbose.
 
@@ -154,6 +455,10 @@ def gapfill(dfin, flag=None, date=None, timeformat='%Y-%m-%d %H:%M:%S',
 
         `if err and errmean:` err_estimate, mean_estimate
 
+        `if fillerr:` filled_data, quality_class, err_estimate, err_count,
+        where err_count is the number of samples with similar meteorological
+        conditions used for the error estimate (0 if there is none)
+
         pandas.Dataframe(s) will be returned if *dfin* was Dataframe.
 
         numpy array(s) will be returned if *dfin* was numpy array.
@@ -256,6 +561,23 @@ def gapfill(dfin, flag=None, date=None, timeformat='%Y-%m-%d %H:%M:%S',
 
     """
     # Check input
+    if engine not in ['loop', 'vectorized']:
+        raise ValueError('engine must be loop or vectorized, given: '
+                         + str(engine))
+    if backend not in ['numpy', 'numba']:
+        raise ValueError('backend must be numpy or numba, given: '
+                         + str(backend))
+    if (backend == 'numba') and (_numba_kernel() is None):
+        warnings.warn('numba is not available, using backend numpy with'
+                      ' engine vectorized.')
+        backend = 'numpy'
+        engine  = 'vectorized'
+    if err and fillerr:
+        raise ValueError('err and fillerr cannot be both True.')
+    if (n_jobs == 0) or (n_jobs < -1) or (chunks < 1):
+        raise ValueError('n_jobs must be -1 or positive and chunks must be'
+                         ' positive, given: ' + str(n_jobs) + ', '
+                         + str(chunks))
     # numpy or panda
     if isinstance(dfin, (np.ndarray, np.ma.MaskedArray)):
         isnumpy = True
@@ -284,7 +606,18 @@ def gapfill(dfin, flag=None, date=None, timeformat='%Y-%m-%d %H:%M:%S',
         df = dfin.copy()
 
     # Incoming flags
-    if flag is not None:
+    from qc_flags import QCFlags
+    qc = flag if isinstance(flag, QCFlags) else None
+    if qc is not None:
+        fisnumpy = isnumpy
+        fistrans = istrans
+        # rejected data in the store, missing data elsewhere
+        ff = ((df == undef) | df.isna()).astype(np.uint16)
+        cols = [col for col in df.columns if col in qc.columns]
+        if cols:
+            rejected = qc.rejected(cols).loc[df.index].to_numpy()
+            ff[cols] = ff[cols].to_numpy() | rejected.astype(np.uint16)
+    elif flag is not None:
         if isinstance(flag, (np.ndarray, np.ma.MaskedArray)):
             fisnumpy = True
             fistrans = False
@@ -315,30 +648,7 @@ def gapfill(dfin, flag=None, date=None, timeformat='%Y-%m-%d %H:%M:%S',
         ff[df.isna()] = 1
 
     # Data and flags
-    sw_id = ''
-    for cc in df.columns:
-        if cc.startswith('SW_IN_') or (cc == 'SW_IN'):
-            sw_id = cc
-            break
-    ta_id = ''
-    for cc in df.columns:
-        if cc.startswith('TA_') or (cc == 'TA'):
-            ta_id = cc
-            break
-    vpd_id = ''
-    for cc in df.columns:
-        if cc.startswith('VPD_') or (cc == 'VPD'):
-            vpd_id = cc
-            break
-    astr = 'Global radiation with name SW or starting with SW_'
-    astr = astr + ' must be in input.'
-    assert sw_id,  astr
-    astr = 'Air temperature with name TA or starting with TA_'
-    astr = astr + ' must be in input.'
-    assert ta_id,  astr
-    astr = 'Vapour pressure deficit with name VPD or starting'
-    astr = astr + ' with VPD_ must be in input.'
-    assert vpd_id, astr
+    sw_id, ta_id, vpd_id, hcols = _mds_columns(df.columns)
 
     sw      = df[sw_id].to_numpy()
     sw_flg  = ff[sw_id].to_numpy()
@@ -355,48 +665,503 @@ def gapfill(dfin, flag=None, date=None, timeformat='%Y-%m-%d %H:%M:%S',
     else:
         ffill = ff.copy(deep=True)
         ffill[:] = 0
+    # efill is error estimate and cfill its number of samples if fillerr
+    if fillerr:
+        efill = df.copy(deep=True)
+        cfill = pd.DataFrame(0, index=df.index, columns=df.columns)
+    else:
+        efill = None
+        cfill = None
 
     # Times
     # number of data points per week; basic factor of the time window
     week    = pd.Timedelta('1 W') / (df.index[1] - df.index[0])
     nperday = week // 7
-    hour    = df.index.hour + df.index.minute / 60.
+    hour    = (df.index.hour + df.index.minute / 60.).to_numpy()
     day     = (df.index.to_julian_date() - 0.5).astype(int)
 
+    # flag for all meteorological conditions
+    meteo_flg = (ta_flg == 0) & (vpd_flg == 0) & (sw_flg == 0)
+
     # Filling variables
-    ndata = len(df)
-    for hcol in df.columns:
+    kwargs = dict(sw_dev=sw_dev, ta_dev=ta_dev, vpd_dev=vpd_dev,
+                  longgap=longgap, fullday=fullday, err=err, ddof=ddof,
+                  engine=engine, backend=backend, verbose=verbose)
+    if n_jobs == -1:
+        n_jobs = os.cpu_count()
+    if (n_jobs > 1) or (chunks > 1):
+        _mds_parallel(df, ff, dfill, ffill, efill, cfill, hcols,
+                      sw, ta, vpd, sw_flg, meteo_flg, hour, day,
+                      week, nperday, undef, n_jobs, chunks, kwargs)
+    else:
+        for hcol in hcols:
+            if verbose > 0:
+                if err:
+                    print('  Error estimate ', str(hcol))
+                else:
+                    print('  Filling ', str(hcol))
+
+            data  = df[hcol].to_numpy()
+            dflag = ff[hcol].to_numpy()
+
+            data_f  = dfill[hcol].to_numpy()
+            dflag_f = ffill[hcol].to_numpy()
+
+            if err:
+                data_f[:]  = undef
+                dflag_f[:] = undef
+
+            if fillerr:
+                err_f   = np.full(len(df), undef, dtype=float)
+                count_f = np.zeros(len(df), dtype=int)
+            else:
+                err_f   = None
+                count_f = None
+
+            _mds_column(data, dflag, data_f, dflag_f,
+                        sw, ta, vpd, sw_flg, meteo_flg, hour, day,
+                        week, nperday, err_f=err_f, count_f=count_f,
+                        **kwargs)
+
+            dfill[hcol] = data_f
+            ffill[hcol] = dflag_f
+            if fillerr:
+                efill[hcol] = err_f
+                cfill[hcol] = count_f
+
+    # Large gaps and quality classes back to the flags store
+    if (qc is not None) and (not err):
+        largegap = np.column_stack([
+            _largegap(ff[hcol].to_numpy(), day, nperday, longgap, fullday)
+            for hcol in hcols])
+        qc.set('largegap', largegap, index=df.index, columns=hcols)
+        qc.set_quality(ffill[hcols])
+
+    # Finish
+
+    if isnumpy:
+        if istrans:
+            dfout = dfill.to_numpy().T
+        else:
+            dfout = dfill.to_numpy()
+    else:
+        dfout = dfill
+
+    if fisnumpy:
+        if fistrans:
+            ffout = ffill.to_numpy().T
+        else:
+            ffout = ffill.to_numpy()
+    else:
+        ffout = ffill
+
+    if fillerr:
+        if isnumpy:
+            if istrans:
+                efout = efill.to_numpy().T
+                cfout = cfill.to_numpy().T
+            else:
+                efout = efill.to_numpy()
+                cfout = cfill.to_numpy()
+        else:
+            efout = efill
+            cfout = cfill
+
+    if err:
+        if errmean:
+            return ffout, dfout
+        else:
+            return ffout
+    elif fillerr:
+        return dfout, ffout, efout, cfout
+    else:
+        return dfout, ffout
+
+
+def gapfill_array(data, date, colhead, flag=None,
+                  timeformat='%Y-%m-%d %H:%M:%S',
+                  sw_dev=50., ta_dev=2.5, vpd_dev=5.,
+                  longgap=60, fullday=False, undef=-9999,
+                  engine='vectorized', backend='numpy',
+                  out=None, flag_out=None, verbose=0):
+    """
+    Fill gaps of flux data with MDS working directly on numpy arrays.
+
+    Same gap filling as `gapfill` without converting the input to
+    DataFrames and without copying it: the variables are rows of a
+    contiguous 2-D array that is read column by column, and the results can
+    be written into arrays given by the caller, or into *data* itself.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        2-D float array with one row per variable in *colhead*, i.e. with
+        shape (len(colhead), number of time steps). See *dfin* of `gapfill`
+        for the mandatory variables.
+    date : array_like
+        1D-array_like of dates, e.g. numpy.datetime64 or strings in format
+        *timeformat*.
+    colhead : array_like of str
+        Names of the rows of *data*.
+    flag : numpy.ndarray, optional
+        Array of the same shape as *data*, e.g. of type int8. Non-zero values
+        are treated as missing values. By default, *undef* and NaN values of
+        *data* are missing values.
+    timeformat, sw_dev, ta_dev, vpd_dev, longgap, fullday, undef, engine,
+    backend, verbose
+        See `gapfill` (*engine* defaults to 'vectorized').
+    out : numpy.ndarray, optional
+        Float array of the same shape as *data* for the filled data. It can
+        be *data* itself to fill the gaps in place.
+    flag_out : numpy.ndarray, optional
+        Integer array of the same shape as *data* for the quality class of
+        the filled data, e.g. of type int8. It cannot be *flag*.
+
+    Returns
+    -------
+    out, flag_out : numpy.ndarray
+        Filled data and quality class (0: not filled, 1-3: quality category
+        of the gap filling), of type int8 if *flag_out* is not given.
+
+    Examples
+    --------
+    >>> dat_f, flag_f = gapfill_array(dfin, adate, colhead, flag=flag,
+    ...                               undef=undef, out=dfin)
+
+    """
+    colhead = list(colhead)
+    if (data.ndim != 2) or (data.shape[0] != len(colhead)):
+        raise ValueError('data must have one row per column head.'
+                         ' len(colhead)=' + str(len(colhead)) +
+                         ' shape(data)=' + str(data.shape) + '.')
+    if flag is None:
+        flag = ((data == undef) | np.isnan(data)).astype(np.int8)
+    elif flag.shape != data.shape:
+        raise ValueError('flag must have same shape as data array.')
+    if flag_out is flag:
+        raise ValueError('flag_out cannot be flag.')
+    if out is None:
+        out = data.copy()
+    elif out is not data:
+        out[...] = data
+    if flag_out is None:
+        flag_out = np.zeros(data.shape, dtype=np.int8)
+    else:
+        flag_out[...] = 0
+    if (backend == 'numba') and (_numba_kernel() is None):
+        warnings.warn('numba is not available, using backend numpy with'
+                      ' engine vectorized.')
+        backend = 'numpy'
+        engine  = 'vectorized'
+
+    sw_id, ta_id, vpd_id, hcols = _mds_columns(colhead)
+    isw  = colhead.index(sw_id)
+    ita  = colhead.index(ta_id)
+    ivpd = colhead.index(vpd_id)
+    meteo_flg = (flag[isw] == 0) & (flag[ita] == 0) & (flag[ivpd] == 0)
+
+    # Times
+    index   = pd.DatetimeIndex(pd.to_datetime(date, format=timeformat))
+    week    = pd.Timedelta('1 W') / (index[1] - index[0])
+    nperday = week // 7
+    hour    = (index.hour + index.minute / 60.).to_numpy()
+    day     = (index.to_julian_date() - 0.5).astype(int).to_numpy()
+
+    for hcol in hcols:
+        if verbose > 0:
+            print('  Filling ', str(hcol))
+        i = colhead.index(hcol)
+        # filled values are never used as samples, so out can be data
+        _mds_column(data[i], flag[i], out[i], flag_out[i],
+                    data[isw], data[ita], data[ivpd], flag[isw], meteo_flg,
+                    hour, day, week, nperday, sw_dev, ta_dev, vpd_dev,
+                    longgap, fullday, False, 1, engine, backend, verbose)
+    return out, flag_out
+
+
+def gap_runs(flag, day=None):
+    """
+    Index of the runs of consecutive missing data, e.g. to get statistics
+    of the gaps in a time series.
+
+    Parameters
+    ----------
+    flag : array_like
+        Non-zero (or True) for missing data.
+    day : array_like of int, optional
+        Day of every data point, e.g. `(index.to_julian_date() - 0.5)`.
+
+    Returns
+    -------
+    runs : DataFrame
+        One row per gap with its first data point 'start' and its number of
+        data points 'length'. If *day* is given, also the days of the first
+        and last data points of the gap, 'first_day' and 'last_day'.
+
+    Examples
+    --------
+    >>> runs = gap_runs(np.isnan(df['FC']))
+    >>> runs['length'].describe()
+
+    """
+    missing = np.asarray(flag) != 0
+    edges   = np.diff(np.concatenate(([0], missing.astype(np.int8), [0])))
+    start   = np.where(edges == 1)[0]
+    stop    = np.where(edges == -1)[0]
+    runs    = pd.DataFrame({'start': start, 'length': stop - start})
+    if day is not None:
+        day = np.asarray(day)
+        runs['first_day'] = day[start]
+        runs['last_day']  = day[stop - 1]
+    return runs
+
+
+class MDSGapFiller:
+    """
+    Incremental gap filling of a growing time series with the MDS of
+    `gapfill`.
+
+    New records are added with `append`. Only data points whose MDS search
+    windows reach the new records, or whose large gap status changed, are
+    filled again; all other points keep their previous values, so that the
+    results are the same as running `gapfill` over the whole record. The
+    state can be written to disk with `save` and read back with `load`
+    between runs.
+
+    Parameters
+    ----------
+    sw_dev, ta_dev, vpd_dev, longgap, fullday, undef, engine, backend
+        See `gapfill` (*engine* defaults to 'vectorized').
+    freq : str or pandas.Timedelta, optional
+        Time step of the records, e.g. '30min'. Default is the step between
+        the first two records, which must then be appended first together.
+
+    Attributes
+    ----------
+    data, flag : pandas.DataFrame
+        All records appended so far and their flags.
+    filled, quality : pandas.DataFrame
+        Filled data and quality class of the filling as given by `gapfill`.
+
+    Examples
+    --------
+    >>> filler = MDSGapFiller()
+    >>> filled, quality = filler.append(df_year)
+    >>> filler.save('site_mds.pkl')
+    >>> filler = MDSGapFiller.load('site_mds.pkl')
+    >>> filled, quality = filler.append(df_new_records)
+    """
+
+    def __init__(self, sw_dev=50., ta_dev=2.5, vpd_dev=5.,
+                 longgap=60, fullday=False, undef=-9999,
+                 engine='vectorized', backend='numpy', freq=None):
+        self.sw_dev   = sw_dev
+        self.ta_dev   = ta_dev
+        self.vpd_dev  = vpd_dev
+        self.longgap  = longgap
+        self.fullday  = fullday
+        self.undef    = undef
+        self.engine   = engine
+        self.backend  = backend
+        self.freq     = None if freq is None else pd.Timedelta(freq)
+        self.data     = None
+        self.flag     = None
+        self.filled   = None
+        self.quality  = None
+
+    def append(self, df, flag=None):
+        """
+        Append records and fill the gaps affected by them.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            New records with the same columns as the previous ones (see
+            *dfin* of `gapfill`), all later than the last record.
+        flag : pandas.DataFrame, optional
+            Flags of the new records (see *flag* of `gapfill`). By default,
+            *undef* and NaN values are flagged.
+
+        Returns
+        -------
+        filled, quality : pandas.DataFrame
+            Filled data and quality class of all records.
+        """
+        if flag is None:
+            flag = ((df == self.undef) | df.isna()).astype(int)
+        if self.data is None:
+            if (self.freq is None) and (len(df) < 2):
+                raise ValueError('The first records must be at least 2 to'
+                                 ' infer the time step, or freq must be'
+                                 ' given.')
+            nold = 0
+            self.data    = df.copy(deep=True)
+            self.flag    = flag.copy(deep=True)
+            self.filled  = df.copy(deep=True)
+            self.quality = flag.copy(deep=True)
+            self.quality[:] = 0
+        else:
+            if list(df.columns) != list(self.data.columns):
+                raise ValueError('Appended records must have the columns: '
+                                 + str(list(self.data.columns)))
+            if df.index[0] <= self.data.index[-1]:
+                raise ValueError('Appended records must start after '
+                                 + str(self.data.index[-1]))
+            nold    = len(self.data)
+            quality = flag.copy(deep=True)
+            quality[:] = 0
+            self.data    = pd.concat([self.data, df])
+            self.flag    = pd.concat([self.flag, flag])
+            self.filled  = pd.concat([self.filled, df])
+            self.quality = pd.concat([self.quality, quality])
+        self._refill(nold)
+        return self.filled, self.quality
+
+    def _refill(self, nold):
+        """Fill again all points that can change after the record *nold*."""
+        df = self.data
+        ff = self.flag
+        sw_id, ta_id, vpd_id, hcols = _mds_columns(df.columns)
+        sw      = df[sw_id].to_numpy()
+        sw_flg  = ff[sw_id].to_numpy()
+        ta      = df[ta_id].to_numpy()
+        vpd     = df[vpd_id].to_numpy()
+        meteo_flg = ((ff[ta_id].to_numpy() == 0) &
+                     (ff[vpd_id].to_numpy() == 0) & (sw_flg == 0))
+
+        if self.freq is None:
+            self.freq = df.index[1] - df.index[0]
+        week    = pd.Timedelta('1 W') / self.freq
+        nperday = week // 7
+        hour    = (df.index.hour + df.index.minute / 60.).to_numpy()
+        day     = (df.index.to_julian_date() - 0.5).astype(int).to_numpy()
+        # farthest data point used to fill a gap
+        hw_week, hw_hour = _mds_windows(week, nperday)
+        reach = max(hw_week[-1], hw_hour[-1])
+
+        for hcol in hcols:
+            data  = df[hcol].to_numpy()
+            dflag = ff[hcol].to_numpy()
+            start = max(nold - reach, 0)
+            if nold > 0:
+                # large gaps and margins can move with new records
+                old = _largegap(dflag[:nold], day[:nold], nperday,
+                                self.longgap, self.fullday)
+                new = _largegap(dflag, day, nperday,
+                                self.longgap, self.fullday)
+                changed = np.where(old != new[:nold])[0]
+                if changed.size > 0:
+                    start = min(start, changed[0])
+            data_f  = self.filled[hcol].to_numpy(copy=True)
+            dflag_f = self.quality[hcol].to_numpy(copy=True)
+            data_f[start:]  = data[start:]
+            dflag_f[start:] = 0
+            _mds_column(data, dflag, data_f, dflag_f,
+                        sw, ta, vpd, sw_flg, meteo_flg, hour, day,
+                        week, nperday, self.sw_dev, self.ta_dev,
+                        self.vpd_dev, self.longgap, self.fullday,
+                        False, 1, self.engine, self.backend, 0,
+                        start=start)
+            self.filled[hcol]  = data_f
+            self.quality[hcol] = dflag_f
+
+    def save(self, path):
+        """
+        Write the state of the gap filler to *path* (pickle file).
+        """
+        pd.to_pickle(self.__dict__, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read a gap filler written with `save` from *path*.
+        """
+        filler = cls()
+        filler.__dict__.update(pd.read_pickle(path))
+        return filler
+
+
+def _mds_columns(columns):
+    """
+    Columns of global radiation, air temperature and vapour pressure
+    deficit, and the columns to fill, in the input of `gapfill`.
+
+    Returns
+    -------
+    sw_id, ta_id, vpd_id : str
+        Names of the meteorological columns.
+    hcols : list of str
+        Names of the other columns.
+    """
+    sw_id = ''
+    for cc in columns:
+        if cc.startswith('SW_IN_') or (cc == 'SW_IN'):
+            sw_id = cc
+            break
+    ta_id = ''
+    for cc in columns:
+        if cc.startswith('TA_') or (cc == 'TA'):
+            ta_id = cc
+            break
+    vpd_id = ''
+    for cc in columns:
+        if cc.startswith('VPD_') or (cc == 'VPD'):
+            vpd_id = cc
+            break
+    astr = 'Global radiation with name SW or starting with SW_'
+    astr = astr + ' must be in input.'
+    assert sw_id,  astr
+    astr = 'Air temperature with name TA or starting with TA_'
+    astr = astr + ' must be in input.'
+    assert ta_id,  astr
+    astr = 'Vapour pressure deficit with name VPD or starting'
+    astr = astr + ' with VPD_ must be in input.'
+    assert vpd_id, astr
 
+    hcols = []
+    for hcol in columns:
         if hcol.startswith('SW_IN_') or (hcol == 'SW_IN'):
             continue
         if hcol.startswith('TA_') or (hcol == 'TA'):
             continue
         if hcol.startswith('VPD_') or (hcol == 'VPD'):
             continue
+        hcols.append(hcol)
+    return sw_id, ta_id, vpd_id, hcols
 
-        if verbose > 0:
-            if err:
-                print('  Error estimate ', str(hcol))
-            else:
-                print('  Filling ', str(hcol))
-
-        data  = df[hcol].to_numpy()
-        dflag = ff[hcol].to_numpy()
-
-        data_f  = dfill[hcol].to_numpy()
-        dflag_f = ffill[hcol].to_numpy()
 
-        if err:
-            data_f[:]  = undef
-            dflag_f[:] = undef
+def _largegap(dflag, day, nperday, longgap, fullday, verbose=0):
+    """
+    Data points of large margins and large gaps that are not filled.
 
-        # Large margins
+    Parameters
+    ----------
+    dflag : array
+        Non-zero for missing data.
+    day : array of int
+        Day of every data point.
+    nperday : float
+        Number of data points per day.
+    longgap, fullday, verbose
+        See `gapfill`.
 
-        # Check for large margins at beginning
-        largegap   = np.zeros(ndata, dtype=bool)
-        firstvalid = np.amin(np.where(dflag == 0)[0])
-        lastvalid  = np.amax(np.where(dflag == 0)[0])
-        nn         = int(nperday * longgap)
+    Returns
+    -------
+    largegap : array of bool
+        True in large margins and gaps longer than *longgap* days.
+    """
+    ndata = len(dflag)
+
+    # Large margins
+
+    # Check for large margins at beginning
+    largegap   = np.zeros(ndata, dtype=bool)
+    valid      = np.where(dflag == 0)[0]
+    nn         = int(nperday * longgap)
+    # without valid data, only the large gaps below apply
+    if valid.size > 0:
+        firstvalid = valid[0]
+        lastvalid  = valid[-1]
         if firstvalid > nn:
             if verbose > 1:
                 print('    Large margin at beginning: ', firstvalid)
@@ -406,94 +1171,271 @@ def gapfill(dfin, flag=None, date=None, timeformat='%Y-%m-%d %H:%M:%S',
                 print('    Large margin at end: ', lastvalid-nn)
             largegap[(lastvalid+nn):] = True
 
-        # Large gaps
-
-        # search largegap - code from maskgroup.py
-        index  = []
-        length = []
-        count  = 0
-        for i in range(ndata):
-            if i == 0:
-                if dflag[i] != 0:
-                    index += [i]
-                    count  = 1
-            if i > 0:
-                if (dflag[i] != 0) and (dflag[i-1] == 0):
-                    index += [i]
-                    count  = 1
-                elif dflag[i] != 0:
-                    count += 1
-                elif (dflag[i] == 0) and (dflag[i-1] != 0):
-                    length += [count]
-                    count = 0
-                else:
-                    pass
-        if count > 0:
-            length += [count]
-
-        # set largegap
-        for i in range(len(index)):
-            if length[i] > nn:
-                if verbose > 1:
-                    print('    Large gap: ', index[i], ':', index[i]+length[i])
-                largegap[index[i]:index[i]+length[i]] = True
-
-        # set or unset rest of days in large gaps
-        if fullday:
-            for i in range(ndata-1):
-                # end of large margin
-                if largegap[i] and not largegap[i+1]:
-                    largegap[np.where(day == day[i])[0]] = False
-                # beginning of large margin
-                elif not largegap[i] and largegap[i+1]:
-                    largegap[np.where(day == day[i])[0]] = False
-                else:
-                    continue
+    # Large gaps
+    runs = gap_runs(dflag)
+    for start, length in runs[runs['length'] > nn].to_numpy():
+        if verbose > 1:
+            print('    Large gap: ', start, ':', start+length)
+        largegap[start:start+length] = True
+
+    # set or unset rest of days in large gaps
+    if fullday:
+        runs = gap_runs(largegap).to_numpy()
+        stop = runs[:, 0] + runs[:, 1]
+        # last point before beginning and last point at end of large gaps
+        edges = np.append(runs[runs[:, 0] > 0, 0] - 1,
+                          stop[stop < ndata] - 1)
+        largegap[np.isin(day, day[edges])] = False
+    return largegap
+
+
+def _mds_column(data, dflag, data_f, dflag_f,
+                sw, ta, vpd, sw_flg, meteo_flg, hour, day, week, nperday,
+                sw_dev, ta_dev, vpd_dev, longgap, fullday,
+                err, ddof, engine, backend, verbose, start=0, stop=None,
+                err_f=None, count_f=None):
+    """
+    Gap filling or error estimate of one column of `gapfill`.
 
-        # Gap filling
+    Large gaps are searched in the whole column, but only the data points
+    *start* to *stop* are filled in *data_f* and *dflag_f* (in place), as
+    well as the error estimates in *err_f* and *count_f* if given.
+    """
+    ndata = len(data)
+
+    largegap = _largegap(dflag, day, nperday, longgap, fullday, verbose)
+
+    # Gap filling
+
+    # flag for all meteorological conditions and data
+    total_flg = meteo_flg & (dflag == 0)
+
+    if backend == 'numba':
+        if stop is None:
+            stop = ndata
+        _numba_kernel()(data, dflag, data_f, dflag_f, largegap,
+                        sw, ta, vpd, sw_flg, meteo_flg, total_flg, hour,
+                        *_mds_stages(week, nperday, err),
+                        sw_dev, ta_dev, vpd_dev, err, ddof, start, stop,
+                        err_f is not None,
+                        data_f if err_f is None else err_f,
+                        dflag_f if count_f is None else count_f)
+    elif engine == 'loop':
+        _mds_loop(data, dflag, data_f, dflag_f, largegap,
+                  sw, ta, vpd, sw_flg, meteo_flg, total_flg, hour,
+                  week, nperday, sw_dev, ta_dev, vpd_dev,
+                  err, ddof, verbose, start, stop, err_f, count_f)
+    else:
+        _mds_vectorized(data, dflag, data_f, dflag_f, largegap,
+                        sw, ta, vpd, sw_flg, meteo_flg, total_flg, hour,
+                        week, nperday, sw_dev, ta_dev, vpd_dev,
+                        err, ddof, verbose, start, stop, err_f, count_f)
 
-        # flag for all meteorological conditions
-        meteo_flg = (ta_flg == 0) & (vpd_flg == 0) & (sw_flg == 0)
-        # flag for all meteorological conditions and data
-        total_flg = meteo_flg & (dflag == 0)
 
-        # Fill loop over all data points
-        for j in range(ndata):
-            if not err:
-                # no reason to go further, no gap -> continue
-                if (dflag[j] == 0) | largegap[j]:
-                    continue
-            # 3 Methods
-            #   1. ta, vpd and global radiation sw;
-            #   2. just global radiation sw;
-            #   3. no meteorolgical conditions: take the mean of +- hour
-
-            # for better overview: dynamic calculation of radiation threshold
-            # minimum 20; maximum 50 [Wm-2] according to private correspondence
-            # with Markus Reichstein
-            sw_devmax = np.maximum(20., np.minimum(sw[j], sw_dev))
-
-            # Method 1: all met conditions
-            if meteo_flg[j]:
-                # search for values around the met-conditions
-                # in a window of time
-                # (one week in the first iteration and odd weeks in the next)
-                j1  = j - np.arange(1, week+1, dtype=int) + 1
-                j2  = j + np.arange(1, week, dtype=int)
+def _share_arrays(arrays):
+    """
+    Copy a dict of arrays into shared memory.
+
+    Returns the specifications (name, shape, dtype) to attach to the arrays
+    with `_attach_arrays` and the shared memory blocks, which must be closed
+    and unlinked by the caller.
+    """
+    from multiprocessing import shared_memory
+    specs  = {}
+    blocks = []
+    for key, arr in arrays.items():
+        arr = np.ascontiguousarray(arr)
+        shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+        blocks.append(shm)
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        specs[key] = (shm.name, arr.shape, arr.dtype.str)
+    return specs, blocks
+
+
+def _attach_arrays(specs):
+    """Attach to the shared arrays created by `_share_arrays`."""
+    from multiprocessing import shared_memory
+    arrays = {}
+    blocks = []
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        blocks.append(shm)
+        arrays[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return arrays, blocks
+
+
+def _mds_worker(specs, icol, start, stop, kwargs):
+    """Fill data points *start* to *stop* of shared column *icol*."""
+    arrays, blocks = _attach_arrays(specs)
+    try:
+        if 'err_f' in arrays:
+            err_f   = arrays['err_f'][icol]
+            count_f = arrays['count_f'][icol]
+        else:
+            err_f   = None
+            count_f = None
+        _mds_column(arrays['data'][icol], arrays['dflag'][icol],
+                    arrays['data_f'][icol], arrays['dflag_f'][icol],
+                    arrays['sw'], arrays['ta'], arrays['vpd'],
+                    arrays['sw_flg'], arrays['meteo_flg'],
+                    arrays['hour'], arrays['day'],
+                    start=start, stop=stop, err_f=err_f, count_f=count_f,
+                    **kwargs)
+    finally:
+        del arrays
+        for shm in blocks:
+            shm.close()
+
+
+def _mds_parallel(df, ff, dfill, ffill, efill, cfill, hcols,
+                  sw, ta, vpd, sw_flg, meteo_flg, hour, day,
+                  week, nperday, undef, n_jobs, chunks, kwargs):
+    """
+    Fill columns *hcols* of *dfill* and *ffill* (and *efill* and *cfill* if
+    not None) with a pool of *n_jobs* processes, splitting every column into
+    *chunks* disjoint time chunks.
+
+    Every task writes only its own chunk of the shared output arrays so the
+    results do not depend on the order in which the tasks finish.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    data_f  = dfill[hcols].to_numpy().T
+    dflag_f = ffill[hcols].to_numpy().T
+    if kwargs['err']:
+        data_f  = np.full(data_f.shape, undef, dtype=data_f.dtype)
+        dflag_f = np.full(dflag_f.shape, undef, dtype=dflag_f.dtype)
+    arrays = {
+        'data': df[hcols].to_numpy().T, 'dflag': ff[hcols].to_numpy().T,
+        'data_f': data_f, 'dflag_f': dflag_f,
+        'sw': sw, 'ta': ta, 'vpd': vpd, 'sw_flg': sw_flg,
+        'meteo_flg': meteo_flg, 'hour': hour, 'day': np.asarray(day)}
+    outputs = ['data_f', 'dflag_f']
+    if efill is not None:
+        arrays['err_f']   = np.full(data_f.shape, undef, dtype=float)
+        arrays['count_f'] = np.zeros(data_f.shape, dtype=int)
+        outputs += ['err_f', 'count_f']
+    specs, blocks = _share_arrays(arrays)
+    del arrays
+    kwargs = dict(kwargs, week=week, nperday=nperday)
+    try:
+        bounds = np.linspace(0, len(df), chunks+1).astype(int)
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            tasks = []
+            for icol, hcol in enumerate(hcols):
+                if kwargs['verbose'] > 0:
+                    if kwargs['err']:
+                        print('  Error estimate ', str(hcol))
+                    else:
+                        print('  Filling ', str(hcol))
+                for start, stop in zip(bounds[:-1], bounds[1:]):
+                    tasks.append(pool.submit(_mds_worker, specs, icol,
+                                             start, stop, kwargs))
+            for task in tasks:
+                task.result()
+        arrays, views = _attach_arrays({ key: specs[key] for key in outputs })
+        for icol, hcol in enumerate(hcols):
+            dfill[hcol] = arrays['data_f'][icol].copy()
+            ffill[hcol] = arrays['dflag_f'][icol].copy()
+            if efill is not None:
+                efill[hcol] = arrays['err_f'][icol].copy()
+                cfill[hcol] = arrays['count_f'][icol].copy()
+        del arrays
+        for shm in views:
+            shm.close()
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
+def _mds_loop(data, dflag, data_f, dflag_f, largegap,
+              sw, ta, vpd, sw_flg, meteo_flg, total_flg, hour,
+              week, nperday, sw_dev, ta_dev, vpd_dev,
+              err, ddof, verbose, start=0, stop=None,
+              err_f=None, count_f=None):
+    """
+    Reference MDS loop of `gapfill` over the data points *start* to *stop*
+    of one column.
+
+    *data_f* and *dflag_f* are filled in place. If *err_f* and *count_f* are
+    given, the error estimate and the number of samples of Method 1 are
+    stored in them for every data point while filling the gaps.
+    """
+    ndata = len(data)
+    if stop is None:
+        stop = ndata
+    fillerr = err_f is not None
+
+    # Fill loop over all data points
+    for j in range(start, stop):
+        isgap = (dflag[j] != 0) & ~largegap[j]
+        if not err:
+            # no reason to go further, no gap -> continue
+            if not (isgap or fillerr):
+                continue
+        # 3 Methods
+        #   1. ta, vpd and global radiation sw;
+        #   2. just global radiation sw;
+        #   3. no meteorolgical conditions: take the mean of +- hour
+
+        # for better overview: dynamic calculation of radiation threshold
+        # minimum 20; maximum 50 [Wm-2] according to private correspondence
+        # with Markus Reichstein
+        sw_devmax = np.maximum(20., np.minimum(sw[j], sw_dev))
+
+        # Method 1: all met conditions
+        if meteo_flg[j]:
+            # search for values around the met-conditions
+            # in a window of time
+            # (one week in the first iteration and odd weeks in the next)
+            j1  = j - np.arange(1, week+1, dtype=int) + 1
+            j2  = j + np.arange(1, week, dtype=int)
+            jj  = np.append(j1, j2)
+            win = np.unique(np.sort(np.clip(jj, 0, ndata-1)))
+            # get boolean array where meteo-conditions are in a given width
+            conditions = ( (np.abs(sw[win]-sw[j])   < sw_devmax) &
+                           (np.abs(ta[win]-ta[j])   < ta_dev) &
+                           (np.abs(vpd[win]-vpd[j]) < vpd_dev) &
+                           total_flg[win] )
+            num4avg = np.sum(conditions)
+            # we need at least two samples with similar conditions
+            if num4avg >= 2:
+                dat = np.ma.array(data[win], mask=~conditions)
+                if verbose > 2:
+                    print('    m1.1: ', j, win.size, dat.mean(),
+                          dat.std(ddof=ddof))
+                if fillerr:
+                    err_f[j]   = dat.std(ddof=ddof)
+                    count_f[j] = num4avg
+                    if not isgap:
+                        continue
+                data_f[j] = dat.mean()
+                if err:
+                    dflag_f[j] = dat.std(ddof=ddof)
+                else:
+                    # assign also quality category of gap filling
+                    dflag_f[j] = 1
+                continue
+            else:  # --> extend time window to two weeks
+                j1  = j - np.arange(1, 2*week+1, dtype=int) + 1
+                j2  = j + np.arange(1, 2*week, dtype=int)
                 jj  = np.append(j1, j2)
                 win = np.unique(np.sort(np.clip(jj, 0, ndata-1)))
-                # get boolean array where meteo-conditions are in a given width
-                conditions = ( (np.abs(sw[win]-sw[j])   < sw_devmax) &
-                               (np.abs(ta[win]-ta[j])   < ta_dev) &
-                               (np.abs(vpd[win]-vpd[j]) < vpd_dev) &
+                conditions = ( (np.abs(sw[win]  - sw[j])  < sw_devmax) &
+                               (np.abs(ta[win]  - ta[j])  < ta_dev) &
+                               (np.abs(vpd[win] - vpd[j]) < vpd_dev) &
                                total_flg[win] )
                 num4avg = np.sum(conditions)
-                # we need at least two samples with similar conditions
                 if num4avg >= 2:
                     dat = np.ma.array(data[win], mask=~conditions)
                     if verbose > 2:
-                        print('    m1.1: ', j, win.size, dat.mean(),
+                        print('    m1.2: ', j, win.size, dat.mean(),
                               dat.std(ddof=ddof))
+                    if fillerr:
+                        err_f[j]   = dat.std(ddof=ddof)
+                        count_f[j] = num4avg
+                        if not isgap:
+                            continue
                     data_f[j] = dat.mean()
                     if err:
                         dflag_f[j] = dat.std(ddof=ddof)
@@ -501,195 +1443,583 @@ def gapfill(dfin, flag=None, date=None, timeformat='%Y-%m-%d %H:%M:%S',
                         # assign also quality category of gap filling
                         dflag_f[j] = 1
                     continue
-                else:  # --> extend time window to two weeks
-                    j1  = j - np.arange(1, 2*week+1, dtype=int) + 1
-                    j2  = j + np.arange(1, 2*week, dtype=int)
-                    jj  = np.append(j1, j2)
-                    win = np.unique(np.sort(np.clip(jj, 0, ndata-1)))
-                    conditions = ( (np.abs(sw[win]  - sw[j])  < sw_devmax) &
-                                   (np.abs(ta[win]  - ta[j])  < ta_dev) &
-                                   (np.abs(vpd[win] - vpd[j]) < vpd_dev) &
-                                   total_flg[win] )
-                    num4avg = np.sum(conditions)
-                    if num4avg >= 2:
-                        dat = np.ma.array(data[win], mask=~conditions)
-                        if verbose > 2:
-                            print('    m1.2: ', j, win.size, dat.mean(),
-                                  dat.std(ddof=ddof))
-                        data_f[j] = dat.mean()
-                        if err:
-                            dflag_f[j] = dat.std(ddof=ddof)
-                        else:
-                            # assign also quality category of gap filling
-                            dflag_f[j] = 1
-                        continue
 
-            if err:
+        if err or not isgap:
+            continue
+        # if you come here, gap-filling rather than error estimate
+
+        # If nothing is found under similar meteo within two weeks,
+        # look for global radiation within one week ->
+
+        # Method 2: just global radiation available
+        if sw_flg[j] == 0:
+            j1  = j - np.arange(1, week+1, dtype=int) + 1
+            j2  = j + np.arange(1, week, dtype=int)
+            jj  = np.append(j1, j2)
+            win = np.unique(np.sort(np.clip(jj, 0, ndata-1)))
+            # get boolean array where meteo-conditions are in a given width
+            conditions = ( (np.abs(sw[win]-sw[j]) < sw_devmax) &
+                           total_flg[win] )
+            num4avg = np.sum(conditions)
+            # we need at least two samples with similar conditions
+            if num4avg >= 2:
+                dat = np.ma.array(data[win], mask=~conditions)
+                if verbose > 2:
+                    print('    m2: ', j, win.size, dat.mean(),
+                          dat.std(ddof=ddof))
+                data_f[j]  = dat.mean()
+                dflag_f[j] = 1
                 continue
-            # if you come here, gap-filling rather than error estimate
 
-            # If nothing is found under similar meteo within two weeks,
-            # look for global radiation within one week ->
+        # If still nothing is found under similar sw within one week,
+        # take the same hour within 1-7 days
+
+        # Method 3: same hour
+        enough = False
+        for i in range(2):
+            t_win = (nperday * (2*i+1))//2
+            j1  = j - np.arange(1, t_win+1, dtype=int) + 1
+            j2  = j + np.arange(1, t_win, dtype=int)
+            jj  = np.append(j1, j2)
+            win = np.unique(np.sort(np.clip(jj, 0, ndata-1)))
+            conditions = ( (np.abs(hour[win]-hour[j]) < 1.1)
+                           & (dflag[win] == 0) )
+            num4avg = np.sum(conditions)
+            if num4avg >= 2:
+                dat = np.ma.array(data[win], mask=~conditions)
+                if verbose > 2:
+                    print('    m3.{:d}: '.format(i), j, win.size,
+                          dat.mean(), dat.std(ddof=ddof))
+                data_f[j] = dat.mean()
+                if i == 0:
+                    dflag_f[j] = 1
+                else:
+                    dflag_f[j] = 2
+                break
+
+        # sanity check
+        if dflag_f[j] > 0:
+            continue
 
-            # Method 2: just global radiation available
-            if sw_flg[j] == 0:
-                j1  = j - np.arange(1, week+1, dtype=int) + 1
-                j2  = j + np.arange(1, week, dtype=int)
+        # If still nothing is found, start a new cycle
+        # with increased window size
+        # Method 4: same as 1 but for 3-12 weeks
+        if meteo_flg[j]:
+            for multi in range(3, 12):
+                j1  = j - np.arange(1, multi*week+1, dtype=int) + 1
+                j2  = j + np.arange(1, multi*week, dtype=int)
                 jj  = np.append(j1, j2)
                 win = np.unique(np.sort(np.clip(jj, 0, ndata-1)))
-                # get boolean array where meteo-conditions are in a given width
-                conditions = ( (np.abs(sw[win]-sw[j]) < sw_devmax) &
+                conditions = ( (np.abs(sw[win]  - sw[j])  < sw_devmax) &
+                               (np.abs(ta[win]  - ta[j])  < ta_dev) &
+                               (np.abs(vpd[win] - vpd[j]) < vpd_dev) &
                                total_flg[win] )
                 num4avg = np.sum(conditions)
                 # we need at least two samples with similar conditions
                 if num4avg >= 2:
                     dat = np.ma.array(data[win], mask=~conditions)
                     if verbose > 2:
-                        print('    m2: ', j, win.size, dat.mean(),
-                              dat.std(ddof=ddof))
-                    data_f[j]  = dat.mean()
-                    dflag_f[j] = 1
-                    continue
+                        print('    m4.{:d}: '.format(multi), j, win.size,
+                              dat.mean(), dat.std(ddof=ddof))
+                    data_f[j] = dat.mean()
+                    # assign also quality category of gap filling
+                    if multi <= 2:
+                        dflag_f[j] = 1
+                    elif multi > 4:
+                        dflag_f[j] = 3
+                    else:
+                        dflag_f[j] = 2
+                    break
 
-            # If still nothing is found under similar sw within one week,
-            # take the same hour within 1-7 days
+            # Check because continue does not support
+            # to jump out of two loops
+            if dflag_f[j] > 0:
+                continue
 
-            # Method 3: same hour
-            enough = False
-            for i in range(2):
-                t_win = (nperday * (2*i+1))//2
-                j1  = j - np.arange(1, t_win+1, dtype=int) + 1
-                j2  = j + np.arange(1, t_win, dtype=int)
+        # Method 5: same as 2 but for 2-12 weeks
+        if sw_flg[j] == 0:
+            for multi in range(2, 12):
+                j1  = j - np.arange(1, multi*week+1, dtype=int) + 1
+                j2  = j + np.arange(1, multi*week, dtype=int)
                 jj  = np.append(j1, j2)
                 win = np.unique(np.sort(np.clip(jj, 0, ndata-1)))
-                conditions = ( (np.abs(hour[win]-hour[j]) < 1.1)
-                               & (dflag[win] == 0) )
+                # get boolean array where meteo-conditions are
+                # in a given width
+                conditions = ( (np.abs(sw[win] - sw[j]) < sw_devmax) &
+                               total_flg[win] )
                 num4avg = np.sum(conditions)
+                # we need at least two samples with similar conditions
                 if num4avg >= 2:
                     dat = np.ma.array(data[win], mask=~conditions)
                     if verbose > 2:
-                        print('    m3.{:d}: '.format(i), j, win.size,
+                        print('    m5.{:d}: '.format(multi), j, win.size,
                               dat.mean(), dat.std(ddof=ddof))
                     data_f[j] = dat.mean()
-                    if i == 0:
+                    if multi == 0:
                         dflag_f[j] = 1
-                    else:
+                    elif multi <= 2:
                         dflag_f[j] = 2
+                    else:
+                        dflag_f[j] = 3
                     break
 
-            # sanity check
             if dflag_f[j] > 0:
                 continue
 
-            # If still nothing is found, start a new cycle
-            # with increased window size
-            # Method 4: same as 1 but for 3-12 weeks
-            if meteo_flg[j]:
-                for multi in range(3, 12):
-                    j1  = j - np.arange(1, multi*week+1, dtype=int) + 1
-                    j2  = j + np.arange(1, multi*week, dtype=int)
-                    jj  = np.append(j1, j2)
-                    win = np.unique(np.sort(np.clip(jj, 0, ndata-1)))
-                    conditions = ( (np.abs(sw[win]  - sw[j])  < sw_devmax) &
-                                   (np.abs(ta[win]  - ta[j])  < ta_dev) &
-                                   (np.abs(vpd[win] - vpd[j]) < vpd_dev) &
-                                   total_flg[win] )
-                    num4avg = np.sum(conditions)
-                    # we need at least two samples with similar conditions
-                    if num4avg >= 2:
-                        dat = np.ma.array(data[win], mask=~conditions)
-                        if verbose > 2:
-                            print('    m4.{:d}: '.format(multi), j, win.size,
-                                  dat.mean(), dat.std(ddof=ddof))
-                        data_f[j] = dat.mean()
-                        # assign also quality category of gap filling
-                        if multi <= 2:
-                            dflag_f[j] = 1
-                        elif multi > 4:
-                            dflag_f[j] = 3
-                        else:
-                            dflag_f[j] = 2
-                        break
-
-                # Check because continue does not support
-                # to jump out of two loops
-                if dflag_f[j] > 0:
-                    continue
+        # Method 6: same as 3 but for 3-120 days
+        for i in range(3, 120):
+            t_win = nperday * (2*i+1)/2
+            j1  = j - np.arange(1, t_win+1, dtype=int) + 1
+            j2  = j + np.arange(1, t_win, dtype=int)
+            jj  = np.append(j1, j2)
+            win = np.unique(np.sort(np.clip(jj, 0, ndata-1)))
+            conditions = ( (np.abs(hour[win]-hour[j]) < 1.1)
+                           & (dflag[win] == 0) )
+            num4avg = np.sum(conditions)
+            if num4avg >= 2:
+                dat = np.ma.array(data[win], mask=~conditions)
+                if verbose > 2:
+                    print('    m6.{:d}: '.format(i), j, win.size,
+                          dat.mean(), dat.std(ddof=ddof))
+                data_f[j]  = dat.mean()
+                dflag_f[j] = 3
+                break
+
+
+def _halfwidth(w):
+    """
+    Half-width of the window j-w+1 ... j+w-1 searched by `_mds_loop` for a
+    window size *w* (which may be a float).
+    """
+    return np.arange(1, w, dtype=int).size
 
-            # Method 5: same as 2 but for 2-12 weeks
-            if sw_flg[j] == 0:
-                for multi in range(2, 12):
-                    j1  = j - np.arange(1, multi*week+1, dtype=int) + 1
-                    j2  = j + np.arange(1, multi*week, dtype=int)
-                    jj  = np.append(j1, j2)
-                    win = np.unique(np.sort(np.clip(jj, 0, ndata-1)))
-                    # get boolean array where meteo-conditions are
-                    # in a given width
-                    conditions = ( (np.abs(sw[win] - sw[j]) < sw_devmax) &
-                                   total_flg[win] )
-                    num4avg = np.sum(conditions)
-                    # we need at least two samples with similar conditions
-                    if num4avg >= 2:
-                        dat = np.ma.array(data[win], mask=~conditions)
-                        if verbose > 2:
-                            print('    m5.{:d}: '.format(multi), j, win.size,
-                                  dat.mean(), dat.std(ddof=ddof))
-                        data_f[j] = dat.mean()
-                        if multi == 0:
-                            dflag_f[j] = 1
-                        elif multi <= 2:
-                            dflag_f[j] = 2
-                        else:
-                            dflag_f[j] = 3
-                        break
-
-                if dflag_f[j] > 0:
-                    continue
 
-            # Method 6: same as 3 but for 3-120 days
-            for i in range(3, 120):
-                t_win = nperday * (2*i+1)/2
-                j1  = j - np.arange(1, t_win+1, dtype=int) + 1
-                j2  = j + np.arange(1, t_win, dtype=int)
-                jj  = np.append(j1, j2)
-                win = np.unique(np.sort(np.clip(jj, 0, ndata-1)))
-                conditions = ( (np.abs(hour[win]-hour[j]) < 1.1)
-                               & (dflag[win] == 0) )
-                num4avg = np.sum(conditions)
-                if num4avg >= 2:
-                    dat = np.ma.array(data[win], mask=~conditions)
-                    if verbose > 2:
-                        print('    m6.{:d}: '.format(i), j, win.size,
-                              dat.mean(), dat.std(ddof=ddof))
-                    data_f[j]  = dat.mean()
-                    dflag_f[j] = 3
-                    break
+def _mds_windows(week, nperday):
+    """
+    Half-widths of the MDS search windows.
 
-        dfill[hcol] = data_f
-        ffill[hcol] = dflag_f
+    Returns the half-widths for the 1-11 week windows of Methods 1, 2, 4 and 5
+    and for the same-hour windows of Method 3 (first two) and Method 6.
+    """
+    hw_week = [_halfwidth(multi*week) for multi in range(1, 12)]
+    hw_hour = [_halfwidth((nperday * (2*i+1))//2) for i in range(2)]
+    hw_hour += [_halfwidth(nperday * (2*i+1)/2) for i in range(3, 120)]
+    return np.array(hw_week), np.array(hw_hour)
 
-    # Finish
 
-    if isnumpy:
-        if istrans:
-            dfout = dfill.to_numpy().T
-        else:
-            dfout = dfill.to_numpy()
-    else:
-        dfout = dfill
+def _block_size(width, nelem=2**21):
+    """Number of points per block so that block*width stays around *nelem*."""
+    return max(1, nelem // max(1, width))
 
-    if fisnumpy:
-        if fistrans:
-            ffout = ffill.to_numpy().T
+
+def _first_window(points, halfwidths, match, ndata):
+    """
+    Index of the first window in which at least two samples match.
+
+    Parameters
+    ----------
+    points : array of int
+        Data points to search around.
+    halfwidths : array of int
+        Increasing half-widths of the search windows.
+    match : callable
+        ``match(p, jj)`` returns a boolean array of shape `jj.shape` telling
+        if the samples at *jj* match the conditions at points *p[:, None]*.
+    ndata : int
+        Number of data points.
+
+    Returns
+    -------
+    step : array of int
+        Index into *halfwidths* of the first window with at least two
+        matching samples, -1 if there is none.
+
+    Notes
+    -----
+    Windows are evaluated as rings of new offsets so that every offset is
+    only looked at once per point, and points leave the search as soon as
+    they have two matches.
+    """
+    step    = np.full(points.size, -1, dtype=int)
+    count   = np.zeros(points.size, dtype=int)
+    pending = np.arange(points.size)
+    prev    = -1
+    for s, hw in enumerate(halfwidths):
+        if pending.size == 0:
+            break
+        if prev < 0:
+            offsets = np.arange(-hw, hw+1)
         else:
-            ffout = ffill.to_numpy()
+            offsets = np.append(np.arange(-hw, -prev), np.arange(prev+1, hw+1))
+        nblock = _block_size(offsets.size)
+        for b in range(0, pending.size, nblock):
+            kk = pending[b:b+nblock]
+            pp = points[kk]
+            jj = pp[:, None] + offsets[None, :]
+            inside = (jj >= 0) & (jj < ndata)
+            jj = np.clip(jj, 0, ndata-1)
+            count[kk] += np.sum(match(pp, jj) & inside, axis=1)
+        found = count[pending] >= 2
+        step[pending[found]] = s
+        pending = pending[~found]
+        prev = hw
+    return step
+
+
+def _diurnal_index(hour, valid):
+    """
+    Index of valid samples per time of day.
+
+    Parameters
+    ----------
+    hour : array of float
+        Decimal hour of every data point.
+    valid : array of bool
+        True for valid data.
+
+    Returns
+    -------
+    slot : array of int
+        Diurnal slot (index into the unique hours) of every data point.
+    positions : list of arrays of int
+        For every diurnal slot, the sorted positions of the valid samples
+        within +-1.1 hours of it, i.e. the samples used by Methods 3 and 6.
+
+    Notes
+    -----
+    The number of valid samples of a slot between positions *lo* and *hi*
+    is the difference of the prefix counts
+    ``np.searchsorted(positions[s], [lo, hi], side=['left', 'right'])``.
+    """
+    uhour, slot = np.unique(hour, return_inverse=True)
+    ivalid    = np.where(valid)[0]
+    positions = [ ivalid[np.abs(hour[ivalid] - uu) < 1.1] for uu in uhour ]
+    return slot, positions
+
+
+def _first_hour_window(points, halfwidths, slot, positions):
+    """
+    Same as `_first_window` for the same-hour conditions of Methods 3 and 6.
+
+    The prefix counts of `_diurnal_index` are monotone in the window size so
+    the first window with at least two samples is the first one reaching the
+    second closest valid sample of the same hour, which is found by binary
+    search over the window sizes instead of scanning all windows.
+    """
+    step = np.full(points.size, -1, dtype=int)
+    for ss, pos in enumerate(positions):
+        kk = np.where(slot[points] == ss)[0]
+        if (kk.size == 0) or (pos.size < 2):
+            continue
+        pp = points[kk]
+        # the two closest samples are within two positions on either side
+        ii   = np.searchsorted(pos, pp)[:, None] + np.arange(-2, 2)[None, :]
+        ok   = (ii >= 0) & (ii < pos.size)
+        dist = np.abs(pos[np.clip(ii, 0, pos.size-1)] - pp[:, None])
+        dist = np.where(ok, dist, np.iinfo(dist.dtype).max)
+        dist.sort(axis=1)
+        found = np.searchsorted(halfwidths, dist[:, 1])
+        found[found >= halfwidths.size] = -1
+        step[kk] = found
+    return step
+
+
+def _window_stats(points, hw, match, data, err, ddof):
+    """
+    Masked mean (and standard deviation) of *data* around *points*.
+
+    The window of each point is j-hw ... j+hw clipped to the data range,
+    masked where ``match`` is False. The reductions are done in the same way
+    as `numpy.ma` does in `_mds_loop` so that results are bit-identical.
+
+    Returns
+    -------
+    mean, std : arrays of float
+        *std* is None if not *err*.
+    count : array of int
+        Number of samples in the mean.
+    """
+    ndata = len(data)
+    mean  = np.empty(points.size)
+    std   = np.empty(points.size) if err else None
+    count = np.empty(points.size, dtype=int)
+    lo    = points - hw
+    hi    = points + hw
+    edge  = (lo < 0) | (hi >= ndata)
+    # full windows in blocks
+    inner   = np.where(~edge)[0]
+    offsets = np.arange(-hw, hw+1)
+    nblock  = _block_size(offsets.size)
+    for b in range(0, inner.size, nblock):
+        kk   = inner[b:b+nblock]
+        pp   = points[kk]
+        jj   = pp[:, None] + offsets[None, :]
+        cond = match(pp, jj)
+        dat  = data[jj]
+        cnt  = np.sum(cond, axis=1)
+        avg  = np.where(cond, dat, 0.).sum(axis=1) * 1. / cnt
+        mean[kk]  = avg
+        count[kk] = cnt
+        if err:
+            anom  = dat - avg[:, None]
+            anom *= anom
+            std[kk] = np.sqrt(np.where(cond, anom, 0.).sum(axis=1) /
+                              (cnt - ddof))
+    # windows clipped at the borders one by one
+    for k in np.where(edge)[0]:
+        jj   = np.arange(max(lo[k], 0), min(hi[k], ndata-1)+1)
+        cond = match(points[k:k+1], jj[None, :])[0]
+        dat  = np.ma.array(data[jj], mask=~cond)
+        mean[k]  = dat.mean()
+        count[k] = np.sum(cond)
+        if err:
+            std[k] = dat.std(ddof=ddof)
+    return mean, std, count
+
+
+def _mds_vectorized(data, dflag, data_f, dflag_f, largegap,
+                    sw, ta, vpd, sw_flg, meteo_flg, total_flg, hour,
+                    week, nperday, sw_dev, ta_dev, vpd_dev,
+                    err, ddof, verbose, start=0, stop=None,
+                    err_f=None, count_f=None):
+    """
+    Batched MDS of `gapfill` for the data points *start* to *stop* of one
+    column.
+
+    Gives bit-identical results to `_mds_loop`. For every method, the first
+    window with at least two similar samples is searched for all remaining
+    gaps at once (`_first_window`) and the gaps are then filled per window
+    size (`_window_stats`). The same-hour windows of Methods 3 and 6 are
+    looked up in a diurnal index of the valid data (`_diurnal_index`).
+    *data_f* and *dflag_f* are filled in place, as well as *err_f* and
+    *count_f* if given (see `_mds_loop`).
+    """
+    ndata = len(data)
+    hw_week, hw_hour = _mds_windows(week, nperday)
+    sw_devmax = np.maximum(20., np.minimum(sw, sw_dev))
+
+    def match_meteo(p, jj):
+        return ( (np.abs(sw[jj]  - sw[p, None])  < sw_devmax[p, None]) &
+                 (np.abs(ta[jj]  - ta[p, None])  < ta_dev) &
+                 (np.abs(vpd[jj] - vpd[p, None]) < vpd_dev) &
+                 total_flg[jj] )
+
+    def match_sw(p, jj):
+        return ( (np.abs(sw[jj] - sw[p, None]) < sw_devmax[p, None]) &
+                 total_flg[jj] )
+
+    def match_hour(p, jj):
+        return (np.abs(hour[jj] - hour[p, None]) < 1.1) & (dflag[jj] == 0)
+
+    fillerr = err_f is not None
+
+    def fill(points, step, halfwidths, match, flags, name, errest=False):
+        # fill points found in window halfwidths[step] and return the rest
+        for s in np.unique(step[step >= 0]):
+            pp = points[step == s]
+            mean, std, cnt = _window_stats(pp, halfwidths[s], match, data,
+                                           errest, ddof)
+            if fillerr and errest:
+                err_f[pp]   = std
+                count_f[pp] = cnt
+                mean = mean[isgap[pp]]
+                pp   = pp[isgap[pp]]
+            data_f[pp] = mean
+            if err:
+                dflag_f[pp] = std
+            else:
+                dflag_f[pp] = flags[s]
+            if verbose > 2:
+                print('    {:s}.{:d}: '.format(name, s), pp.size)
+        return points[step < 0]
+
+    if stop is None:
+        stop = ndata
+    isgap = (dflag != 0) & ~largegap
+    if err or fillerr:
+        todo = np.arange(start, stop)
     else:
-        ffout = ffill
+        todo = start + np.where(isgap[start:stop])[0]
 
+    # Method 1: all met conditions within one and two weeks
+    pp   = todo[meteo_flg[todo]]
+    step = _first_window(pp, hw_week[:2], match_meteo, ndata)
+    fill(pp, step, hw_week[:2], match_meteo, [1, 1], 'm1', err or fillerr)
     if err:
-        if errmean:
-            return ffout, dfout
-        else:
-            return ffout
-    else:
-        return dfout, ffout
\ No newline at end of file
+        return
+    todo = todo[isgap[todo]]
+    todo = todo[dflag_f[todo] <= 0]
+
+    # Method 2: just global radiation within one week
+    pp   = todo[sw_flg[todo] == 0]
+    step = _first_window(pp, hw_week[:1], match_sw, ndata)
+    fill(pp, step, hw_week[:1], match_sw, [1], 'm2')
+    todo = todo[dflag_f[todo] <= 0]
+
+    # Method 3: same hour within 1-3 days
+    slot, positions = _diurnal_index(hour, dflag == 0)
+    step = _first_hour_window(todo, hw_hour[:2], slot, positions)
+    todo = fill(todo, step, hw_hour[:2], match_hour, [1, 2], 'm3')
+
+    # Method 4: same as 1 but for 3-11 weeks
+    pp   = todo[meteo_flg[todo]]
+    step = _first_window(pp, hw_week[2:], match_meteo, ndata)
+    fill(pp, step, hw_week[2:], match_meteo,
+         [2 if multi <= 4 else 3 for multi in range(3, 12)], 'm4')
+    todo = todo[dflag_f[todo] <= 0]
+
+    # Method 5: same as 2 but for 2-11 weeks
+    pp   = todo[sw_flg[todo] == 0]
+    step = _first_window(pp, hw_week[1:], match_sw, ndata)
+    fill(pp, step, hw_week[1:], match_sw,
+         [2 if multi <= 2 else 3 for multi in range(2, 12)], 'm5')
+    todo = todo[dflag_f[todo] <= 0]
+
+    # Method 6: same as 3 but for 3-120 days
+    step = _first_hour_window(todo, hw_hour[2:], slot, positions)
+    fill(todo, step, hw_hour[2:], match_hour, [3] * (hw_hour.size-2), 'm6')
+
+
+def _mds_stages(week, nperday, err):
+    """
+    Table of the MDS cascade for `_mds_kernel`.
+
+    Returns
+    -------
+    stage_kind : array of int
+        Conditions of each method: 0 all met conditions, 1 just global
+        radiation, 2 same hour.
+    stage_start : array of int
+        Index of the first window of each method in *win_hw*, with a last
+        element closing the last method.
+    win_hw, win_flag : arrays of int
+        Half-widths and quality flags of the windows of the methods.
+    """
+    hw_week, hw_hour = _mds_windows(week, nperday)
+    stages = [(0, hw_week[:2], [1, 1]),
+              (1, hw_week[:1], [1]),
+              (2, hw_hour[:2], [1, 2]),
+              (0, hw_week[2:], [2 if multi <= 4 else 3
+                                for multi in range(3, 12)]),
+              (1, hw_week[1:], [2 if multi <= 2 else 3
+                                for multi in range(2, 12)]),
+              (2, hw_hour[2:], [3] * (hw_hour.size-2))]
+    if err:
+        stages = stages[:1]
+    stage_kind  = np.array([ kind for kind, hw, flags in stages ])
+    stage_start = np.cumsum([0] + [ hw.size for kind, hw, flags in stages ])
+    win_hw      = np.concatenate([ hw for kind, hw, flags in stages ])
+    win_flag    = np.concatenate([ flags for kind, hw, flags in stages ])
+    return stage_kind, stage_start, win_hw.astype(np.int64), win_flag
+
+
+def _mds_kernel(data, dflag, data_f, dflag_f, largegap,
+                sw, ta, vpd, sw_flg, meteo_flg, total_flg, hour,
+                stage_kind, stage_start, win_hw, win_flag,
+                sw_dev, ta_dev, vpd_dev, err, ddof, start, stop,
+                fillerr, err_f, count_f):
+    """
+    MDS cascade of `_mds_loop` over plain arrays without temporary arrays,
+    to be compiled with numba (see `_numba_kernel`). *err_f* and *count_f*
+    are only used if *fillerr*.
+
+    Windows are counted ring by ring and means are summed sequentially, so
+    quality flags are the same as `_mds_loop` while filled values and error
+    estimates can differ in the last digits.
+    """
+    ndata = data.shape[0]
+    for j in range(start, stop):
+        isgap = (dflag[j] != 0) and not largegap[j]
+        if not err:
+            if not (isgap or fillerr):
+                continue
+        sw_devmax = max(20., min(sw[j], sw_dev))
+        done = False
+        for st in range(stage_kind.shape[0]):
+            # only Method 1 for error estimates
+            if (st > 0) and not isgap:
+                break
+            kind = stage_kind[st]
+            if (kind == 0) and not meteo_flg[j]:
+                continue
+            if (kind == 1) and (sw_flg[j] != 0):
+                continue
+
+            def similar(k):
+                if kind == 0:
+                    return ( (abs(sw[k] - sw[j]) < sw_devmax) and
+                             (abs(ta[k] - ta[j]) < ta_dev) and
+                             (abs(vpd[k] - vpd[j]) < vpd_dev) and
+                             total_flg[k] )
+                elif kind == 1:
+                    return (abs(sw[k] - sw[j]) < sw_devmax) and total_flg[k]
+                else:
+                    return (abs(hour[k] - hour[j]) < 1.1) and (dflag[k] == 0)
+
+            count = 0
+            prev  = -1
+            for w in range(stage_start[st], stage_start[st+1]):
+                hw = win_hw[w]
+                lo = max(j - hw, 0)
+                hi = min(j + hw, ndata - 1)
+                # count only the offsets added to the previous window
+                if prev < 0:
+                    n1 = hi - lo + 1
+                    n2 = 0
+                else:
+                    n1 = max(j - prev - lo, 0)
+                    n2 = max(hi - j - prev, 0)
+                for i in range(n1 + n2):
+                    if i < n1:
+                        k = lo + i
+                    else:
+                        k = j + prev + 1 + i - n1
+                    if similar(k):
+                        count += 1
+                prev = hw
+                if count < 2:
+                    continue
+                # mean and standard deviation of similar conditions
+                dsum = 0.
+                for k in range(lo, hi+1):
+                    if similar(k):
+                        dsum += data[k]
+                avg = dsum / count
+                std = 0.
+                if err or (fillerr and (st == 0)):
+                    dsum = 0.
+                    for k in range(lo, hi+1):
+                        if similar(k):
+                            dsum += (data[k] - avg) * (data[k] - avg)
+                    std = np.sqrt(dsum / (count - ddof))
+                if err:
+                    data_f[j]  = avg
+                    dflag_f[j] = std
+                else:
+                    if fillerr and (st == 0):
+                        err_f[j]   = std
+                        count_f[j] = count
+                    if isgap:
+                        data_f[j]  = avg
+                        dflag_f[j] = win_flag[w]
+                done = True
+                break
+            if done:
+                break
+
+
+_NUMBA_KERNEL = None
+
+
+def _numba_kernel():
+    """
+    `_mds_kernel` compiled with numba, None if numba is not available.
+    """
+    global _NUMBA_KERNEL
+    if _NUMBA_KERNEL is None:
+        try:
+            import numba
+        except ImportError:
+            return None
+        _NUMBA_KERNEL = numba.njit(cache=True)(_mds_kernel)
+    return _NUMBA_KERNEL
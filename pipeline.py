@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 16 23:40:12 2026
+Streaming post-processing pipeline
+
+Composes the reading, screening and gap filling functions into a pipeline
+that processes a site in time chunks. Every stage declares the halo of data
+it needs around a chunk, e.g. the MDS search windows of `gapfill`, so that
+each chunk is processed with its context and only the chunk is written to
+the output. With inputs read lazily from the reader cache
+(`read_inputs(..., lazy=True)`), only the chunk plus halos is in memory
+instead of the whole record.
+
+Example
+-------
+>>> df, units = read_inputs(fulloutput=FULL_PATH, biomet=BIOMET_PATH,
+...                         cache="cache", lazy=True)
+>>> pipe = Pipeline([range_stage(yaml), dependencies_stage(yaml),
+...                  mds_stage(["FC", "LE", "H"])], chunk="365D")
+>>> pipe.run(df, "site_gapfilled.parquet")
+"""
+import pandas as pd
+
+#%% Stages
+
+
+class Stage:
+    """
+    Step of a `Pipeline`, a function of a DataFrame returning a DataFrame
+    with the same index.
+
+    Parameters
+    ----------
+    func : callable
+        Function called as func(df, **kwargs).
+    halo : str or Timedelta, optional
+        Data needed before and after a chunk to process it, e.g. "30D".
+        Default is no halo, records are processed independently.
+    name : str, optional
+        Name of the stage. Default is the name of *func*.
+    **kwargs
+        Keyword arguments of *func*.
+    """
+
+    def __init__(self, func, halo="0D", name=None, **kwargs):
+        self.func   = func
+        self.halo   = pd.Timedelta(halo)
+        self.name   = func.__name__ if name is None else name
+        self.kwargs = kwargs
+
+    def __call__(self, df):
+        return self.func(df, **self.kwargs)
+
+    def __repr__(self):
+        return "Stage({}, halo={})".format(self.name, self.halo)
+
+
+def range_stage(yaml):
+    """
+    Stage of `data_screening.physical_range` with the YAML configuration
+    *yaml*, compiled once for all chunks, no halo.
+    """
+    import data_screening
+    plan = data_screening.range_plan(yaml)
+    return Stage(lambda df: data_screening.physical_range(plan, df),
+                 name="physical_range")
+
+
+def dependencies_stage(yaml):
+    """
+    Stage of `data_screening.dependencies_filtering` with the YAML
+    configuration *yaml*, compiled once for all chunks, no halo.
+    """
+    import data_screening
+    plan = data_screening.dependency_plan(yaml)
+    return Stage(lambda df: data_screening.dependencies_filtering(plan, df),
+                 name="dependencies_filtering")
+
+
+def biomet_stage(predictors, halo="30D", **kwargs):
+    """
+    Stage of `gapfilling.biomet_gap_fill` with the DataFrame of
+    *predictors* and keyword arguments *kwargs*.
+
+    The regressions are fitted on the chunk and its halo, so the results
+    differ from a fit on the whole record. The default halo of 30 days gives
+    each chunk a month of training data on both sides, and covers moving
+    windows (*window*) of up to 30 days.
+    """
+    import gapfilling
+    def fill(df):
+        window = predictors.loc[df.index[0]:df.index[-1]]
+        return gapfilling.biomet_gap_fill(df, window, **kwargs)
+    return Stage(fill, halo=halo, name="biomet_gap_fill")
+
+
+def mds_stage(columns=None, freq="30min", qc_suffix="_QC", **kwargs):
+    """
+    Stage of `gapfilling.gapfill` (MDS) filling *columns*.
+
+    The halo covers the farthest data point that the MDS can use to fill a
+    gap, i.e. the same-hour windows of Method 6 (about 120 days), and the
+    *longgap* days of the large gap detection. The filled chunks are thus
+    the same as filling the whole record at once.
+
+    Parameters
+    ----------
+    columns : list of str, optional
+        Columns to fill. Default is all but the meteorological drivers
+        (SW_IN, TA and VPD, see `gapfilling.gapfill`).
+    freq : str, optional
+        Time step of the records. Default is "30min".
+    qc_suffix : str, optional
+        Suffix of the added columns with the quality class of the filling.
+        Default is "_QC".
+    **kwargs
+        Keyword arguments of `gapfilling.gapfill`, *engine* defaults to
+        "vectorized".
+    """
+    import gapfilling
+    kwargs.setdefault("engine", "vectorized")
+    undef = kwargs.get("undef", -9999)
+    step = pd.Timedelta(freq)
+    week = pd.Timedelta("1 W") / step
+    hw_week, hw_hour = gapfilling._mds_windows(week, week // 7)
+    halo = max(max(hw_week[-1], hw_hour[-1]) * step,
+               pd.Timedelta(days=kwargs.get("longgap", 60) + 1))
+    def fill(df):
+        sw_id, ta_id, vpd_id, hcols = gapfilling._mds_columns(df.columns)
+        cols = hcols if columns is None else list(columns)
+        data = df[[sw_id, ta_id, vpd_id] + cols]
+        # NaN of the screening stages and undef are missing values
+        flag = ((data == undef) | data.isna()).astype(int)
+        filled, quality = gapfilling.gapfill(data, flag=flag, **kwargs)
+        df = df.copy()
+        df[cols] = filled[cols]
+        for col in cols:
+            df[col + qc_suffix] = quality[col]
+        return df
+    return Stage(fill, halo=halo, name="gapfill")
+
+#%% Pipeline
+
+
+class Pipeline:
+    """
+    Pipeline of stages processing the records of a site in time chunks.
+
+    Each chunk is read with the sum of the halos of all stages around it.
+    After every stage, the window is trimmed to the halos of the remaining
+    stages, and the chunk itself is written to the output. The records can
+    be a DataFrame, or read by windows from a lazy source of `read_inputs`
+    so that memory is bounded by the chunk window.
+
+    Parameters
+    ----------
+    stages : list of Stage
+        Stages run in order.
+    chunk : str or Timedelta, optional
+        Length of the chunks. Default is "365D".
+    """
+
+    def __init__(self, stages, chunk="365D"):
+        self.stages = list(stages)
+        self.chunk  = pd.Timedelta(chunk)
+
+    def __repr__(self):
+        return "Pipeline([{}], chunk={})".format(
+            ", ".join(map(repr, self.stages)), self.chunk)
+
+    @property
+    def halo(self):
+        """Data read before and after each chunk."""
+        return sum((stage.halo for stage in self.stages), pd.Timedelta(0))
+
+    def chunks(self, df):
+        """
+        Processes the records of *df*, a DataFrame or a lazy source of
+        `read_inputs`, and yields the output of the stages chunk by chunk, in
+        time order.
+        """
+        index = df.index
+        if len(index) == 0:
+            return
+        edges = pd.date_range(index[0], index[-1] + self.chunk,
+                              freq=self.chunk)
+        for start, end in zip(edges[:-1], edges[1:]):
+            lo, hi = index.searchsorted([start, end])
+            if lo == hi:
+                continue
+            halo = self.halo
+            window = _window(df, start - halo, end + halo)
+            for stage in self.stages:
+                window = stage(window)
+                halo = halo - stage.halo
+                lo, hi = window.index.searchsorted([start - halo, end + halo])
+                window = window.iloc[lo:hi]
+            yield window
+
+    def run(self, df, output=None):
+        """
+        Processes the records of *df* and writes the output chunk by chunk.
+
+        Parameters
+        ----------
+        df : DataFrame or JoinedWindows
+            Records with a sorted datetime index, e.g. from `read_inputs`.
+        output : str or callable, optional
+            CSV (.csv) or Parquet (.parquet, needs pyarrow) file written
+            incrementally, or function called with each output chunk.
+            Default is None, the chunks are concatenated and returned.
+
+        Returns
+        -------
+        df : DataFrame or None
+            Output of the stages if *output* is None.
+        """
+        if output is None:
+            return pd.concat(list(self.chunks(df)))
+        if callable(output):
+            for out in self.chunks(df):
+                output(out)
+        elif output.endswith(".parquet"):
+            import pyarrow as pa
+            from pyarrow import parquet
+            writer = None
+            try:
+                for out in self.chunks(df):
+                    if writer is None:
+                        table  = pa.Table.from_pandas(out)
+                        writer = parquet.ParquetWriter(output, table.schema)
+                    else:
+                        table = pa.Table.from_pandas(out,
+                                                     schema=writer.schema)
+                    writer.write_table(table)
+            finally:
+                if writer is not None:
+                    writer.close()
+        elif output.endswith(".csv"):
+            header = True
+            for out in self.chunks(df):
+                out.to_csv(output, mode="w" if header else "a",
+                           header=header)
+                header = False
+        else:
+            raise ValueError("output must be a .csv or .parquet file or a"
+                             " function, given: " + str(output))
+
+
+def _window(df, start, stop):
+    """
+    Records of *df*, a DataFrame or a lazy source, from *start* included to
+    *stop* excluded.
+    """
+    if isinstance(df, pd.DataFrame):
+        lo, hi = df.index.searchsorted([start, stop])
+        return df.iloc[lo:hi]
+    return df.window(start, stop)
+
+
+class JoinedWindows:
+    """
+    Lazy join of `data_ingest.FeatherWindows` on a regular time grid, the
+    same as joining the DataFrames and calling asfreq(*freq*), but read by
+    time windows.
+
+    Parameters
+    ----------
+    sources : list of data_ingest.FeatherWindows
+        Records to join, columns in this order.
+    freq : str, optional
+        Time step of the grid. Default is "30min".
+    """
+
+    def __init__(self, sources, freq="30min"):
+        self.sources = list(sources)
+        first = min(src.index[0] for src in self.sources if len(src))
+        last  = max(src.index[-1] for src in self.sources if len(src))
+        self.index   = pd.date_range(first, last, freq=freq)
+        self.columns = pd.Index([]).append([src.columns
+                                            for src in self.sources])
+
+    def __repr__(self):
+        return "JoinedWindows({} records x {} columns)".format(
+            len(self.index), len(self.columns))
+
+    def window(self, start=None, stop=None):
+        """
+        DataFrame of the records from *start* included to *stop* excluded,
+        from the first or to the last record if None.
+        """
+        lo = 0 if start is None else self.index.searchsorted(start)
+        hi = len(self.index) if stop is None else \
+            self.index.searchsorted(stop)
+        df = pd.concat([src.window(start, stop) for src in self.sources],
+                       axis=1)
+        return df.reindex(self.index[lo:max(hi, lo)])
+
+
+def read_inputs(fulloutput=None, biomet=None, cache=None, lazy=False):
+    """
+    Reads the EddyPro full output and the biomet files of a site and joins
+    them on their 30-min index.
+
+    Parameters
+    ----------
+    fulloutput : str, optional
+        Path of the full output file, see `data_ingest.df_fulloutput`.
+    biomet : str, optional
+        Path of the biomet files, see `data_ingest.df_biomet`.
+    cache : str, optional
+        Cache directory of the readers, the files are then only parsed when
+        they change.
+    lazy : bool, optional
+        If True, the joined data are read by time windows from the cache
+        files when the pipeline runs, instead of being loaded in memory. The
+        files are parsed at once the first time. Needs *cache*. Default is
+        False.
+
+    Returns
+    -------
+    df : DataFrame or JoinedWindows
+        Joined data, read by windows if *lazy*.
+    units : Series
+        Units of the variables.
+    """
+    import data_ingest
+    dfs = []
+    if fulloutput is not None:
+        dfs.append(data_ingest.df_fulloutput(fulloutput, cache=cache,
+                                             lazy=lazy))
+    if biomet is not None:
+        dfs.append(data_ingest.df_biomet(biomet, cache=cache, lazy=lazy))
+    if not dfs:
+        raise ValueError("fulloutput or biomet must be given.")
+    units = pd.concat([units for _, units in dfs])
+    if lazy:
+        return JoinedWindows([df for df, _ in dfs]), units
+    df = pd.concat([df for df, _ in dfs], axis=1)
+    if isinstance(df.index, pd.DatetimeIndex):
+        df = df.asfreq("30min")
+    return df, units
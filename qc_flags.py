@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 00:05:41 2026
+Bit-packed quality control flags
+
+One uint16 per data point and variable, with one bit per screening test and
+two bits for the quality class of the MDS gap filling. The screening
+functions of data_screening write their rejections into a QCFlags store,
+`gapfilling.gapfill` reads the rejected points from it and writes back the
+large gaps and quality classes, so that the reasons why any point was
+removed or filled can be audited afterwards.
+"""
+import numpy as np
+import pandas as pd
+
+# Bits of the tests
+RANGE      = 0x0001  # outside the physical range
+DEPENDENCY = 0x0002  # missing or rejected dependency
+DATE       = 0x0004  # date exclusion
+FOKEN      = 0x0008  # Mauder and Foken (2004) flag 2
+NONFINITE  = 0x0010  # nan or infinite value
+LARGEGAP   = 0x0020  # in a large gap, not filled by the MDS
+# Quality class 1-3 of the MDS gap filling in bits 6 and 7
+MDS_SHIFT  = 6
+MDS        = 0x0003 << MDS_SHIFT
+# Tests rejecting data
+REJECT     = RANGE | DEPENDENCY | DATE | FOKEN | NONFINITE
+
+TESTS = {"range": RANGE, "dependency": DEPENDENCY, "date": DATE,
+         "foken": FOKEN, "nonfinite": NONFINITE, "largegap": LARGEGAP}
+
+
+class QCFlags:
+    """
+    Store of the quality control flags of a set of variables.
+
+    Parameters
+    ----------
+    index : array_like
+        Time index of the data points.
+    columns : list of str, optional
+        Variables. More are added when flags are set for them.
+
+    Attributes
+    ----------
+    flags : numpy.ndarray of uint16
+        Flags of shape (len(index), len(columns)).
+
+    Examples
+    --------
+    >>> qc = QCFlags(df.index)
+    >>> df2 = physical_range(yaml, df, qc=qc)
+    >>> df3 = dependencies_filtering(yaml, df2, qc=qc)
+    >>> filled, quality = gapfill(df3, flag=qc)
+    >>> qc.audit("2024-07-01 12:30")
+    >>> qc.counts()
+    """
+
+    def __init__(self, index, columns=()):
+        self.index   = pd.Index(index)
+        self.columns = pd.Index(list(columns))
+        self.flags   = np.zeros((len(self.index), len(self.columns)),
+                                dtype=np.uint16)
+
+    def __repr__(self):
+        return "QCFlags({} points x {} variables)".format(*self.flags.shape)
+
+    def _columns(self, columns, add=False):
+        """Positions of *columns*, adding the new ones if *add*."""
+        columns = [columns] if isinstance(columns, str) else list(columns)
+        new = [col for col in dict.fromkeys(columns)
+               if col not in self.columns]
+        if new:
+            if not add:
+                raise KeyError("Variables not in the flags: " + str(new))
+            self.columns = self.columns.append(pd.Index(new))
+            self.flags = np.hstack([self.flags, np.zeros(
+                (len(self.index), len(new)), dtype=np.uint16)])
+        return self.columns.get_indexer(columns)
+
+    def _rows(self, index):
+        """Positions of the time *index*, all points if None."""
+        if index is None:
+            return slice(None)
+        rows = self.index.get_indexer(pd.Index(index))
+        if (rows < 0).any():
+            raise KeyError("Times not in the flags index.")
+        return rows
+
+    def set(self, test, mask, index=None, columns=None):
+        """
+        Sets the bit of *test* where *mask* is True and clears it elsewhere.
+
+        Parameters
+        ----------
+        test : str or int
+            Name of the test (see `TESTS`) or its bit.
+        mask : array_like or DataFrame of bool
+            Rejected points, of shape (len(index), len(columns)), or 1-D for
+            a single variable. The index and columns of a DataFrame are used
+            if *index* and *columns* are not given.
+        index : array_like, optional
+            Times of the rows of *mask*. Default is the whole index.
+        columns : str or list of str, optional
+            Variables of the columns of *mask*.
+        """
+        bit = np.uint16(TESTS.get(test, test))
+        if isinstance(mask, pd.DataFrame):
+            index   = mask.index if index is None else index
+            columns = mask.columns if columns is None else columns
+        elif isinstance(mask, pd.Series):
+            index   = mask.index if index is None else index
+            columns = mask.name if columns is None else columns
+        cols = self._columns(columns, add=True)
+        rows = self._rows(index)
+        mask = np.asarray(mask, dtype=bool)
+        if mask.ndim == 1:
+            mask = mask[:, None]
+        sel = (rows, cols) if isinstance(rows, slice) else np.ix_(rows, cols)
+        block = self.flags[sel] & ~bit
+        block[mask] |= bit
+        self.flags[sel] = block
+
+    def test(self, test, columns=None):
+        """
+        DataFrame of the points flagged by *test* (name or bit).
+        """
+        bit = TESTS.get(test, test)
+        return self._frame((self._block(columns) & bit) != 0, columns)
+
+    def rejected(self, columns=None):
+        """
+        DataFrame of the points rejected by any screening test.
+        """
+        return self._frame((self._block(columns) & REJECT) != 0, columns)
+
+    def quality(self, columns=None):
+        """
+        DataFrame of the quality class of the MDS gap filling, 0 for data
+        that were not filled.
+        """
+        return self._frame((self._block(columns) & MDS) >> MDS_SHIFT,
+                           columns)
+
+    def set_quality(self, quality, index=None):
+        """
+        Stores the quality classes of `gapfilling.gapfill`, a DataFrame with
+        values 0-3 or a 2-D array with *index* and columns.
+        """
+        cols = self._columns(quality.columns, add=True)
+        rows = self._rows(quality.index if index is None else index)
+        sel = (rows, cols) if isinstance(rows, slice) else np.ix_(rows, cols)
+        qclass = np.asarray(quality).astype(np.uint16) & 0x0003
+        self.flags[sel] = (self.flags[sel] & ~np.uint16(MDS)) | \
+            (qclass << MDS_SHIFT)
+
+    def audit(self, time, columns=None):
+        """
+        Tests that flagged the data points at *time*.
+
+        Returns
+        -------
+        dict
+            List of the names of the tests, and "mds class k" for filled
+            data, of each variable with flags.
+        """
+        row = self.index.get_loc(pd.Timestamp(time)
+                                 if isinstance(self.index, pd.DatetimeIndex)
+                                 else time)
+        block = self._block(columns)[row]
+        names = self.columns if columns is None else \
+            pd.Index([columns] if isinstance(columns, str) else columns)
+        report = {}
+        for col, value in zip(names, block):
+            tests = [name for name, bit in TESTS.items() if value & bit]
+            if value & MDS:
+                tests.append("mds class {}".format((value & MDS) >> MDS_SHIFT))
+            if tests:
+                report[col] = tests
+        return report
+
+    def counts(self):
+        """
+        DataFrame of the number of points flagged by each test (rows) for
+        each variable (columns), and of the points filled by the MDS.
+        """
+        counts = {name: ((self.flags & bit) != 0).sum(axis=0)
+                  for name, bit in TESTS.items()}
+        counts["mds"] = ((self.flags & MDS) != 0).sum(axis=0)
+        return pd.DataFrame(counts, index=self.columns).T
+
+    def to_frame(self):
+        """
+        DataFrame of the raw uint16 flags.
+        """
+        return pd.DataFrame(self.flags, index=self.index,
+                            columns=self.columns)
+
+    def _block(self, columns):
+        """Flags of *columns*, all if None."""
+        if columns is None:
+            return self.flags
+        return self.flags[:, self._columns(columns)]
+
+    def _frame(self, values, columns):
+        """DataFrame of *values* of *columns* with the flags index."""
+        if columns is None:
+            columns = self.columns
+        elif isinstance(columns, str):
+            columns = [columns]
+        return pd.DataFrame(values, index=self.index, columns=columns)
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 11:02:15 2026
+Tests of the biomet readers and of the ECCC downloads of data_ingest
+
+Run with: python -m pytest -q test_data_ingest.py
+"""
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import data_ingest
+
+
+def write_toa5(path, start, n, status=False, value=1.):
+    """
+    Writes a CSI datalogger TOA5 file of *n* 30-min records from *start*,
+    with TA = *value* + record number and an optional text column.
+    """
+    columns = ["TIMESTAMP", "RECORD", "TA_1_1_1"] + (["STATUS"] if status
+                                                     else [])
+    units = ["TS", "RN", "C"] + ([""] if status else [])
+    lines = ['"TOA5","site","CR1000X","1","OS","CPU","1234","Biomet"',
+             ",".join('"'+c+'"' for c in columns),
+             ",".join('"'+u+'"' for u in units),
+             ",".join('""' for _ in columns)]
+    times = pd.date_range(start, periods=n, freq="30min")
+    for i, time in enumerate(times):
+        row = ['"{:%Y-%m-%d %H:%M:%S}"'.format(time), str(i),
+               str(value + i)]
+        if status:
+            row.append('"OK"' if i % 2 else '"LOW"')
+        lines.append(",".join(row))
+    with open(path, "w", newline="") as f:
+        f.write("\n".join(lines) + "\n")
+    return times
+
+
+def test_biomet_text_column(tmp_path):
+    times = write_toa5(tmp_path / "a.dat", "2020-01-01 00:30", 6,
+                       status=True)
+    write_toa5(tmp_path / "b.dat", "2020-01-01 03:30", 4)
+    df, units = data_ingest.df_biomet(str(tmp_path / "*.dat"))
+    assert df.attrs["skipped_files"] == {}
+    assert list(df.columns) == ["RECORD", "TA_1_1_1", "STATUS"]
+    assert df.TA_1_1_1.dtype == float
+    np.testing.assert_array_equal(df.loc[times, "TA_1_1_1"],
+                                  1. + np.arange(6))
+    assert list(df.loc[times, "STATUS"]) == ["LOW", "OK"] * 3
+    assert df.STATUS.iloc[6:].isna().all()
+
+
+def touch(path, mtime):
+    """Sets the mtime of *path*, changes are then seen whatever the clock."""
+    import os
+    os.utime(path, ns=(mtime, mtime))
+
+
+def test_update_biomet_manifest(tmp_path):
+    import os
+    import warnings
+    store = str(tmp_path / "store.feather")
+    pattern = str(tmp_path / "*.dat")
+    a = write_toa5(tmp_path / "a.dat", "2020-01-01 00:30", 4)
+    df, _ = data_ingest.update_biomet(pattern, store)
+    assert len(df) == 4
+    manifest = data_ingest._feather_meta(store)["manifest"]
+    assert list(manifest) == [str(tmp_path / "a.dat")]
+    assert (manifest[str(tmp_path / "a.dat")]["start"],
+            manifest[str(tmp_path / "a.dat")]["stop"]) == (0, 4)
+    # New file
+    b = write_toa5(tmp_path / "b.dat", "2020-01-01 02:30", 4)
+    df, _ = data_ingest.update_biomet(pattern, store)
+    assert df.index.equals(a.append(b))
+    # Changed file, its records are replaced
+    write_toa5(tmp_path / "a.dat", "2020-01-01 00:30", 4, value=10.)
+    touch(tmp_path / "a.dat", 10**18)
+    df, _ = data_ingest.update_biomet(pattern, store)
+    np.testing.assert_array_equal(df.loc[a, "TA_1_1_1"], 10. + np.arange(4))
+    np.testing.assert_array_equal(df.loc[b, "TA_1_1_1"], 1. + np.arange(4))
+    assert df.equals(data_ingest.df_biomet(pattern)[0])
+    # Removed file, its records stay in the store
+    os.remove(tmp_path / "b.dat")
+    df, _ = data_ingest.update_biomet(pattern, store)
+    np.testing.assert_array_equal(df.loc[b, "TA_1_1_1"], 1. + np.arange(4))
+    # Changed file that cannot be parsed keeps its records and its entry
+    before = data_ingest._feather_meta(store)["manifest"]
+    with open(tmp_path / "a.dat", "w") as f:
+        f.write("garbage\n")
+    touch(tmp_path / "a.dat", 2*10**18)
+    # with a new file read in the same update
+    c = write_toa5(tmp_path / "c.dat", "2020-01-02 00:30", 2, value=5.)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        df2, _ = data_ingest.update_biomet(pattern, store)
+    assert any("a.dat" in str(w.message) for w in caught)
+    assert df2.loc[df.index].equals(df)
+    np.testing.assert_array_equal(df2.loc[c, "TA_1_1_1"], 5. + np.arange(2))
+    manifest = data_ingest._feather_meta(store)["manifest"]
+    assert manifest[str(tmp_path / "a.dat")] == \
+        before[str(tmp_path / "a.dat")]
+    # and is read again once fixed
+    write_toa5(tmp_path / "a.dat", "2020-01-01 00:30", 4, value=20.)
+    touch(tmp_path / "a.dat", 3*10**18)
+    df3, _ = data_ingest.update_biomet(pattern, store)
+    np.testing.assert_array_equal(df3.loc[a, "TA_1_1_1"], 20. + np.arange(4))
+
+
+class ECCCServer:
+    """
+    Local stand-in of the ECCC bulk data service on a thread.
+
+    The responses of each (year, month) are given by *status*, a list of
+    HTTP status codes returned in turn before 200, or "sleep" to answer
+    after *delay* seconds.
+    """
+
+    def __init__(self, status=None, delay=0.):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        from urllib.parse import parse_qs, urlparse
+        self.status = status or {}
+        self.delay = delay
+        self.calls = {}
+        self.times = {}
+        self.active = self.max_active = 0
+        lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                period = (int(query["Year"][0]), int(query["Month"][0]))
+                with lock:
+                    n = server.calls.get(period, 0)
+                    server.calls[period] = n + 1
+                    server.times.setdefault(period, []).append(
+                        time.monotonic())
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                try:
+                    status = server.status.get(period, [])
+                    status = status[n] if n < len(status) else 200
+                    time.sleep(server.delay if status == "sleep" else 0.02)
+                    if status in (200, "sleep"):
+                        body = "{}-{},{}\n".format(*period,
+                                                   query["stationID"][0])
+                        body = body.encode()
+                        self.send_response(200)
+                        self.send_header("Content-Length", str(len(body)))
+                        self.end_headers()
+                        self.wfile.write(body)
+                    else:
+                        self.send_response(status)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                finally:
+                    with lock:
+                        server.active -= 1
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/bulk".format(self.httpd.server_port)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def eccc_server():
+    pytest.importorskip("requests")
+    servers = []
+
+    def start(status=None, delay=0.):
+        servers.append(ECCCServer(status, delay))
+        return servers[-1]
+    yield start
+    for server in servers:
+        server.close()
+
+
+PERIODS = [(2020, month) for month in range(1, 13)]
+
+
+def test_eccc_download(eccc_server):
+    server = eccc_server()
+    texts = data_ingest.eccc_download(51698., PERIODS, n_jobs=4,
+                                      base_url=server.url)
+    # in the order of the periods
+    assert texts == ["2020-{},51698\n".format(m) for m in range(1, 13)]
+    assert set(server.calls.values()) == {1}
+    # on the threads of the pool
+    assert 1 < server.max_active <= 4
+    server.max_active = 0
+    assert data_ingest.eccc_download(51698, PERIODS[:3], n_jobs=1,
+                                     base_url=server.url) == texts[:3]
+    assert server.max_active == 1
+
+
+def test_eccc_download_retries(eccc_server):
+    server = eccc_server({(2020, 2): [503, 429, 500], (2020, 3): [404],
+                          (2020, 4): [400, 503]})
+    texts = data_ingest.eccc_download(51698, PERIODS[:4], retries=3,
+                                      backoff=0.05, base_url=server.url)
+    assert texts[0] == "2020-1,51698\n"
+    assert texts[1] == "2020-2,51698\n"
+    assert server.calls[(2020, 2)] == 4
+    # exponential backoff
+    waits = np.diff(server.times[(2020, 2)])
+    assert (waits >= 0.05 * 2**np.arange(3)).all()
+    # refusals are not retried
+    assert texts[2] is None and texts[3] is None
+    assert server.calls[(2020, 3)] == server.calls[(2020, 4)] == 1
+
+
+def test_eccc_download_timeout(eccc_server):
+    import requests
+    server = eccc_server({(2020, 1): ["sleep"] * 2}, delay=0.5)
+    assert data_ingest.eccc_download(51698, PERIODS[:1], retries=2,
+                                     backoff=0.01, timeout=0.2,
+                                     base_url=server.url) \
+        == ["2020-1,51698\n"]
+    assert server.calls[(2020, 1)] == 3
+    # still timing out after the retries
+    server = eccc_server({(2020, 1): ["sleep"] * 3}, delay=0.5)
+    with pytest.raises(requests.Timeout):
+        data_ingest.eccc_download(51698, PERIODS[:1], retries=1,
+                                  backoff=0.01, timeout=0.2,
+                                  base_url=server.url)
+    assert server.calls[(2020, 1)] == 2
+
+
+def test_eccc_download_requests_missing(monkeypatch, tmp_path):
+    import sys
+    monkeypatch.setitem(sys.modules, "requests", None)
+    with pytest.raises(ImportError, match="pip install requests"):
+        data_ingest.eccc_download(51698, PERIODS[:1])
+    # not needed when all the periods are in the cache
+    cache = data_ingest.ECCCCache(str(tmp_path))
+    cache.put(51698, 2020, 1, "2020-1,51698\n")
+    assert data_ingest.eccc_download(51698, PERIODS[:1], cache=cache) \
+        == ["2020-1,51698\n"]
+
+
+@pytest.fixture
+def june_2020(monkeypatch):
+    """Months up to May 2020 are complete, June 2020 is the current one."""
+    monkeypatch.setattr(data_ingest.ECCCCache, "complete", staticmethod(
+        lambda year, month: (int(year), int(month)) < (2020, 6)))
+
+
+def test_eccc_cache_states(tmp_path, june_2020, monkeypatch):
+    cache = data_ingest.ECCCCache(str(tmp_path))
+    assert cache.get(51698, 2020, 1) is None
+    # ended months
+    cache.put(51698, 2020, 1, "january")
+    cache.put(51698, 2020, 2, None)
+    assert cache.get(51698, 2020, 1) == "january"
+    assert cache.get(51698, 2020, 2) == ""
+    # current month, downloaded again at every use, refusals not stored
+    cache.put(51698, 2020, 6, "june so far")
+    cache.put(51698, 2020, 7, None)
+    assert cache.get(51698, 2020, 6) is None
+    assert cache.get(51698, 2020, 7) is None
+    # failed downloads are not stored
+    cache.put(51698, 2020, 3, data_ingest._ECCC_FAILED)
+    assert cache.get(51698, 2020, 3) is None
+    assert sorted(os.listdir(tmp_path / "51698")) == \
+        ["2020-01.csv.gz", "2020-02.refused", "2020-06.partial.csv.gz"]
+    assert cache.stats() == {"hits": 2, "misses": 3, "refreshed": 1,
+                             "hit_rate": 2/6}
+    # the partial month becomes final once it ended
+    cache.put(51698, 2020, 5, "may")
+    monkeypatch.setattr(data_ingest.ECCCCache, "complete",
+                        staticmethod(lambda year, month: True))
+    cache.put(51698, 2020, 6, "june")
+    assert sorted(os.listdir(tmp_path / "51698")) == \
+        ["2020-01.csv.gz", "2020-02.refused", "2020-05.csv.gz",
+         "2020-06.csv.gz"]
+    # gzip files read by a new cache
+    cache = data_ingest.ECCCCache(str(tmp_path))
+    assert [cache.get(51698, 2020, m) for m in (1, 2, 5, 6)] == \
+        ["january", "", "may", "june"]
+    assert (cache.hits, cache.misses, cache.refreshed) == (4, 0, 0)
+
+
+def test_eccc_download_cache(tmp_path, eccc_server, june_2020):
+    import warnings
+    periods = [(2020, month) for month in range(1, 7)]
+    # 404 in March, 503 in April beyond the retries then fine
+    server = eccc_server({(2020, 3): [404], (2020, 4): [503] * 2})
+    cache = data_ingest.ECCCCache(str(tmp_path))
+    with pytest.warns(UserWarning, match=r"\(2020, 4\)"):
+        texts = data_ingest.eccc_download(51698, periods, retries=1,
+                                          backoff=0.01, base_url=server.url,
+                                          cache=cache)
+    expected = ["2020-{},51698\n".format(m) for m in range(1, 7)]
+    assert texts == expected[:2] + [None, None] + expected[4:]
+    assert sorted(os.listdir(tmp_path / "51698")) == \
+        ["2020-01.csv.gz", "2020-02.csv.gz", "2020-03.refused",
+         "2020-05.csv.gz", "2020-06.partial.csv.gz"]
+    assert (cache.hits, cache.misses, cache.refreshed) == (0, 6, 0)
+    # the failed month and the current month are downloaded again
+    before = dict(server.calls)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        texts = data_ingest.eccc_download(51698, periods, retries=1,
+                                          backoff=0.01, base_url=server.url,
+                                          cache=cache)
+    assert {period: n - before[period] for period, n in server.calls.items()
+            if n > before[period]} == {(2020, 4): 1, (2020, 6): 1}
+    assert texts == expected[:2] + [None] + expected[3:]
+    assert (cache.hits, cache.misses, cache.refreshed) == (4, 7, 1)
+    assert cache.stats()["hit_rate"] == 4/12
+
+
+def test_eccc_download_failed(eccc_server):
+    # 5xx beyond the retries without cache
+    server = eccc_server({(2020, 2): [500] * 3})
+    with pytest.warns(UserWarning, match="1 month"):
+        texts = data_ingest.eccc_download(51698, PERIODS[:2], retries=2,
+                                          backoff=0.01, base_url=server.url)
+    assert texts == ["2020-1,51698\n", None]
+    assert server.calls[(2020, 2)] == 3
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 11:40:26 2026
+Tests of the screening functions of data_screening
+
+Run with: python -m pytest -q test_data_screening.py
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import data_screening
+
+
+def dependency_yaml(dependent):
+    """YAML dict of variables with the given dependencies."""
+    yaml = {}
+    for var, dep in dependent.items():
+        yaml[var] = {"inputFileName": var, "variableName": var,
+                     "minMax": [-100, 100]}
+        if dep is not None:
+            yaml[var]["dependent"] = dep
+    return yaml
+
+
+@pytest.fixture
+def frame():
+    index = pd.date_range("2020-01-01", periods=6, freq="30min")
+    return pd.DataFrame({"A": np.arange(6.), "B": np.arange(6.),
+                         "C": np.arange(6.), "D": np.arange(6.)},
+                        index=index)
+
+
+def test_dependencies_multi_level(frame):
+    # A depends on B, B on C: the nan of C reach A through B
+    yaml = dependency_yaml({"A": "B", "B": ["C"], "C": None, "D": None})
+    frame.loc[frame.index[1], "C"] = np.nan
+    frame.loc[frame.index[3], "B"] = np.nan
+    plan = data_screening.dependency_plan(yaml)
+    assert plan.order.index("C") < plan.order.index("B") \
+        < plan.order.index("A")
+    out = data_screening.dependencies_filtering(yaml, frame)
+    assert list(out.A.isna()) == [False, True, False, True, False, False]
+    assert list(out.B.isna()) == [False, True, False, True, False, False]
+    assert list(out.C.isna()) == [False, True, False, False, False, False]
+    assert out.D.notna().all()
+    assert out.attrs["missing_variables"] == []
+
+
+def test_dependencies_self_loop(frame):
+    # accepted as before the dependency graph
+    yaml = dependency_yaml({"A": ["A", "B"], "B": "B"})
+    frame.loc[frame.index[2], "B"] = np.nan
+    out = data_screening.dependencies_filtering(yaml, frame)
+    assert list(out.A.isna()) == [False, False, True, False, False, False]
+    assert out.B.isna().sum() == 1
+
+
+def test_dependencies_cycle():
+    yaml = dependency_yaml({"A": "B", "B": "C", "C": "A", "D": "A"})
+    with pytest.raises(ValueError, match="Cyclic") as error:
+        data_screening.dependency_plan(yaml)
+    for var in "ABC":
+        assert var in str(error.value)
+
+
+def exclusion_mask(index, intervals, variable):
+    """Mask of the former callers, one comparison per interval."""
+    mask = np.zeros(len(index), dtype=bool)
+    for start, end, variables in intervals:
+        if variables == "all" or variable in variables:
+            mask |= (index >= start) & (index <= end)
+    return mask
+
+
+def test_date_exclusions_bounds():
+    index = pd.date_range("2020-01-01", periods=10, freq="30min")
+    exclusions = data_screening.DateExclusions([
+        {"start": None, "end": "2020-01-01 01:00"},
+        {"start": "2020-01-01 02:00", "end": "2020-01-01 02:00",
+         "variables": "FC"},
+        {"start": "2020-01-01 03:30", "end": None, "variables": ["LE"]}])
+    # both bounds included, open bounds to the ends of the index
+    assert list(np.flatnonzero(exclusions.mask(index))) == [0, 1, 2]
+    assert list(np.flatnonzero(exclusions.mask(index, "FC"))) == [0, 1, 2, 4]
+    assert list(np.flatnonzero(exclusions.mask(index, "LE"))) == \
+        [0, 1, 2, 7, 8, 9]
+    # bounds between the times of the index
+    exclusions = data_screening.DateExclusions(
+        [{"start": "2020-01-01 00:45", "end": "2020-01-01 01:15"}])
+    assert list(np.flatnonzero(exclusions.mask(index))) == [2]
+    with pytest.raises(ValueError, match="end after"):
+        data_screening.DateExclusions(
+            [{"start": "2020-01-02", "end": "2020-01-01"}])
+
+
+def test_date_exclusions_apply(frame, tmp_path):
+    csv = tmp_path / "exclusions.csv"
+    csv.write_text("start,end,variables,reason\n"
+                   "2020-01-01 00:30,2020-01-01 01:00,A;B,calibration\n"
+                   "2020-01-01 02:00,2020-01-01 02:00,all,power\n")
+    exclusions = data_screening.DateExclusions.from_csv(csv)
+    assert exclusions.variables() == ["A", "B", "all"]
+    out = exclusions.apply(frame)
+    assert list(out.A.isna()) == [False, True, True, False, True, False]
+    assert out.B.isna().equals(out.A.isna())
+    assert list(out.C.isna()) == [False] * 4 + [True, False]
+    masks = exclusions.masks(frame.index, ["A", "C"])
+    np.testing.assert_array_equal(masks, out[["A", "C"]].isna().to_numpy())
+    # only the variables targeted are masked
+    only_a = data_screening.DateExclusions(
+        [{"start": "2020-01-01", "end": "2020-01-02", "variables": "A"}])
+    out = only_a.apply(frame)
+    assert out.A.isna().all()
+    assert out.drop(columns="A").equals(frame.drop(columns="A"))
+
+
+def test_date_exclusions_baseline():
+    # masks of overlapping random intervals as built before the registry
+    rng = np.random.default_rng(0)
+    index = pd.date_range("2020-01-01", periods=5000, freq="30min")
+    intervals = []
+    for _ in range(40):
+        start = index[0] + pd.Timedelta(minutes=int(rng.integers(-600, 150000)))
+        end = start + pd.Timedelta(minutes=int(rng.integers(0, 3000)))
+        variables = "all" if rng.random() < 0.3 else \
+            list(rng.choice(["A", "B", "C"], rng.integers(1, 3),
+                            replace=False))
+        intervals.append((start, end, variables))
+    exclusions = data_screening.DateExclusions(
+        [{"start": s, "end": e, "variables": v} for s, e, v in intervals])
+    for var in ["A", "B", "C", "D"]:
+        expected = exclusion_mask(index, intervals, var)
+        np.testing.assert_array_equal(exclusions.mask(index, var), expected)
+        data = rng.normal(size=len(index))
+        np.testing.assert_array_equal(
+            data_screening.quality_screening(
+                data, -10, 10, exclusions.mask(index, var), np.nan, np.nan),
+            np.where(expected, np.nan, data))
+    np.testing.assert_array_equal(
+        exclusions.mask(index),
+        exclusion_mask(index, [i for i in intervals if i[2] == "all"], ""))
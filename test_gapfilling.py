@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 10:12:37 2026
+Parity tests of the MDS gap filling engines and backends
+
+The 'loop' engine with the 'numpy' backend is the reference. The
+'vectorized' engine must give bit-identical results, the 'numba' backend the
+same flags and values within 1e-12.
+
+Run with: python -m pytest -q test_gapfilling.py
+"""
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+import gapfilling
+
+
+def synthetic(ndays=70, seed=0):
+    """
+    30-min records with gaps in the fluxes and the meteorological drivers,
+    including a gap longer than 20 days and gaps at the start and end.
+    """
+    rng = np.random.default_rng(seed)
+    n = ndays * 48
+    idx = pd.date_range("2020-01-01 00:30", periods=n, freq="30min")
+    hour = idx.hour + idx.minute / 60
+    sw = np.clip(800*np.sin((hour-6)/12*np.pi), 0, None) \
+        * (0.6 + 0.4*rng.random(n))
+    ta = 10 + 8*np.sin((hour-9)/24*2*np.pi) + rng.normal(0, 1, n)
+    vpd = np.clip(0.8*ta + rng.normal(0, 2, n), 0, None)
+    df = pd.DataFrame({"FC": -0.02*sw + 2 + rng.normal(0, 2, n),
+                       "LE": 0.3*sw + rng.normal(0, 10, n),
+                       "SW_IN": sw, "TA": ta, "VPD": vpd}, index=idx)
+    for col in ["FC", "LE"]:
+        gaps = rng.random(n) < 0.3
+        for start in rng.integers(0, n, 8):
+            gaps[start:start+rng.integers(1, 200)] = True
+        df.loc[gaps, col] = -9999.
+    df.iloc[1000:1000+48*25, 0] = -9999.
+    df.iloc[:5, 1] = -9999.
+    df.iloc[-5:, 1] = -9999.
+    for col in ["SW_IN", "TA", "VPD"]:
+        gaps = rng.random(n) < 0.05
+        for start in rng.integers(0, n, 4):
+            gaps[start:start+rng.integers(1, 300)] = True
+        df.loc[gaps, col] = -9999.
+    return df
+
+
+@pytest.fixture(scope="module")
+def df():
+    return synthetic()
+
+
+CASES = {"fill": {}, "err": {"err": True, "errmean": True},
+         "fillerr": {"fillerr": True}}
+
+
+def frames(out):
+    """Outputs of gapfill as a tuple of DataFrames."""
+    return out if isinstance(out, tuple) else (out,)
+
+
+@pytest.fixture(scope="module")
+def reference(df):
+    return {case: frames(gapfilling.gapfill(df, engine="loop", **kwargs))
+            for case, kwargs in CASES.items()}
+
+
+def assert_parity(out, ref, case, rtol):
+    """Same flags, and same values within *rtol* (0 is bit-identical)."""
+    assert len(out) == len(ref)
+    for o, r in zip(out, ref):
+        assert o.columns.equals(r.columns)
+        assert o.index.equals(r.index)
+        o, r = o.to_numpy(), r.to_numpy()
+        if (rtol == 0) or (o.dtype.kind in "iu"):
+            np.testing.assert_array_equal(o, r)
+        else:
+            np.testing.assert_allclose(o, r, rtol=rtol, atol=rtol)
+    if case == "fill":
+        # quality flags
+        np.testing.assert_array_equal(out[1].to_numpy(), ref[1].to_numpy())
+    if case == "fillerr":
+        # numbers of samples of the error estimates
+        np.testing.assert_array_equal(out[3].to_numpy(), ref[3].to_numpy())
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_vectorized_bit_identical(df, reference, case):
+    out = frames(gapfilling.gapfill(df, engine="vectorized", **CASES[case]))
+    assert_parity(out, reference[case], case, 0)
+
+
+@pytest.mark.parametrize("case", CASES)
+def test_numba_parity(df, reference, case):
+    pytest.importorskip("numba")
+    out = frames(gapfilling.gapfill(df, backend="numba", **CASES[case]))
+    assert_parity(out, reference[case], case, 1e-12)
+
+
+@pytest.mark.parametrize("engine,backend",
+                         [("loop", "numpy"), ("vectorized", "numpy"),
+                          ("loop", "numba")])
+@pytest.mark.parametrize("n_jobs,chunks", [(1, 3), (2, 1), (2, 3)])
+def test_parallel_parity(df, reference, engine, backend, n_jobs, chunks):
+    if backend == "numba":
+        pytest.importorskip("numba")
+    rtol = 1e-12 if backend == "numba" else 0
+    for case, kwargs in CASES.items():
+        out = frames(gapfilling.gapfill(df, engine=engine, backend=backend,
+                                        n_jobs=n_jobs, chunks=chunks,
+                                        **kwargs))
+        assert_parity(out, reference[case], case, rtol)
+
+
+def test_numba_fallback(df, reference, monkeypatch):
+    # numba cannot be imported and no kernel was compiled yet
+    monkeypatch.setitem(sys.modules, "numba", None)
+    monkeypatch.setattr(gapfilling, "_NUMBA_KERNEL", None)
+    assert gapfilling._numba_kernel() is None
+    with pytest.warns(UserWarning, match="numba is not available"):
+        out = frames(gapfilling.gapfill(df, backend="numba"))
+    assert_parity(out, reference["fill"], "fill", 0)
+
+
+def test_incremental_nan_single_record(df, reference):
+    # NaN gaps, and a first append of a single record with freq
+    nan = df.replace(-9999., np.nan)
+    filler = gapfilling.MDSGapFiller(engine="loop", freq="30min")
+    filler.append(nan.iloc[:1])
+    for start in range(1, len(nan), 700):
+        filled, quality = filler.append(nan.iloc[start:start+700])
+    ref, ref_quality = reference["fill"]
+    np.testing.assert_array_equal(quality.to_numpy(), ref_quality.to_numpy())
+    gaps = ref_quality.to_numpy() != 0
+    np.testing.assert_array_equal(filled.to_numpy()[gaps],
+                                  ref.to_numpy()[gaps])
+
+
+def test_incremental_single_record_without_freq(df):
+    with pytest.raises(ValueError, match="freq"):
+        gapfilling.MDSGapFiller().append(df.iloc[:1])
+
+
+def test_station_cache_tz(tmp_path):
+    # the models of a tz-aware index are read from the cache at the next call
+    rng = np.random.default_rng(1)
+    idx = pd.date_range("2020-01-01", periods=500, freq="30min",
+                        tz="America/Toronto")
+    ta = 10 + rng.normal(0, 3, len(idx))
+    stations = {"near": pd.DataFrame({"TA": ta + rng.normal(0, .1, len(idx))},
+                                     index=idx),
+                "far": pd.DataFrame({"TA": rng.normal(0, 3, len(idx))},
+                                    index=idx)}
+    df = pd.DataFrame({"TA_1_1_1": ta}, index=idx)
+    df.iloc[100:150, 0] = np.nan
+    cache = str(tmp_path / "models.json")
+    filled, models = gapfilling.station_gap_fill(df, stations, cache=cache)
+    assert models.loc["TA_1_1_1", "station"] == "near"
+    assert models.fitted.all()
+    # same times in a new index object
+    df2 = df.set_axis(pd.DatetimeIndex(list(idx)))
+    filled2, models2 = gapfilling.station_gap_fill(df2, stations, cache=cache)
+    assert not models2.fitted.any()
+    pd.testing.assert_frame_equal(filled2, filled, check_freq=False)
+    # same wall times in another time zone are other data
+    df3 = df.tz_localize(None).tz_localize("UTC")
+    stations3 = {name: x.tz_localize(None).tz_localize("UTC")
+                 for name, x in stations.items()}
+    _, models3 = gapfilling.station_gap_fill(df3, stations3, cache=cache)
+    assert models3.fitted.all()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 12:05:48 2026
+Tests of the quality control flags store of qc_flags
+
+Run with: python -m pytest -q test_qc_flags.py
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+import data_screening
+import gapfilling
+import qc_flags
+from qc_flags import QCFlags
+from test_gapfilling import synthetic
+
+
+@pytest.fixture
+def index():
+    return pd.date_range("2020-01-01 00:30", periods=6, freq="30min")
+
+
+def test_set_clear(index):
+    qc = QCFlags(index, ["A"])
+    qc.set("range", [True, False, True, False, False, False], columns="A")
+    qc.set("date", pd.Series([False, True] * 3, index=index, name="A"))
+    # new variable, on part of the index
+    qc.set("dependency", [True, True], index=index[2:4], columns="B")
+    assert list(qc.columns) == ["A", "B"]
+    assert qc.flags[0, 0] == qc_flags.RANGE
+    assert qc.flags[1, 0] == qc_flags.DATE
+    assert qc.flags[2, 0] == qc_flags.RANGE
+    assert list(qc.flags[:, 1]) == [0, 0, qc_flags.DEPENDENCY,
+                                    qc_flags.DEPENDENCY, 0, 0]
+    # setting a test again clears its bit elsewhere, the other bits stay
+    qc.set("range", [False, False, False, False, False, True], columns="A")
+    assert list(qc.test("range", "A").A) == [False] * 5 + [True]
+    assert list(qc.test("date", "A").A) == [False, True] * 3
+    assert list(qc.rejected().A) == [False, True, False, True, False, True]
+    with pytest.raises(KeyError):
+        qc.test("range", "C")
+    with pytest.raises(KeyError):
+        qc.set("range", [True], index=index[:1] - pd.Timedelta("1D"),
+               columns="A")
+
+
+def test_quality_audit(index):
+    qc = QCFlags(index, ["A", "B"])
+    qc.set("foken", [True] + [False] * 5, columns="A")
+    quality = pd.DataFrame({"A": [1, 0, 2, 0, 3, 0], "B": [0] * 6},
+                           index=index)
+    qc.set_quality(quality)
+    pd.testing.assert_frame_equal(qc.quality(), quality.astype(np.uint16))
+    # the test bits are kept
+    assert qc.test("foken", "A").A.iloc[0]
+    assert qc.audit(index[0]) == {"A": ["foken", "mds class 1"]}
+    assert qc.audit(str(index[4])) == {"A": ["mds class 3"]}
+    assert qc.audit(index[1]) == {}
+    # classes set again replace the former ones
+    qc.set_quality(quality.iloc[:1] * 0 + 2)
+    assert qc.audit(index[0], "A") == {"A": ["foken", "mds class 2"]}
+    counts = qc.counts()
+    assert counts.loc["foken", "A"] == 1
+    assert counts.loc["mds", "A"] == 3
+    assert counts.loc["mds", "B"] == 1
+
+
+def test_quality_screening(index):
+    qc = QCFlags(index)
+    var = pd.Series([1., 50., np.nan, 2., 3., 4.], index=index, name="A")
+    dates = np.array([False, False, False, False, True, False])
+    screened = data_screening.quality_screening(
+        var, 0, 10, dates, np.nan, np.array([0, 0, 0, 2, 0, 0]), qc=qc)
+    assert np.isnan(screened[1:5]).all()
+    assert qc.audit(index[1]) == {"A": ["range"]}
+    assert qc.audit(index[2]) == {"A": ["nonfinite"]}
+    assert qc.audit(index[3]) == {"A": ["foken"]}
+    assert qc.audit(index[4]) == {"A": ["date"]}
+    # plain arrays with the column name
+    data_screening.quality_screening(var.to_numpy(), 0, 100, np.nan, np.nan,
+                                     np.nan, qc=qc, column="A")
+    assert qc.test("range", "A").A.sum() == 0
+    assert qc.test("foken", "A").A.sum() == 1
+    with pytest.raises(ValueError, match="column"):
+        data_screening.quality_screening(var.to_numpy(), 0, 10, np.nan,
+                                         np.nan, np.nan, qc=qc)
+
+
+def test_gapfill_flags():
+    df = synthetic(ndays=40)
+    qc = QCFlags(df.index)
+    reject = np.zeros(len(df), dtype=bool)
+    reject[100:110] = True
+    qc.set("range", reject, columns="FC")
+    # FC has a gap of 19 days at the end, a large margin with longgap=10
+    filled, quality = gapfilling.gapfill(df, flag=qc, engine="loop",
+                                         longgap=10)
+    # rejected data are filled as missing data
+    ref, ref_quality = gapfilling.gapfill(
+        df.where(~np.column_stack([reject] + [np.zeros(len(df), bool)] * 4),
+                 -9999.), engine="loop", longgap=10)
+    pd.testing.assert_frame_equal(filled, ref)
+    # quality classes and large gaps are written back
+    np.testing.assert_array_equal(qc.quality(["FC", "LE"]).to_numpy(),
+                                  quality[["FC", "LE"]].to_numpy())
+    assert qc.test("range", "FC").FC.sum() == 10
+    largegap = qc.test("largegap", "FC").FC.to_numpy()
+    assert largegap.any()
+    assert (quality.FC.to_numpy()[largegap] == 0).all()
+    assert "largegap" in qc.audit(df.index[largegap][0], "FC")["FC"]